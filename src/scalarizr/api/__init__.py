@@ -11,6 +11,7 @@ api_routes = {
     'apache': 'scalarizr.api.apache.ApacheAPI',
     'app': 'scalarizr.api.apache.ApacheAPI',
     'chef': 'scalarizr.api.chef.ChefAPI',
+    'executor': 'scalarizr.api.executor.ExecutorAPI',
     'haproxy': 'scalarizr.api.haproxy.HAProxyAPI',
     'mariadb': 'scalarizr.api.mariadb.MariaDBAPI',
     'memcached': 'scalarizr.api.memcached.MemcachedAPI',
@@ -15,9 +15,19 @@ import binascii
 import logging
 import sys
 import time
+import gzip
+import errno
+import Queue
+import select
+import socket
 import urllib2
-import hashlib
-import hmac
+import cStringIO
+import threading
+import SocketServer
+import wsgiref.simple_server
+# time.strptime() imports it on first call, which isn't thread-safe:
+# concurrent requests fail with "'module' object has no attribute '_strptime_time'"
+import _strptime
 try:
     import json
 except ImportError:
@@ -26,11 +36,15 @@ except ImportError:
 
 from scalarizr import rpc
 from scalarizr.util import cryptotool
+from scalarizr.util import metrics
 from scalarizr.bus import bus
 
 LOG_CATEGORY = 'scalarizr.api'
 LOG = logging.getLogger(LOG_CATEGORY)
 
+# Responses smaller than that are sent uncompressed
+GZIP_MIN_SIZE = 1024
+
 
 
 class Security(object):
@@ -40,13 +54,12 @@ class Security(object):
         self.crypto_key_path = crypto_key_path
 
     def _read_crypto_key(self):
-        return binascii.a2b_base64(open(self.crypto_key_path).read().strip())
+        return cryptotool.read_key(self.crypto_key_path)
 
     def sign(self, data, key, timestamp=None):
         date = time.strftime(self.DATE_FORMAT, timestamp or time.gmtime())
-        canonical_string = data + date
 
-        digest = hmac.new(key, canonical_string, hashlib.sha1).digest()
+        digest = cryptotool.hmac_sha1(key, data, date)
         sign = binascii.b2a_base64(digest)
         if sign.endswith('\n'):
             sign = sign[:-1]
@@ -72,11 +85,26 @@ class Security(object):
             raise rpc.InvalidRequestError('Failed to encrypt data. Error: %s' % (sys.exc_info()[1], ))
 
 
+def gzip_data(data, compresslevel=6):
+    buf = cStringIO.StringIO()
+    fp = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=compresslevel)
+    try:
+        fp.write(data)
+    finally:
+        fp.close()
+    return buf.getvalue()
+
+
+def gunzip_data(data):
+    return gzip.GzipFile(fileobj=cStringIO.StringIO(data)).read()
+
+
 class WsgiApplication(Security):
 
-    def __init__(self, req_handler, crypto_key_path):
+    def __init__(self, req_handler, crypto_key_path, gzip_min_size=None):
         Security.__init__(self, crypto_key_path)
         self.req_handler = req_handler
+        self.gzip_min_size = gzip_min_size
 
 
     def __call__(self, environ, start_response):
@@ -101,9 +129,14 @@ class WsgiApplication(Security):
             result = self.encrypt_data(result)
             sig, date = self.sign(result, self._read_crypto_key())
             headers = [('Content-type', 'application/json'),
-                            ('Content-length', str(len(result))),
                             ('X-Signature', sig),
                             ('Date', date)]
+            # signature is calculated on uncompressed data
+            if self.gzip_min_size is not None and len(result) >= self.gzip_min_size \
+                    and 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', ''):
+                result = gzip_data(result)
+                headers.append(('Content-Encoding', 'gzip'))
+            headers.append(('Content-length', str(len(result))))
 
             start_response('200 OK', headers)
             return [result, ]
@@ -116,10 +149,12 @@ class WsgiApplication(Security):
 
 
     def handle_meta_params(self, req):
-        if 'params' in req and '_platform_access_data' in req['params']:
-            pl = bus.platform
-            pl.set_access_data(req['params']['_platform_access_data'])
-            del req['params']['_platform_access_data']
+        for item in req if isinstance(req, list) else [req]:
+            if isinstance(item, dict) and item.get('params') \
+                    and '_platform_access_data' in item['params']:
+                pl = bus.platform
+                pl.set_access_data(item['params']['_platform_access_data'])
+                del item['params']['_platform_access_data']
         return self
 
     def __enter__(self):
@@ -158,12 +193,220 @@ class HttpServiceProxy(rpc.ServiceProxy, Security):
 
         namespace = self.local.method[0] if len(self.local.method) > 1 else ''
 
+        headers['Accept-Encoding'] = 'gzip'
+
         http_req = urllib2.Request(posixpath.join(self.endpoint, namespace), jsonrpc_req, headers)
         try:
-            jsonrpc_resp = urllib2.urlopen(http_req).read()
+            resp = urllib2.urlopen(http_req)
+            jsonrpc_resp = resp.read()
+            if resp.info().get('Content-Encoding') == 'gzip':
+                jsonrpc_resp = gunzip_data(jsonrpc_resp)
             if self.crypto_key_path and not self.sign_only:
                 return self.decrypt_data(jsonrpc_resp)
             else:
                 return jsonrpc_resp
         except urllib2.HTTPError, e:
             raise Exception('%s: %s' % (e.code, e.read()))
+
+
+class _ServerHandler(wsgiref.simple_server.ServerHandler):
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        wsgiref.simple_server.ServerHandler.cleanup_headers(self)
+        # without Content-Length the only way to mark response end is to close connection
+        if 'Content-Length' not in self.headers:
+            self.request_handler.close_connection = 1
+        # don't hold worker with idle connection while others wait for it
+        server = self.request_handler.server
+        if server.backlogged() or \
+                self.request_handler.served >= server.max_keep_alive_requests:
+            self.request_handler.close_connection = 1
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+
+class KeepAliveRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    '''
+    HTTP/1.1 WSGI request handler, serves requests from one connection
+    until client closes it, it's idle for `server.keep_alive_timeout` seconds
+    or other connections are waiting for a worker
+    '''
+    protocol_version = 'HTTP/1.1'
+    # response goes out in one write, small writes on keep-alive connection
+    # get stuck by Nagle and client's delayed ACK
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # how often idle connection checks server backlog
+    idle_poll_interval = 0.05
+
+    def setup(self):
+        self.timeout = self.server.keep_alive_timeout
+        self.served = 0
+        wsgiref.simple_server.WSGIRequestHandler.setup(self)
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self._wait_next_request():
+            self.handle_one_request()
+
+    def _wait_next_request(self):
+        '''
+        Waits for the next request on idle connection.
+        Returns False when it should be closed to give the worker back
+        '''
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        if rbuf is not None and rbuf.tell():
+            # pipelined request is already read into buffer
+            return True
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        while True:
+            wait = self.idle_poll_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return False
+            try:
+                if select.select([self.connection], [], [], wait)[0]:
+                    return True
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    return False
+            if self.server.backlogged():
+                return False
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            self.close_connection = 1
+            return
+        self.served += 1
+        self.server.stats.incr('requests')
+        handler = _ServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        LOG.debug('%s - %s', self.client_address[0], format % args)
+
+
+class PooledWsgiServer(wsgiref.simple_server.WSGIServer):
+    '''
+    WSGI server with fixed number of worker threads. Accepted connections
+    wait for a worker in a queue of queue_size, when it's full client gets
+    503 Service Unavailable instead of another thread
+    '''
+    keep_alive_timeout = 5
+    # connection is closed after this number of requests, so it can't hold worker forever
+    max_keep_alive_requests = 100
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class=KeepAliveRequestHandler,
+                workers=4, queue_size=32, keep_alive_timeout=None):
+        wsgiref.simple_server.WSGIServer.__init__(self, server_address, handler_class)
+        if keep_alive_timeout is not None:
+            self.keep_alive_timeout = keep_alive_timeout
+        self.stats = metrics.Counters('accepted', 'rejected', 'requests')
+        self._queue = Queue.Queue(queue_size)
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name='API worker %d' % i)
+            t.setDaemon(True)
+            t.start()
+            self._workers.append(t)
+
+    def backlogged(self):
+        return not self._queue.empty()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self._close(request)
+
+    def _close(self, request):
+        try:
+            request.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        self.close_request(request)
+
+    def _drain(self):
+        while True:
+            try:
+                request, client_address = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+            self._close(request)
+
+    def process_request(self, request, client_address):
+        try:
+            self._queue.put_nowait((request, client_address))
+            self.stats.incr('accepted')
+        except Queue.Full:
+            self.stats.incr('rejected')
+            LOG.warn('API request queue is full, rejecting connection from %s', client_address[0])
+            try:
+                request.sendall('HTTP/1.1 503 Service Unavailable\r\n'
+                        'Retry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            except socket.error:
+                pass
+            self._close(request)
+
+    def server_close(self):
+        wsgiref.simple_server.WSGIServer.server_close(self)
+        # Queued connections will never be served now
+        self._drain()
+        for _ in self._workers:
+            try:
+                self._queue.put_nowait(None)
+            except Queue.Full:
+                # Queue is smaller then pool, wait for a worker to take previous sentinel
+                try:
+                    self._queue.put(None, timeout=self.keep_alive_timeout + 1)
+                except Queue.Full:
+                    LOG.warn('API workers are busy, not waiting for them to stop')
+                    break
+        for t in self._workers:
+            t.join(self.keep_alive_timeout + 1)
+        self._workers = []
+
+
+class ThreadingWsgiServer(SocketServer.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    pass
+
+
+def make_server(host, port, app, workers=None, queue_size=32, keep_alive_timeout=None):
+    '''
+    API server: PooledWsgiServer when workers > 0,
+    otherwise former thread per connection HTTP/1.0 server
+    '''
+    if workers:
+        server = PooledWsgiServer((host, port), workers=workers, queue_size=queue_size,
+                        keep_alive_timeout=keep_alive_timeout)
+    else:
+        server = ThreadingWsgiServer((host, port), wsgiref.simple_server.WSGIRequestHandler)
+    server.set_app(app)
+    return server
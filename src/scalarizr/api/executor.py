@@ -0,0 +1,46 @@
+import logging
+
+from scalarizr import rpc
+from scalarizr import bollard
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ExecutorAPI(object):
+    """
+    Basic API to inspect task executor.
+
+    Namespace::
+
+        executor
+    """
+
+    def __init__(self, executor=None):
+        self.executor = executor or bollard.Executor()
+
+    @rpc.query_method
+    def stats(self):
+        """
+        Returns worker pool and task queue statistics:
+        queue depth, worker utilisation and task wait time.
+
+        :rtype: dict
+
+        Example::
+
+            {
+                'workers': 3,
+                'min_workers': 1,
+                'max_workers': 4,
+                'busy_workers': 2,
+                'utilisation': 0.67,
+                'queue_depth': 5,
+                'waiting_for_limit': 2,
+                'running': {'backup': 1, 'api.status': 1},
+                'task_limits': {'backup': 1},
+                'wait_time': {'count': 120, 'last': 0.001, 'avg': 0.4, 'p50': 0.002,
+                              'p99': 5.1, 'max': 6.0}
+            }
+        """
+        return self.executor.stats()
@@ -4,8 +4,13 @@ Created on Nov 25, 2011
 @author: marat
 '''
 
+from __future__ import with_statement
+
 from pprint import pformat
 import logging
+import threading
+import functools
+import time
 from collections import OrderedDict
 
 from scalarizr import exceptions
@@ -17,6 +22,7 @@ from scalarizr import rpc
 from scalarizr import linux
 from scalarizr.handlers import get_role_servers
 from scalarizr.util import Singleton
+from scalarizr.util import Debounce
 from scalarizr.util.initdv2 import Status
 from scalarizr.util import PopenError
 from scalarizr import exceptions
@@ -27,6 +33,10 @@ from scalarizr.api import operation
 
 
 LOG = logging.getLogger(__name__)
+# seconds to coalesce haproxy.cfg writes after runtime API updates
+PERSIST_DELAY = 2
+# seconds to reuse `show stat` result
+STATS_TTL = 1
 HEALTHCHECK_DEFAULTS = {
     'timeout_check': '3s',
     'default-server': OrderedDict((('fall', 2), ('inter', '30s'), ('rise', 10)))
@@ -49,6 +59,14 @@ def normalize_params(params):
     ])
 
 
+def _synchronized(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwds):
+        with self._lock:
+            return method(self, *args, **kwds)
+    return wrapper
+
+
 _rule_protocol = validate.rule(choises=['tcp', 'http', 'TCP', 'HTTP'])
 _rule_backend = validate.rule(re=r'^role:\d+$')
 _rule_hc_target = validate.rule(re='^[tcp|http]+:\d+$')
@@ -132,6 +150,10 @@ class HAProxyAPI(BehaviorAPI):
 
     behavior = 'haproxy'
 
+    # Apply server add/remove/enable/disable through the stats socket
+    # instead of reload when running haproxy already knows the server
+    runtime_api = True
+
     def __init__(self, path=None):
         self.cfg = haproxy.HAProxyConfManager() #haproxy.HAProxyCfg(path)
         open(self.cfg.conf_path, 'w').close()  # clear conf file
@@ -139,6 +161,124 @@ class HAProxyAPI(BehaviorAPI):
         self.naming_mgr = SectionNamingMgr()
         self._op_api = operation.OperationAPI()
         self._proxies_table = {}
+        # Augeas tree is shared with deferred writer
+        self._lock = threading.RLock()
+        self._persist = Debounce(self._save_conf, PERSIST_DELAY,
+                                 lock=self._lock, name='haproxy.cfg write')
+        self._stat_socket = haproxy.StatSocket()
+        self._stats = None
+        self._stats_time = 0
+        # (backend, server) removed from haproxy.cfg but still known
+        # to running haproxy in maintenance mode
+        self._removed_servers = set()
+
+    def _save_conf(self):
+        self.cfg.save()
+
+    def _reload(self):
+        """
+        Writes haproxy.cfg now and reloads running haproxy
+        """
+        self._persist.cancel()
+        self.cfg.save()
+        if self.svc.status() == Status.RUNNING:
+            self.svc.reload()
+        self._removed_servers.clear()
+        self._stats = None
+
+    def _runtime(self, command, servers):
+        """
+        Runs `enable server` / `disable server` for (backend, server) pairs.
+        Returns False when changes can't be applied without reload
+        """
+        if not self.runtime_api or self.svc.status() != Status.RUNNING:
+            return False
+        try:
+            if command == 'enable':
+                self._stat_socket.enable_server(*servers)
+            else:
+                self._stat_socket.disable_server(*servers)
+        except haproxy.HAProxyError, e:
+            LOG.debug('Runtime API update failed, reloading haproxy: %s', e)
+            return False
+        self._stats = None
+        return True
+
+    def _apply(self, command, servers):
+        """
+        Applies server state changes, already made in self.cfg, to running haproxy.
+        haproxy.cfg write is deferred and coalesced with subsequent updates
+        """
+        if not servers:
+            return
+        if self._runtime(command, servers):
+            LOG.debug('%sd servers with runtime API: %s', command, servers)
+            self._persist()
+        else:
+            self._reload()
+
+    def _ensure_stats_socket(self):
+        """
+        Admin level stats socket is needed for health stats and runtime updates.
+        Returns True if haproxy.cfg was changed
+        """
+        if self.cfg.get('global/stats_socket/path') == haproxy.STATS_SOCKET and \
+                self.cfg.get('global/stats_socket/level') == 'admin':
+            return False
+        self.cfg.remove('global/stats_socket')
+        self.cfg.set('global/stats_socket', OrderedDict((
+                ('path', haproxy.STATS_SOCKET), ('level', 'admin'))), save_conf=False)
+        if not self.cfg.get('global/spread-checks'):
+            self.cfg.set('global/spread-checks', '5', save_conf=False)
+        return True
+
+    def _server_stats(self):
+        """
+        Returns `show stat` rows without servers removed from haproxy.cfg,
+        running haproxy keeps them in maintenance mode until reload
+        """
+        now = time.time()
+        if self._stats is None or now - self._stats_time > STATS_TTL:
+            self._stats = self._stat_socket.show_stat()
+            self._stats_time = now
+        if not self._removed_servers:
+            return self._stats
+        return [stat for stat in self._stats
+                if (stat.get('pxname'), stat.get('svname')) not in self._removed_servers]
+
+    def _find_servers(self, server, backend=None):
+        """
+        Returns [(backend_name, server_name, server_xpath)] for server matching name
+        """
+        srv_name = self._server_name(server)
+        ret = []
+        for backend_xpath in self.cfg.get_all_xpaths('backend'):
+            backend_name = self.cfg.get(backend_xpath+'/name')
+            if backend and backend_name != backend:
+                continue
+            found_servers = self.cfg.find_all_xpaths(backend_xpath+'/server',
+                'name',
+                srv_name.replace('*', '\*')+'.*')
+            for server_xpath in found_servers:
+                ret.append((backend_name, self.cfg.get(server_xpath+'/name'), server_xpath))
+        return ret
+
+    def _add_servers(self, backend_server_pairs):
+        """
+        Adds servers to backends. Servers removed earlier are brought back
+        from maintenance mode, new ones need reload
+        """
+        servers = []
+        for backend_xpath, server in backend_server_pairs:
+            self.cfg.add(backend_xpath+'/server', server)
+            servers.append((self.cfg.get(backend_xpath+'/name'), server['name']))
+
+        disabled = any(server.get('disabled') for _, server in backend_server_pairs)
+        if not disabled and self._removed_servers.issuperset(servers):
+            self._removed_servers.difference_update(servers)
+            self._apply('enable', servers)
+        else:
+            self._reload()
 
     def _server_name(self, server):
         if isinstance(server, basestring):
@@ -214,6 +354,7 @@ class HAProxyAPI(BehaviorAPI):
         """
         return self.svc.status()
 
+    @_synchronized
     def do_reconfigure(self, op, proxies, template=None):
         """
         template is a raw part of haproxy.conf which is inserted at the beginning
@@ -233,6 +374,9 @@ class HAProxyAPI(BehaviorAPI):
                 'timeout_client': '5000ms',
                 'timeout_server': '5000ms'}
             self.cfg.add('defaults', defaults)
+        self._ensure_stats_socket()
+        self._persist.cancel()
+        self._removed_servers.clear()
             
         for proxy in proxies:       
             LOG.debug("Calling make_proxy port=%s, backends=%s, %s", proxy["port"],
@@ -273,6 +417,7 @@ class HAProxyAPI(BehaviorAPI):
         return ordered_server_params
 
     @rpc.command_method
+    @_synchronized
     def make_proxy(self, port, backend_port=None, backends=None, template=None,
                 check_timeout=None, maxconn=None, **default_server_params):
         """
@@ -429,6 +574,7 @@ class HAProxyAPI(BehaviorAPI):
         if self.svc.status() == Status.RUNNING:
             self.svc.reload()
 
+    @_synchronized
     def remove_proxy(self, port):
         """
         Removes listen and backend sections from haproxy.cfg and restarts service
@@ -442,13 +588,13 @@ class HAProxyAPI(BehaviorAPI):
         self.cfg.remove(listener_xpath)
         self.cfg.remove(backend_xpath)
 
-        self.cfg.save()
-        self.svc.reload()
+        self._reload()
 
         if iptables.enabled():
             close_port(port)
         
     @rpc.command_method
+    @_synchronized
     def add_server(self, server=None, backend=None):
         """
         Adds server with ipaddr to backend section.
@@ -463,6 +609,8 @@ class HAProxyAPI(BehaviorAPI):
 
             TBD.
         """
+        # don't lose deferred changes
+        self._persist.flush()
         self.cfg.load()
 
         if backend:
@@ -482,13 +630,10 @@ class HAProxyAPI(BehaviorAPI):
         server = normalize_params(server)
         server = self._ordered_server_params(server)
 
-        for backend_xpath in backend_xpaths:
-            self.cfg.add(backend_xpath+'/server', server)
-
-        self.cfg.save()
-        self.svc.reload()
+        self._add_servers([(backend_xpath, server) for backend_xpath in backend_xpaths])
 
     @rpc.command_method
+    @_synchronized
     def add_server_to_role(self, server, role_id):
         """
         Adds server to each backend which contains role_id
@@ -516,14 +661,10 @@ class HAProxyAPI(BehaviorAPI):
             return
 
         LOG.debug("Adding servers to backends: %s", backend_server_pairs)
-
-        for backend_xpath, server in backend_server_pairs:
-            self.cfg.add(backend_xpath+'/server', server)
-
-        self.cfg.save()
-        self.svc.reload()
+        self._add_servers(backend_server_pairs)
 
     @rpc.command_method
+    @_synchronized
     def remove_server(self, server, backend=None):
         """
         Removes server with ipaddr from backend section.
@@ -543,29 +684,63 @@ class HAProxyAPI(BehaviorAPI):
             backend = backend.strip()
         if isinstance(server, dict) and 'host' in server:
             server['address'] = server.pop('host')
-        srv_name = self._server_name(server)
 
-        backend_xpaths = self.cfg.get_all_xpaths('backend')
-        for backend_xpath in backend_xpaths:
-            found_servers = self.cfg.find_all_xpaths(backend_xpath+'/server',
-                'name',
-                srv_name.replace('*', '\*')+'.*')
-            for server_xpath in found_servers:
-                self.cfg.remove(server_xpath)
-                self.cfg.save() # DBG:
+        servers = []
+        # removing from the end keeps xpath indexes of the rest valid
+        for backend_name, server_name, server_xpath in reversed(self._find_servers(server)):
+            self.cfg.remove(server_xpath)
+            servers.append((backend_name, server_name))
 
-        self.cfg.save()
-        if self.svc.status() == Status.RUNNING:
-            self.svc.reload()
+        self._removed_servers.update(servers)
+        self._apply('disable', servers)
+
+    def _set_server_disabled(self, server, backend, disabled):
+        if backend:
+            backend = backend.strip()
+        if isinstance(server, dict) and 'host' in server:
+            server['address'] = server.pop('host')
+        found = self._find_servers(server, backend)
+        if not found:
+            raise exceptions.NotFound('Server not found: %s' % (self._server_name(server), ))
+        for _, _, server_xpath in found:
+            self.cfg.set(server_xpath+'/disabled', disabled, save_conf=False)
+        self._apply('disable' if disabled else 'enable',
+                    [(backend_name, server_name) for backend_name, server_name, _ in found])
+
+    @rpc.command_method
+    @_synchronized
+    def enable_server(self, server, backend=None):
+        """
+        Returns server from maintenance mode without haproxy reload.
+
+        :param server: Server address or configuration.
+        :type server: str or dict
+
+        :param backend: Backend name, all backends by default.
+        :type backend: str
+        """
+        self._set_server_disabled(server, backend, False)
+
+    @rpc.command_method
+    @_synchronized
+    def disable_server(self, server, backend=None):
+        """
+        Puts server into maintenance mode without haproxy reload.
+
+        :param server: Server address or configuration.
+        :type server: str or dict
+
+        :param backend: Backend name, all backends by default.
+        :type backend: str
+        """
+        self._set_server_disabled(server, backend, True)
 
+    @_synchronized
     def health(self):
-        if self.cfg.get('globals/stats_socket') != '/var/run/haproxy-stats.sock':
-            self.cfg.set('globals/stats_socket', '/var/run/haproxy-stats.sock')
-            self.cfg.set('globals/spread-checks', '5')
-            self.cfg.save()
-            self.svc.reload()
+        if self._ensure_stats_socket():
+            self._reload()
 
-        stats = haproxy.StatSocket().show_stat()
+        stats = self._server_stats()
 
         # filter the stats
         relevant_keys = [
@@ -581,35 +756,33 @@ class HAProxyAPI(BehaviorAPI):
             "check_duration",
         ]
         
-        stats = filter(lambda health: health["svname"] not in ("FRONTEND", "BACKEND"), stats)
-        for health in stats:
-            for key in health.keys():
-                if key not in relevant_keys:
-                    del health[key]
+        stats = [dict((key, health[key]) for key in relevant_keys if key in health)
+                 for health in stats if health["svname"] not in ("FRONTEND", "BACKEND")]
 
         # TODO: return data in different format
         return stats
 
     @rpc.query_method
     @validate.param('ipaddr', type='ipv4', optional=True)
+    @_synchronized
     def get_servers_health(self, ipaddr=None):
         """
         APIDOC TBD.
         """
 
-        if self.cfg.get('globals/stats_socket') != '/var/run/haproxy-stats.sock' \
-            or not self.cfg.get('defaults/stats_enable'):
-            self.cfg.set('globals/stats_socket', '/var/run/haproxy-stats.sock')
-            self.cfg.set('defaults/stats_enable')
-            self.cfg.save()
-            self.svc.reload()
+        changed = self._ensure_stats_socket()
+        if not self.cfg.get('defaults/stats_enable'):
+            self.cfg.set('defaults/stats_enable', save_conf=False)
+            changed = True
+        if changed:
+            self._reload()
 
         #TODO: select parameters what we need with filter by ipaddr
-        stats = haproxy.StatSocket().show_stat()
-        return stats
+        return [dict(stat) for stat in self._server_stats()]
 
     @rpc.command_method
     @validate.param('target', required=_rule_hc_target)
+    @_synchronized
     def reset_healthcheck(self, target):  # TODO: figure out what target is
         """
         Return to defaults for `target` backend sections
@@ -622,10 +795,10 @@ class HAProxyAPI(BehaviorAPI):
         for backend_xpath in backend_xpaths:
             self.cfg.set(backend_xpath, HEALTHCHECK_DEFAULTS)
 
-        self.cfg.save()
-        self.svc.reload()
+        self._reload()
 
     @rpc.query_method
+    @_synchronized
     def list_listeners(self):
         """
         :returns: Listeners list
@@ -643,6 +816,7 @@ class HAProxyAPI(BehaviorAPI):
             }, ...]
 
         """
+        self._persist.flush()
         self.cfg.load()
         res = []
         for listener_xpath in self.cfg.get_all_xpaths('listen'):
@@ -665,6 +839,7 @@ class HAProxyAPI(BehaviorAPI):
 
 
     @rpc.query_method
+    @_synchronized
     def list_servers(self, backend=None):
         """
         Lists all servers or servers from particular backend.
@@ -6,8 +6,11 @@ import time
 import cStringIO
 import sys
 import multiprocessing
+import threading
+import functools
 from telnetlib import Telnet
 from hashlib import sha1
+from collections import OrderedDict
 
 from scalarizr import rpc
 from scalarizr import linux
@@ -20,6 +23,8 @@ from scalarizr.util import system2
 from scalarizr.util import PopenError
 from scalarizr.util import Singleton
 from scalarizr.util import firstmatched
+from scalarizr.util import Debounce
+from scalarizr.util import metrics
 from scalarizr import linux
 from scalarizr.linux import iptables
 from scalarizr.linux import LinuxError
@@ -300,12 +305,29 @@ def _fetch_ssl_certificate(ssl_certificate_id):
     return update_ssl_certificate(ssl_certificate_id, cert, key, cacert)
 
 
+def _locked(fn):
+    '''
+    Runs NginxAPI method under self._lock: backend_table and app-servers.include
+    are also rewritten by upstream update timer
+    '''
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwds):
+        with self._lock:
+            return fn(self, *args, **kwds)
+    return wrapper
+
+
 class NginxAPI(BehaviorAPI):
 
     __metaclass__ = Singleton
 
     behavior = 'www'
 
+    # Seconds to accumulate add_server_to_role/remove_server_from_role calls
+    # before applying them with single write, configtest and reload. 0 applies at once.
+    # Overridden by upstream_update_delay option in www.ini
+    upstream_update_delay = 2
+
     def __init__(self, app_inc_dir=None, proxies_inc_dir=None):
         """
         Basic API for configuring and managing Nginx service.
@@ -334,6 +356,20 @@ class NginxAPI(BehaviorAPI):
         if self.proxies_inc_dir:
             self.proxies_inc_path = os.path.join(self.proxies_inc_dir, 'proxies.include')
 
+        try:
+            self.upstream_update_delay = float(__nginx__['upstream_update_delay'])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        self._lock = threading.RLock()
+        # (server, role_id) -> 'add' | 'remove', the latest call wins
+        self._upstream_changes = OrderedDict()
+        self._apply_upstream_changes = Debounce(self._flush_upstream_changes,
+                                                lambda: self.upstream_update_delay,
+                                                lock=self._lock,
+                                                name='nginx upstream update')
+        self.upstream_stats = metrics.Counters('queued', 'coalesced', 'applied', 'reloads')
+
     def init_service(self):
         _logger.debug('Initializing nginx API.')
         self._load_app_servers_inc()
@@ -495,6 +531,7 @@ class NginxAPI(BehaviorAPI):
         return self.service.status()
 
     @rpc.command_method
+    @_locked
     def recreate_proxying(self, proxy_list, reload_service=True):
         """
         Recreates Nginx proxying configuration.
@@ -518,6 +555,10 @@ class NginxAPI(BehaviorAPI):
             proxy_list = []
 
         _logger.debug('Recreating proxying with %s' % proxy_list)
+        # servers are taken from the actual roles list
+        with self._lock:
+            self._apply_upstream_changes.cancel()
+            self._upstream_changes.clear()
         self._clear_nginx_includes()
         self.backend_table = {}
         if linux.os.redhat_family:
@@ -556,6 +597,7 @@ class NginxAPI(BehaviorAPI):
 
         return result
 
+    @_locked
     def make_default_proxy(self, roles):
         # actually list_virtual_hosts() returns only 1 virtual host if it's
         # ssl virtual host. If there are no ssl vhosts in farm, it returns
@@ -624,6 +666,7 @@ class NginxAPI(BehaviorAPI):
         _logger.debug('After making proxy backend table is %s' % self.backend_table)
         _logger.debug('Default proxy is made')
 
+    @_locked
     def _recreate_compat_mode(self):
         _logger.debug('Compatibility mode proxying recreation')
         roles_for_proxy = []
@@ -716,6 +759,7 @@ class NginxAPI(BehaviorAPI):
             if reload_service:
                 self._reload_service()
 
+    @_locked
     def do_reconfigure(self, op, proxies):
         backend_table_bak = self.backend_table.copy()
         selinux_opened_ports_bak = self._selinux_opened_ports
@@ -1227,6 +1271,7 @@ class NginxAPI(BehaviorAPI):
 
         self.proxies_inc.append_conf(server_config)
 
+    @_locked
     def add_proxy(self,
                   name,
                   backends=[],
@@ -1431,6 +1476,7 @@ class NginxAPI(BehaviorAPI):
         return port
 
     @rpc.command_method
+    @_locked
     def remove_proxy(self, hostname, reload_service=True):
         """
         Removes proxy with given hostname. Removes created server and its backends.
@@ -1479,6 +1525,7 @@ class NginxAPI(BehaviorAPI):
             self._reload_service()
 
     @rpc.command_method
+    @_locked
     def make_proxy(self, hostname, **kwds):
         """
         RPC method for adding or updating proxy configuration.
@@ -1559,6 +1606,7 @@ class NginxAPI(BehaviorAPI):
         return result
 
     @rpc.command_method
+    @_locked
     def add_server(self,
                    backend,
                    server,
@@ -1632,6 +1680,7 @@ class NginxAPI(BehaviorAPI):
             self._reload_service()
 
     @rpc.command_method
+    @_locked
     def remove_server(self,
                       backend,
                       server,
@@ -1699,10 +1748,14 @@ class NginxAPI(BehaviorAPI):
             self._reload_service()
 
     @rpc.command_method
+    @_locked
     def add_server_to_role(self, server, role_id, update_conf=True, reload_service=True):
         """
         Adds server to each backend that uses given role. If role isn't used in
-        any backend, does nothing
+        any backend, does nothing.
+        With default update_conf and reload_service the change is queued for
+        ``upstream_update_delay`` seconds and applied together with other
+        queued changes with single reload
 
         :param server: server configuration. Can be just IP of the server or
             dict of parameters (such as 'down', 'backup' or 'port')
@@ -1733,9 +1786,6 @@ class NginxAPI(BehaviorAPI):
         update_conf = _bool_from_scalr_str(update_conf)
         reload_service = _bool_from_scalr_str(reload_service)
 
-        if update_conf:
-            self._load_app_servers_inc()
-
         if not server:
             return
         if not role_id:
@@ -1743,6 +1793,22 @@ class NginxAPI(BehaviorAPI):
         if type(role_id) is not str:
             role_id = str(role_id)
 
+        if update_conf and reload_service and self.upstream_update_delay:
+            self._queue_upstream_change(server, role_id, 'add')
+            return
+
+        if update_conf:
+            self._load_app_servers_inc()
+
+        config_updated = self._add_server_to_role(server, role_id)
+
+        if config_updated:
+            if update_conf:
+                self._save_app_servers_inc()
+            if reload_service:
+                self._reload_service()
+
+    def _add_server_to_role(self, server, role_id):
         config_updated = False
         for backend_name, backend_destinations in self.backend_table.items():
             for dest in backend_destinations:
@@ -1758,14 +1824,10 @@ class NginxAPI(BehaviorAPI):
                         self.remove_server(backend_name, '127.0.0.1', False, False)
                     dest['servers'].append(server)
                     config_updated = True
-
-        if config_updated:
-            if update_conf:
-                self._save_app_servers_inc()
-            if reload_service:
-                self._reload_service()
+        return config_updated
 
     @rpc.command_method
+    @_locked
     def remove_server_from_role(self,
                                 server,
                                 role_id,
@@ -1773,7 +1835,9 @@ class NginxAPI(BehaviorAPI):
                                 reload_service=True):
         """
         Removes server from each backend that uses given role. If role isn't
-        used in any backend, does nothing
+        used in any backend, does nothing.
+        With default update_conf and reload_service the change is queued
+        like in add_server_to_role()
 
         :param server: server IP
         :type server: str
@@ -1797,9 +1861,6 @@ class NginxAPI(BehaviorAPI):
         update_conf = _bool_from_scalr_str(update_conf)
         reload_service = _bool_from_scalr_str(reload_service)
 
-        if update_conf:
-            self._load_app_servers_inc()
-
         if not server:
             return
         if not role_id:
@@ -1807,6 +1868,22 @@ class NginxAPI(BehaviorAPI):
         if type(role_id) is not str:
             role_id = str(role_id)
 
+        if update_conf and reload_service and self.upstream_update_delay:
+            self._queue_upstream_change(server, role_id, 'remove')
+            return
+
+        if update_conf:
+            self._load_app_servers_inc()
+
+        config_updated = self._remove_server_from_role(server, role_id)
+
+        if config_updated:
+            if update_conf:
+                self._save_app_servers_inc()
+            if reload_service:
+                self._reload_service()
+
+    def _remove_server_from_role(self, server, role_id):
         config_updated = False
         for backend_name, backend_destinations in self.backend_table.items():
             for dest in backend_destinations:
@@ -1816,15 +1893,88 @@ class NginxAPI(BehaviorAPI):
                     self.remove_server(backend_name, server, False, False)
                     dest['servers'].remove(server)
                     config_updated = True
+        return config_updated
+
+    def _queue_upstream_change(self, server, role_id, action):
+        key = (server if isinstance(server, basestring) else tuple(sorted(server.items())),
+               role_id)
+        with self._lock:
+            self.upstream_stats.incr('queued')
+            if key in self._upstream_changes:
+                self.upstream_stats.incr('coalesced')
+                del self._upstream_changes[key]
+            self._upstream_changes[key] = (server, action)
+        self._apply_upstream_changes()
+
+    def _flush_upstream_changes(self):
+        """
+        Applies queued role membership changes to app-servers.include
+        with single read, write, configtest and reload.
+        On configtest failure previous app-servers.include is restored
+        """
+        with self._lock:
+            changes, self._upstream_changes = self._upstream_changes, OrderedDict()
+            if not changes:
+                return
+            _logger.debug('Applying %d queued upstream changes', len(changes))
+            self._load_app_servers_inc()
+            backend_table = dict((name, [dict(dest, servers=list(dest['servers']))
+                                        for dest in destinations])
+                                 for name, destinations in self.backend_table.items())
+
+            applied = 0
+            for (_, role_id), (server, action) in changes.items():
+                if action == 'add':
+                    applied += self._add_server_to_role(server, role_id)
+                else:
+                    applied += self._remove_server_from_role(server, role_id)
+            self.upstream_stats.incr('applied', applied)
+            if not applied:
+                return
 
-        if config_updated:
-            if update_conf:
-                self._save_app_servers_inc()
-            if reload_service:
-                self._reload_service()
+            with open(self.app_inc_path) as fp:
+                previous = fp.read()
+            self._save_app_servers_inc()
+            try:
+                self.service.configtest()
+            except initdv2.InitdError:
+                _logger.error('Restoring app-servers.include after failed configtest')
+                with open(self.app_inc_path, 'w') as fp:
+                    fp.write(previous)
+                self._load_app_servers_inc()
+                self.backend_table = backend_table
+                raise
+            self._reload_service()
+            self.upstream_stats.incr('reloads')
+
+    @rpc.command_method
+    def apply_upstream_changes(self):
+        """
+        Applies queued add_server_to_role/remove_server_from_role calls now.
+
+        Example::
+
+            api.nginx.apply_upstream_changes()
+        """
+        self._apply_upstream_changes.flush()
+
+    @rpc.query_method
+    def get_upstream_stats(self):
+        """
+        Returns counters of queued role membership changes:
+        queued calls, coalesced (superseded within the window) ones,
+        server additions/removals applied to upstreams and reloads.
+
+        Example::
+
+            >>> api.nginx.get_upstream_stats()
+            {'queued': 40, 'coalesced': 2, 'applied': 38, 'reloads': 1}
+        """
+        return self.upstream_stats.snapshot()
 
 
     @rpc.command_method
+    @_locked
     def remove_server_from_all_backends(self,
                                         server,
                                         update_conf=True,
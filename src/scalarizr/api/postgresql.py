@@ -5,7 +5,6 @@ Created on Feb 25, 2013
 '''
 
 import os
-import re
 import sys
 import logging
 import tempfile
@@ -155,35 +154,17 @@ class PostgreSQLAPI(BehaviorAPI):
                                 force=False)
         return new_password
 
-    def _parse_query_out(self, out):
+    def _parse_query_out(self, row):
         '''
-        Parses xlog_delay or error string from strings like:
-         log_delay
-        -----------
-                 034
-        (1 row)
-
-        and:
-        ERROR:  function pg_last_xact_replay_timesxtamp() does not exist
-        LINE 1: select pg_last_xact_replay_timesxtamp() as not_modified_sinc...
-                       ^
-        HINT:  No function matches the given name and argument...
-
+        Parses xlog_delay from replication_status_query result row.
+        Value is numeric with psycopg2 driver, string with psql fallback and NULL on master
         '''
         result = {'error': None, 'xlog_delay': None}
-        error_match = re.search(r'ERROR:.*?\n', out)
-        if error_match:
-            result['error'] = error_match.group()
-            return result
-
-        split = out.split()  # [SCALARIZR-1642]
-        if split and "xlog_delay" in split[0] and len(split) > 2:
-            lag = split[2]
+        if row and row[0] not in (None, ''):
             try:
-                result['xlog_delay'] = int(float(lag))
+                result['xlog_delay'] = int(float(row[0]))
             except ValueError:
                 pass
-
         return result
 
     @rpc.query_method
@@ -211,7 +192,7 @@ class PostgreSQLAPI(BehaviorAPI):
         """
         psql = postgresql_svc.PSQL()
         try:
-            query_out = psql.execute(self.replication_status_query)
+            query_out = psql.fetchone(self.replication_status_query)
         except PopenError, e:
             if 'function pg_last_xact_replay_timestamp() does not exist' in str(e):
                 raise BaseException('This version of PostgreSQL server does not support replication status')
@@ -42,6 +42,9 @@ LOG = logging.getLogger(__name__)
 
 max_log_size = 5*1024*1024
 
+# Seconds during which stats methods share one parsed /proc snapshot
+STATS_TTL = 1.0
+
 SCALR_COOKBOOKS_GIT_URL = "git://github.com/Scalr/cookbooks.git"
 
 # Role-builer uses the same mapping
@@ -123,6 +126,50 @@ class _ScalingMetricStrategy(object):
         return {'id':metric.id, 'name':metric.name, 'value':value, 'error':error}
 
 
+class _ProcSampler(object):
+    """
+    Parses /proc files at most once per ttl seconds.
+    Keeps the previous sample of each file so callers can calculate rates.
+    """
+
+    def __init__(self, ttl=STATS_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def sample(self, path, parse):
+        """
+        :return: (current, previous) samples, each is (timestamp, parse(path)) tuple.
+            previous is None until the file is parsed twice
+        """
+        with self._lock:
+            now = time.time()
+            cur, prev = self._samples.get(path, (None, None))
+            if cur is None or now - cur[0] >= self.ttl:
+                cur, prev = (now, parse(path)), cur
+                self._samples[path] = (cur, prev)
+            return cur, prev
+
+    def get(self, path, parse):
+        return self.sample(path, parse)[0][1]
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+
+def _rates(cur, prev, key, fields):
+    """
+    Per-second rates of cur[1][key] counters since prev sample.
+    Returns None values when there is no previous sample or key is new
+    """
+    if not prev or key not in prev[1] or cur[0] <= prev[0]:
+        return dict.fromkeys(fields)
+    elapsed = cur[0] - prev[0]
+    return dict((name, max(0, int(cur[1][key][idx]) - int(prev[1][key][idx])) / elapsed)
+                for name, idx in fields.items())
+
+
 class SystemAPI(object):
     """
     Pluggable API to get system information similar to SNMP, Facter(puppet), Ohai(chef).
@@ -140,6 +187,8 @@ class SystemAPI(object):
     _PATH = ['/usr/bin/', '/usr/local/bin/']
     _CPUINFO = '/proc/cpuinfo'
     _NETSTATS = '/proc/net/dev'
+    _STAT = '/proc/stat'
+    _MOUNTS = '/proc/mounts'
     _LOG_FILE = '/var/log/scalarizr.log'
     _DEBUG_LOG_FILE = '/var/log/scalarizr_debug.log'
     _UPDATE_LOG_FILE = '/var/log/scalarizr_update.log'
@@ -147,6 +196,7 @@ class SystemAPI(object):
 
     def __init__(self):
         self._op_api = operation_api.OperationAPI()
+        self._sampler = _ProcSampler()
 
 
     def _readlines(self, path):
@@ -154,6 +204,53 @@ class SystemAPI(object):
             return fp.readlines()
 
 
+    def _parse_diskstats(self, path):
+        # device -> (reads, sectors read, writes, sectors written)
+        res = {}
+        for value in self._readlines(path):
+            params = value.split()[2:]
+            # Kernels 4.18+ append discard and flush columns
+            if len(params) >= 12:
+                res[params[0]] = (int(params[1]), int(params[3]), int(params[5]), int(params[7]))
+            elif len(params) == 5:
+                res[params[0]] = tuple(int(x) for x in params[1:5])
+            else:
+                raise Exception, 'number of column in %s is unexpected. Count of column =\
+                     %s' % (path, len(params)+2)
+        return res
+
+
+    def _parse_netstats(self, path):
+        # iface -> /proc/net/dev columns
+        res = {}
+        for row in self._readlines(path):
+            if ':' not in row:
+                continue
+            iface, columns = row.split(':', 1)
+            res[iface.strip()] = columns.split()
+        return res
+
+
+    def _parse_stat(self, path):
+        with open(path) as fp:
+            return {'cpu': [int(x) for x in fp.readline().split()[1:]]}
+
+
+    def _parse_mounts(self, path):
+        return list(mount.mounts(path))
+
+
+    def _statvfs(self, mpoint):
+        try:
+            mpoint_stat = os.statvfs(mpoint)
+        except OSError:
+            return None
+        return {
+            'total': (mpoint_stat.f_bsize * mpoint_stat.f_blocks) / 1024,  # Kb
+            'free': (mpoint_stat.f_bsize * mpoint_stat.f_bavail) / 1024    # Kb
+        }
+
+
     def add_extension(self, extension):
         """
         :type extension: object
@@ -410,7 +507,7 @@ class SystemAPI(object):
             ]
         """
 
-        lines = self._readlines(self._CPUINFO)
+        lines = self._sampler.get(self._CPUINFO, self._readlines)
         res = []
         index = 0
         while index < len(lines):
@@ -429,9 +526,10 @@ class SystemAPI(object):
 
 
     @rpc.query_method
-    def cpu_stat(self):
+    def cpu_stat(self, rates=False):
 
         """
+        :param rates: Add 'usage' with CPU time percentages since the previous sample
         :return: CPU stat from /proc/stat.
         :rtype: dict
         
@@ -444,14 +542,32 @@ class SystemAPI(object):
                 'idle': 147309
             }
 
+        With rates=True::
+
+            {
+                ...
+                'usage': {'user': 2.5, 'nice': 0.0, 'system': 1.0, 'idle': 96.5}
+            }
+
         """
-        cpu = open('/proc/stat').readline().strip().split()
-        return {
-            'user': int(cpu[1]),
-            'nice': int(cpu[2]),
-            'system': int(cpu[3]),
-            'idle': int(cpu[4])
+        cur, prev = self._sampler.sample(self._STAT, self._parse_stat)
+        cpu = cur[1]['cpu']
+        res = {
+            'user': cpu[0],
+            'nice': cpu[1],
+            'system': cpu[2],
+            'idle': cpu[3]
         }
+        if rates:
+            fields = {'user': 0, 'nice': 1, 'system': 2, 'idle': 3}
+            usage = dict.fromkeys(fields)
+            if prev:
+                total = sum(cpu) - sum(prev[1]['cpu'])
+                if total > 0:
+                    for name, idx in fields.items():
+                        usage[name] = round((cpu[idx] - prev[1]['cpu'][idx]) * 100.0 / total, 2)
+            res['usage'] = usage
+        return res
 
 
     @rpc.query_method
@@ -506,8 +622,10 @@ class SystemAPI(object):
 
 
     @rpc.query_method
-    def disk_stats(self):
+    def disk_stats(self, rates=False):
         """
+        :param rates: Add per-second rates since the previous sample:
+            'iops' and 'bytes_per_sec' to <read> and <write>
         :return: Disks I/O statistics.
 
         Data format::
@@ -530,30 +648,27 @@ class SystemAPI(object):
         See more at http://www.kernel.org/doc/Documentation/iostats.txt
         """
 
-
-        lines = self._readlines(self._DISKSTATS)
+        cur, prev = self._sampler.sample(self._DISKSTATS, self._parse_diskstats)
         devicelist = {}
-        for value in lines:
-            params = value.split()[2:]
-            device = params[0]
-            for i in range(1, len(params)-1):
-                params[i] = int(params[i])
-            if len(params) == 12:
-                read = {'num': params[1], 'sectors': params[3], 'bytes': params[3]*512}
-                write = {'num': params[5], 'sectors': params[7], 'bytes': params[7]*512}
-            elif len(params) == 5:
-                read = {'num': params[1], 'sectors': params[2], 'bytes': params[2]*512}
-                write = {'num': params[3], 'sectors': params[4], 'bytes': params[4]*512}
-            else:
-                raise Exception, 'number of column in %s is unexpected. Count of column =\
-                     %s' % (self._DISKSTATS, len(params)+2)
+        for device, (rnum, rsectors, wnum, wsectors) in cur[1].items():
+            read = {'num': rnum, 'sectors': rsectors, 'bytes': rsectors*512}
+            write = {'num': wnum, 'sectors': wsectors, 'bytes': wsectors*512}
+            if rates:
+                rate = _rates(cur, prev, device, {'iops': 0, 'read_sectors': 1,
+                                                  'wops': 2, 'write_sectors': 3})
+                read['iops'] = rate['iops']
+                write['iops'] = rate['wops']
+                read['bytes_per_sec'] = rate['read_sectors'] and rate['read_sectors'] * 512
+                write['bytes_per_sec'] = rate['write_sectors'] and rate['write_sectors'] * 512
             devicelist[device] = {'write': write, 'read': read}
         return devicelist
 
 
     @rpc.query_method
-    def net_stats(self):
+    def net_stats(self, rates=False):
         """
+        :param rates: Add 'bytes_per_sec' and 'packets_per_sec' rates since
+            the previous sample to <receive> and <transmit>
         :return: Network I/O statistics.
 
         Data format::
@@ -575,18 +690,20 @@ class SystemAPI(object):
             }
         """
 
-        lines = self._readlines(self._NETSTATS)
+        cur, prev = self._sampler.sample(self._NETSTATS, self._parse_netstats)
         res = {}
-        for row in lines:
-            if ':' not in row:
-                continue
-            row = row.split(':')
-            iface = row.pop(0).strip()
-            columns = map(lambda x: x.strip(), row[0].split())
+        for iface, columns in cur[1].items():
             res[iface] = {
                 'receive': {'bytes': columns[0], 'packets': columns[1], 'errors': columns[2]},
                 'transmit': {'bytes': columns[8], 'packets': columns[9], 'errors': columns[10]},
             }
+            if rates:
+                rate = _rates(cur, prev, iface, {'rx_bytes': 0, 'rx_packets': 1,
+                                                 'tx_bytes': 8, 'tx_packets': 9})
+                res[iface]['receive'].update(bytes_per_sec=rate['rx_bytes'],
+                                             packets_per_sec=rate['rx_packets'])
+                res[iface]['transmit'].update(bytes_per_sec=rate['tx_bytes'],
+                                              packets_per_sec=rate['tx_packets'])
 
         return res
 
@@ -625,16 +742,10 @@ class SystemAPI(object):
                         'not %s' % type(mpoints))
 
         res = dict()
-        mounts = mount.mounts()
+        mounts = self._sampler.get(self._MOUNTS, self._parse_mounts)
+        known = set(m.mpoint for m in mounts) | set(m.device for m in mounts)
         for mpoint in mpoints:
-            try:
-                assert mpoint in mounts
-                mpoint_stat = os.statvfs(mpoint)
-                res[mpoint] = dict()
-                res[mpoint]['total'] = (mpoint_stat.f_bsize * mpoint_stat.f_blocks) / 1024  # Kb
-                res[mpoint]['free'] = (mpoint_stat.f_bsize * mpoint_stat.f_bavail) / 1024   # Kb
-            except:
-                res[mpoint] = None
+            res[mpoint] = self._statvfs(mpoint) if mpoint in known else None
 
         return res
 
@@ -644,10 +755,10 @@ class SystemAPI(object):
         skip_mpoint_re = re.compile(r'/(sys|proc|dev|selinux)')
         skip_fstype = ('tmpfs', 'devfs')
         ret = {}
-        for m in mount.mounts():
+        for m in self._sampler.get(self._MOUNTS, self._parse_mounts):
             if not (skip_mpoint_re.search(m.mpoint) or m.fstype in skip_fstype):
                 entry = m._asdict()
-                entry.update(self.statvfs([m.mpoint])[m.mpoint])
+                entry.update(self._statvfs(m.mpoint) or {})
                 ret[m.mpoint] = entry
         return ret
 
@@ -888,7 +999,7 @@ if linux.os.windows_family:
 
         @coinitialized
         @rpc.query_method
-        def disk_stats(self):
+        def disk_stats(self, rates=False):
             wmi = client.GetObject('winmgmts:')
 
             res = dict()
@@ -942,7 +1053,7 @@ if linux.os.windows_family:
     
         @coinitialized
         @rpc.query_method
-        def net_stats(self):
+        def net_stats(self, rates=False):
             class MIB_IFROW(ctypes.Structure):
                 _fields_ = [
                     ('wszName', wintypes.WCHAR*256),
@@ -1011,7 +1122,7 @@ if linux.os.windows_family:
 
         @coinitialized
         @rpc.query_method
-        def cpu_stat(self):
+        def cpu_stat(self, rates=False):
             raw_idle = ctypes.c_uint64(0)
             raw_kernel = ctypes.c_uint64(0)
             raw_user = ctypes.c_uint64(0)
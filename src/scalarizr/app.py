@@ -18,7 +18,7 @@ from scalarizr.config import CmdLineIni, ScalarizrCnf, ScalarizrState, Scalarizr
 from scalarizr.storage import Storage
 from scalarizr.handlers import MessageListener
 from scalarizr.messaging import MessageServiceFactory, MessageService, MessageConsumer, Queues, Messages
-from scalarizr.messaging.p2p import P2pConfigOptions
+from scalarizr.messaging.p2p import P2pConfigOptions, P2P_MESSAGE_INDEXES
 from scalarizr.platform import meta, PlatformFactory, UserDataOptions
 from scalarizr.queryenv import new_queryenv
 from scalarizr.api.binding import jsonrpc_http
@@ -54,8 +54,6 @@ import urllib
 import urllib2
 import pprint
 import select
-import wsgiref.simple_server
-import SocketServer
 
 from scalarizr import exceptions
 
@@ -241,6 +239,9 @@ def _init_db(file=None):
         if not any(filter(lambda row: row[1] == 'format', cur.fetchall())):
             cur.execute("alter table p2p_message add column format TEXT default 'xml'")
             conn.commit()
+        for sql in P2P_MESSAGE_INDEXES:
+            cur.execute(sql)
+        conn.commit()
         cur.close()
         conn.close()
     except sqlite.OperationalError, e:
@@ -255,11 +256,19 @@ def _init_db(file=None):
 
         
     # Configure database connection pool
-    t = sqlite_server.SQLiteServerThread(_db_connect)
-    t.setDaemon(True)
-    t.start()
-    sqlite_server.wait_for_server_thread(t)
-    bus.db = t.connection
+    try:
+        backend = __node__['db_backend']
+    except KeyError:
+        backend = 'proxy'
+    if backend == 'wal':
+        logger.debug('Using WAL database backend with per-thread connections')
+        bus.db = sqlite_server.LocalConnection(_db_connect)
+    else:
+        t = sqlite_server.SQLiteServerThread(_db_connect)
+        t.setDaemon(True)
+        t.start()
+        sqlite_server.wait_for_server_thread(t)
+        bus.db = t.connection
     
 
     
@@ -932,14 +941,17 @@ class Service(object):
             except socket.error:
                 pass
             STATE['global.api_port'] = api_port
+            defaults = __node__['defaults']['base']
+            base = dict(defaults, **__node__['base'])
             api_app = jsonrpc_http.WsgiApplication(rpc.RequestHandler(api.api_routes),
-                                                cnf.key_path(cnf.DEFAULT_KEY))
-            class ThreadingWSGIServer(SocketServer.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
-                pass
-            bus.api_server = wsgiref.simple_server.make_server('0.0.0.0',
+                                                cnf.key_path(cnf.DEFAULT_KEY),
+                                                gzip_min_size=jsonrpc_http.GZIP_MIN_SIZE \
+                                                        if int(base['api_gzip']) else None)
+            bus.api_server = jsonrpc_http.make_server('0.0.0.0',
                                 __node__['base']['api_port'], 
                                 api_app, 
-                                server_class=ThreadingWSGIServer)
+                                workers=int(base['api_workers']),
+                                queue_size=int(base['api_queue_size']))
 
         if ports_non_default:
             msg = msg_service.new_message('HostUpdate', None, {
@@ -1053,6 +1065,7 @@ class Service(object):
         self._logger.debug('Shutdowning API server')
         api_server = bus.api_server
         api_server.shutdown()
+        api_server.server_close()
         bus.api_server = None
 
 
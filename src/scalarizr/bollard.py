@@ -13,6 +13,7 @@ import sqlite3
 import logging
 import datetime
 import threading
+import collections
 import traceback
 import multiprocessing
 import multiprocessing.connection
@@ -22,7 +23,7 @@ from abc import ABCMeta, abstractmethod
 
 from scalarizr import util
 from scalarizr.bus import bus
-from scalarizr.util import sqlite_server
+from scalarizr.util import sqlite_server, metrics
 
 if sys.platform == 'win32':
     import win32api
@@ -45,7 +46,9 @@ else:
 
 LOG = logging.getLogger(__name__)
 
+MIN_WORKERS = 1
 MAX_WORKERS = 4
+WORKER_IDLE_TIMEOUT = 60
 SOFT_TIMEOUT = 60
 HARD_TIMEOUT = 120
 ERROR_SLEEP = 5
@@ -390,6 +393,132 @@ class IPCServer(threading.Thread):
         return
 
 
+class _TaskQueue(Queue.Queue):
+
+    """
+    Pending tasks queue aware of per-task-name concurrency limits:
+    get() skips tasks whose name has no free slot.
+    Also tracks tasks sent to workers for Executor pool sizing and stats.
+    Worker retired by Executor gets no more tasks
+    """
+
+    def __init__(self, limits=None):
+        Queue.Queue.__init__(self)
+        self.limits = dict(limits or {})
+        self.wait_time = metrics.Timings()
+        self._enqueued = {}
+        # task_id -> (name, worker_id)
+        self._running = {}
+        self._running_names = collections.defaultdict(int)
+        # worker_id -> time of last task start / finish
+        self._last_active = {}
+        self._retired = set()
+
+    def _eligible(self, task):
+        limit = self.limits.get(task['name'])
+        return not limit or self._running_names[task['name']] < limit
+
+    def _qsize(self, len=len):
+        return len([task for task in self.queue if self._eligible(task)])
+
+    def _put(self, task):
+        self._enqueued[task['task_id']] = time.time()
+        self.queue.append(task)
+
+    def _get(self):
+        for task in self.queue:
+            if self._eligible(task):
+                self.queue.remove(task)
+                put_time = self._enqueued.pop(task['task_id'], None)
+                if put_time:
+                    self.wait_time.add(time.time() - put_time)
+                return task
+
+    def _release(self, task_id):
+        name, worker_id = self._running.pop(task_id, (None, None))
+        if name:
+            self._running_names[name] -= 1
+            if worker_id in self._last_active:
+                self._last_active[worker_id] = time.time()
+        return name
+
+    @property
+    def depth(self):
+        """Number of pending tasks including ones waiting for a free slot"""
+        with self.mutex:
+            return len(self.queue)
+
+    def get_for(self, worker_id, timeout):
+        """
+        Like get(), but the task is accounted as running on worker_id
+        before the mutex is released
+
+        :returns: Task or None if worker was retired
+        :raises Queue.Empty: after timeout
+        """
+
+        with self.not_empty:
+            endtime = time.time() + timeout
+            while worker_id not in self._retired and not self._qsize():
+                remaining = endtime - time.time()
+                if remaining <= 0.0:
+                    raise Queue.Empty
+                self.not_empty.wait(remaining)
+            if worker_id in self._retired:
+                return None
+            task = self._get()
+            self.not_full.notify()
+            self._running[task['task_id']] = (task['name'], worker_id)
+            self._running_names[task['name']] += 1
+            self._last_active[worker_id] = time.time()
+            return task
+
+    def retire(self, worker_id):
+        """
+        Stop dispatching tasks to idle worker
+
+        :returns: False if worker is running a task
+        """
+
+        with self.not_empty:
+            if worker_id in set(w for name, w in self._running.values()):
+                return False
+            self._retired.add(worker_id)
+            self.not_empty.notify_all()
+            return True
+
+    def finished(self, task_id):
+        with self.not_empty:
+            if self._release(task_id):
+                # task name could free a slot for waiting tasks
+                self.not_empty.notify()
+
+    def worker_added(self, worker_id):
+        with self.mutex:
+            self._last_active[worker_id] = time.time()
+
+    def worker_removed(self, worker_id):
+        with self.not_empty:
+            self._last_active.pop(worker_id, None)
+            self._retired.discard(worker_id)
+            for task_id, (name, task_worker_id) in self._running.items():
+                if task_worker_id == worker_id:
+                    self._release(task_id)
+            self.not_empty.notify()
+
+    def busy_workers(self):
+        with self.mutex:
+            return set(worker_id for name, worker_id in self._running.values())
+
+    def last_active(self, worker_id):
+        with self.mutex:
+            return self._last_active.get(worker_id, 0)
+
+    def running(self):
+        with self.mutex:
+            return dict((name, count) for name, count in self._running_names.items() if count)
+
+
 class PushServer(IPCServer):
 
     def __init__(self, queue, *args, **kwds):
@@ -397,40 +526,116 @@ class PushServer(IPCServer):
         self.queue = queue
 
     def handle(self, conn):
-        worker_id = conn.recv()
+        try:
+            worker_id = conn.recv()
+        except (IOError, OSError, EOFError):
+            # Worker was stopped while waiting for connection
+            return
         while not self._terminate.is_set():
             try:
-                task = self.queue.get(timeout=1)
+                # Task is accounted before send, worker can return result before send() returns
+                task = self.queue.get_for(worker_id, timeout=1)
             except Queue.Empty:
                 continue
-            if task.acquire(worker_id):
+            if task is None:
+                LOG.debug('{} worker {} retired'.format(self.cls_name, worker_id))
+            elif not task.acquire(worker_id):
+                self.queue.finished(task['task_id'])
+            else:
                 LOG.debug('{} send {}'.format(self.cls_name, task))
-                conn.send(task)
+                try:
+                    conn.send(task)
+                except (IOError, OSError, EOFError):
+                    # Worker was stopped while waiting for a task
+                    LOG.debug('{} worker {} gone, requeue {}'.format(
+                        self.cls_name, worker_id, task['task_id']))
+                    self.queue.finished(task['task_id'])
+                    task.reset()
+                    task.save()
+                    self.queue.put(task)
             break
 
 
 class PullServer(IPCServer):
 
+    def __init__(self, queue, *args, **kwds):
+        super(PullServer, self).__init__(*args, **kwds)
+        self.queue = queue
+
     def handle(self, conn):
         task = conn.recv()
         if task['state'] in ('completed', 'failed'):
             task['end_date'] = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
         LOG.debug('{} received {}'.format(self.cls_name, task))
+        # Database is the durable record, save before waking up waiters
         task.save()
-        try:
-            Executor._ready_events[task['task_id']].set()
-            del Executor._ready_events[task['task_id']]
-        except KeyError:
-            pass
+        self.queue.finished(task['task_id'])
+        if task['state'] in ('completed', 'failed'):
+            _Waiter.notify(task)
+
+
+class _Waiter(object):
+
+    """
+    In-process completion notification for AsyncResult.
+    PullServer pushes finished task to the waiter registered for its task_id.
+    Waiter is shared by concurrent get() calls of the same task and removed
+    when the last of them unregisters
+    """
+
+    _waiters = {}
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.task = None
+        self.refs = 0
+
+    @classmethod
+    def register(cls, task_id):
+        with cls._lock:
+            if task_id not in cls._waiters:
+                cls._waiters[task_id] = cls()
+            waiter = cls._waiters[task_id]
+            waiter.refs += 1
+            return waiter
+
+    @classmethod
+    def unregister(cls, task_id, waiter):
+        with cls._lock:
+            waiter.refs -= 1
+            if not waiter.refs and cls._waiters.get(task_id) is waiter:
+                del cls._waiters[task_id]
+
+    @classmethod
+    def notify(cls, task):
+        with cls._lock:
+            waiter = cls._waiters.pop(task['task_id'], None)
+        if waiter:
+            waiter.task = task
+            waiter.event.set()
 
 
 class Executor(object):
 
     _workers = {}
-    _ready_events = {}
+    # number of started executors in this process
+    _started = 0
+
+    def __init__(self, max_workers=None, soft_timeout=None, hard_timeout=None, task_modules=None,
+                 min_workers=None, task_limits=None):
+        """
+        :param min_workers: Number of warm workers kept when there are no tasks
+        :type min_workers: int
+
+        :param max_workers: Pool grows up to this number of workers when tasks are waiting
+        :type max_workers: int
 
-    def __init__(self, max_workers=None, soft_timeout=None, hard_timeout=None, task_modules=None):
-        self._push_queue = Queue.Queue()
+        :param task_limits: Max number of simultaneously running tasks by task name
+        :type task_limits: dict
+        """
+
+        self._push_queue = _TaskQueue(task_limits)
         self._push_server_address = os.path.join(push_server_base_address,
                                                  'szr_%s' % uuid.uuid4().hex)
         self._pull_server_address = os.path.join(pull_server_base_address,
@@ -439,12 +644,16 @@ class Executor(object):
         self._push_server = None
         self._pull_server = None
         self._max_workers = max_workers or MAX_WORKERS
+        self._min_workers = min(min_workers or MIN_WORKERS, self._max_workers)
         self._soft_timeout = soft_timeout or SOFT_TIMEOUT
         self._hard_timeout = hard_timeout or HARD_TIMEOUT
         self._state = 'stopped'
         self._state_lock = threading.Lock()
         self._poll_thread = None
+        # set by apply_async to grow pool without waiting for the next poll
+        self._poll_wakeup = threading.Event()
 
+        # Import task modules before workers are forked, so they start warm
         task_modules = task_modules or ()
         for module in task_modules:
             __import__(module)
@@ -454,7 +663,7 @@ class Executor(object):
 
     @property
     def workers(self):
-        return self.__class__._workers.get(self, [])
+        return self.__class__._workers.setdefault(self, [])
 
     @workers.setter
     def workers(self, value):
@@ -474,14 +683,49 @@ class Executor(object):
 
         if wait:
             worker.wait_start()
+        self._push_queue.worker_added(worker.worker_id)
         self.workers.append(worker)
         return worker
 
     def _check_workers(self):
-        self.workers = [worker for worker in self.workers if worker.is_alive()]
-        for i in range((self._max_workers - len(self.workers)) or 0):
+        """
+        Replace dead workers, grow pool up to max workers while tasks are waiting
+        and shrink it down to min workers after WORKER_IDLE_TIMEOUT
+
+        :returns: True if some worker has died since the previous check
+        """
+
+        alive = []
+        for worker in self.workers:
+            if worker.is_alive():
+                alive.append(worker)
+            else:
+                self._push_queue.worker_removed(worker.worker_id)
+        died = len(alive) != len(self.workers)
+        self.workers = alive
+
+        busy = self._push_queue.busy_workers()
+        idle = [worker for worker in alive if worker.worker_id not in busy]
+        waiting = self._push_queue.qsize()
+        launch = max(self._min_workers - len(alive),
+                     min(waiting - len(idle), self._max_workers - len(alive)))
+        for i in range(launch):
             self._launch_worker()
 
+        if not waiting and len(alive) > self._min_workers:
+            now = time.time()
+            for worker in idle:
+                if now - self._push_queue.last_active(worker.worker_id) > WORKER_IDLE_TIMEOUT \
+                        and self._push_queue.retire(worker.worker_id):
+                    # Retired under queue mutex, PushServer won't dispatch to it anymore
+                    LOG.debug('Worker {} is idle, stopping it'.format(worker.worker_id))
+                    self.workers = [w for w in self.workers if w is not worker]
+                    worker.stop()
+                    self._push_queue.worker_removed(worker.worker_id)
+                    # one at a time
+                    break
+        return died
+
     def _validate_running_tasks(self):
         workers_ids = [worker.worker_id for worker in self.workers if worker.is_alive()]
         for task in Task.load_tasks(state='running'):
@@ -503,11 +747,14 @@ class Executor(object):
                     # threads
                     if self._state == 'stopped':
                         return
-                    self._check_workers()
+                    died = self._check_workers()
 
-                self._validate_running_tasks()
+                # Tasks can be orphaned only by dead worker, don't query database otherwise
+                if died:
+                    self._validate_running_tasks()
 
-                time.sleep(EXECUTOR_POLL_SLEEP)
+                self._poll_wakeup.wait(EXECUTOR_POLL_SLEEP)
+                self._poll_wakeup.clear()
             except:
                 LOG.exception('Executor poll error: {}'.format(sys.exc_info()[:2]))
                 time.sleep(ERROR_SLEEP)
@@ -522,7 +769,8 @@ class Executor(object):
 
         self._push_server = PushServer(self._push_queue, self._push_server_address,
                                        self._ipc_authkey)
-        self._pull_server = PullServer(self._pull_server_address, self._ipc_authkey)
+        self._pull_server = PullServer(self._push_queue, self._pull_server_address,
+                                       self._ipc_authkey)
         self._push_server.start()
         self._pull_server.start()
 
@@ -544,11 +792,17 @@ class Executor(object):
         while not self._push_server.is_alive() or not self._pull_server.is_alive():
             time.sleep(0.1)
 
+        # prefork warm workers
+        with self._state_lock:
+            for i in range(self._min_workers):
+                self._launch_worker(wait=True)
+
         self._poll_thread = threading.Thread(target=self._poll)
         self._poll_thread.daemon = True
         self._poll_thread.start()
 
         self._state = 'started'
+        self.__class__._started += 1
         LOG.debug('Executor started')
 
     def stop(self):
@@ -561,6 +815,7 @@ class Executor(object):
             # use lock to avoid simultaneously starting and stopping workers from different
             # threads
             self._state = 'stopped'
+            self.__class__._started -= 1
             for worker in self.workers:
                 worker.stop()
 
@@ -589,12 +844,50 @@ class Executor(object):
 
         if self._state == 'started':
             self._push_queue.put(task)
+            self._poll_wakeup.set()
 
-        ready_event = threading.Event()
-        self.__class__._ready_events[task['task_id']] = ready_event
         async_result = AsyncResult(task)
         return async_result
 
+    def stats(self):
+        """
+        :returns: Pool and queue statistics
+        :rtype: dict
+
+        Example::
+
+            {
+                'workers': 3,
+                'min_workers': 1,
+                'max_workers': 4,
+                'busy_workers': 2,
+                'utilisation': 0.67,
+                'queue_depth': 5,
+                'waiting_for_limit': 2,
+                'running': {'backup': 1, 'api.status': 1},
+                'task_limits': {'backup': 1},
+                'wait_time': {'count': 120, 'last': 0.001, 'avg': 0.4, 'p50': 0.002,
+                              'p99': 5.1, 'max': 6.0}
+            }
+        """
+
+        workers = [worker for worker in self.workers if worker.is_alive()]
+        busy = len(self._push_queue.busy_workers() &
+                   set(worker.worker_id for worker in workers))
+        depth = self._push_queue.depth
+        return {
+            'workers': len(workers),
+            'min_workers': self._min_workers,
+            'max_workers': self._max_workers,
+            'busy_workers': busy,
+            'utilisation': round(float(busy) / len(workers), 2) if workers else 0.0,
+            'queue_depth': depth,
+            'waiting_for_limit': depth - self._push_queue.qsize(),
+            'running': self._push_queue.running(),
+            'task_limits': self._push_queue.limits,
+            'wait_time': self._push_queue.wait_time.summary(),
+        }
+
     @classmethod
     def revoke(cls, task_id):
         """
@@ -608,6 +901,7 @@ class Executor(object):
                 LOG.debug('Killing task {}'.format(task_id))
                 task.set_exception(TaskKilledError())
                 task.save()
+                _Waiter.notify(task)
             finally:
                 for executor, workers in Executor._workers.iteritems():
                     for worker in workers:
@@ -615,12 +909,13 @@ class Executor(object):
                         try:
                             if str(task['worker_id']) == worker.worker_id:
                                 worker.terminate()
+                                executor._push_queue.finished(task_id)
                                 break
                         finally:
                             worker.unlock()
 
 
-prog = re.compile(r'.*\nState:\t*(.) *\((.*)\)\n.*')
+prog = re.compile(r'^State:\t*(.) *\((.*)\)$', re.M)
 
 
 def is_alive(pid):
@@ -631,7 +926,7 @@ def is_alive(pid):
         try:
             with open('/proc/%d/status' % pid, 'r') as f:
                 text = f.read()
-                match = prog.match(text)
+                match = prog.search(text)
                 assert match.groups()[0] != 'Z'
         except (IOError, AttributeError, AssertionError):
             return False
@@ -860,6 +1155,14 @@ class Worker(multiprocessing.Process):
 
 class AsyncResult(object):
 
+    """
+    Result of task applied by Executor.
+
+    In the process with started Executor get() is woken up by PullServer
+    as soon as worker returns the result. Otherwise it polls database
+    every result_poll_timeout seconds
+    """
+
     result_poll_timeout = 1
     ready_event_timeout = 10
 
@@ -877,7 +1180,6 @@ class AsyncResult(object):
             self._task.load()
         else:
             raise TypeError('Argument task must be instance of Task class or task_id')
-        self._ready_event = Executor._ready_events.get(self._task['task_id'], None)
 
     def __getattr__(self, name):
         assert name in self._task.schema, "'%s' not in Task schema" % name
@@ -886,29 +1188,15 @@ class AsyncResult(object):
         return self._task[name]
 
     def get(self, timeout=None):
-        self._task.load()
-        remaining_timeout = timeout
-
-        # lool until timeout will occurred or task state will be changed to completed or failed
-        while self._task['state'] in ['pending', 'running']:
-            if timeout and not remaining_timeout:
-                # Timeout has occurred
-                break
-            if self._ready_event:
-                if timeout:
-                    curr_timeout = min(self.ready_event_timeout, remaining_timeout)
-                else:
-                    curr_timeout = self.ready_event_timeout
-                self._ready_event.wait(timeout=curr_timeout)
-            else:
-                if timeout:
-                    curr_timeout = min(self.result_poll_timeout, remaining_timeout)
-                else:
-                    curr_timeout = self.result_poll_timeout
-                time.sleep(curr_timeout)
-            if timeout:
-                remaining_timeout -= curr_timeout
-            self._task.load()
+        # Register waiter before reading the state, PullServer saves task before notify,
+        # so the result can't be missed in between
+        task_id = self._task['task_id']
+        waiter = _Waiter.register(task_id) if Executor._started else None
+        try:
+            self._wait(waiter, timeout)
+        finally:
+            if waiter:
+                _Waiter.unregister(task_id, waiter)
 
         if self._task['state'] not in ['completed', 'failed']:
             raise TimeoutError("Task '%s' get timeout" % self._task['task_id'])
@@ -922,5 +1210,33 @@ class AsyncResult(object):
 
         return result
 
+    def _wait(self, waiter, timeout):
+        self._task.load()
+        if timeout:
+            deadline = time.time() + timeout
+
+        # lool until timeout will occurred or task state will be changed to completed or failed
+        while self._task['state'] in ['pending', 'running']:
+            if timeout:
+                remaining_timeout = deadline - time.time()
+                if remaining_timeout <= 0:
+                    # Timeout has occurred
+                    break
+            if waiter:
+                # Reload from database after ready_event_timeout in case
+                # the task is finished by another process
+                curr_timeout = self.ready_event_timeout
+            else:
+                curr_timeout = self.result_poll_timeout
+            if timeout:
+                curr_timeout = min(curr_timeout, remaining_timeout)
+            if waiter:
+                if waiter.event.wait(curr_timeout) and waiter.task:
+                    self._task.update(waiter.task)
+                    continue
+            else:
+                time.sleep(curr_timeout)
+            self._task.load()
+
     def revoke(self):
         Executor.revoke(self._task['task_id'])
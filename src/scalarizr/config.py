@@ -8,6 +8,7 @@ Created on Aug 11, 2010
 from scalarizr.bus import bus
 from scalarizr.libs.bases import Observable
 from scalarizr.util import validators
+from scalarizr.util import cryptotool
 
 from ConfigParser import ConfigParser, RawConfigParser, NoOptionError, NoSectionError
 from getpass import getpass
@@ -888,6 +889,8 @@ class ScalarizrCnf(Observable):
                 os.chmod(filename, 0600)
             file = open(filename, "w+")
             file.write(key)
+            # rotated key must not be served from cache even within mtime resolution
+            cryptotool.forget_key(filename)
         except (IOError, OSError), e:
             raise ConfigError("Cannot write %s in file '%s'. %s" % (title or "key", filename, str(e)))
         finally:
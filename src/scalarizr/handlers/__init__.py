@@ -646,7 +646,16 @@ class FarmSecurityMixin(object):
         self._logger = logging.getLogger(__name__)
         self._ports = ports
         self._iptables = iptables
+        self._ipset = None
         if self._iptables.enabled():
+            if self._iptables.ipset_enabled():
+                # One rule per port, farm hosts are ipset members
+                ipset = self._iptables.IPSet('scalr-farm')
+                try:
+                    ipset.create()
+                    self._ipset = ipset
+                except linux.LinuxError, e:
+                    self._logger.debug('ipset unavailable, using per host rules: %s', e)
             bus.on(
                 reload=self.__on_reload
             )
@@ -664,28 +673,30 @@ class FarmSecurityMixin(object):
         if not self.__enabled:
             return
         # Append new server to allowed list
+        if self._ipset:
+            self._ipset.add(self.__host_addresses(message.local_ip, message.remote_ip))
+            return
         rules = []
         for port in self._ports:
             rules += self.__accept_host(message.local_ip, message.remote_ip, port)
-        self._iptables.FIREWALL.ensure(rules)
+        with self._iptables.Batch() as batch:
+            batch.ensure(self._iptables.FIREWALL.name, rules)
 
 
     def on_HostDown(self, message):
         if not self.__enabled:
             return
         # Remove terminated server from allowed list
+        if self._ipset:
+            self._ipset.remove(self.__host_addresses(message.local_ip, message.remote_ip))
+            return
         rules = []
         for port in self._ports:
             rules += self.__accept_host(message.local_ip, message.remote_ip, port)
-        for rule in rules:
-            try:
-                self._iptables.FIREWALL.remove(rule)
-            except: #?
-                if 'does a matching rule exist in that chain' in str(sys.exc_info()[1]):
-                    # When HostDown comes from a server that didn't send HostInit
-                    pass
-                else:
-                    raise
+        # Only existing rules are deleted: HostDown may come from a server
+        # that didn't send HostInit
+        with self._iptables.Batch() as batch:
+            batch.remove(self._iptables.FIREWALL.name, rules)
 
 
     def __create_rule(self, source, dport, jump):
@@ -706,16 +717,21 @@ class FarmSecurityMixin(object):
         return self.__create_rule(None, dport, 'DROP')
 
 
-    def __accept_host(self, local_ip, public_ip, dport):
+    def __host_addresses(self, local_ip, public_ip):
         ret = []
         if local_ip == self._platform.get_private_ip():
-            ret.append(self.__create_accept_rule('127.0.0.1', dport))
+            ret.append('127.0.0.1')
         if local_ip:
-            ret.append(self.__create_accept_rule(local_ip, dport))
-        ret.append(self.__create_accept_rule(public_ip, dport))
+            ret.append(local_ip)
+        ret.append(public_ip)
         return ret
 
 
+    def __accept_host(self, local_ip, public_ip, dport):
+        return [self.__create_accept_rule(address, dport)
+                for address in self.__host_addresses(local_ip, public_ip)]
+
+
     def __insert_iptables_rules(self, *args, **kwds):
         # Collect farm servers IP-s
         hosts = []
@@ -723,6 +739,28 @@ class FarmSecurityMixin(object):
             for host in role.hosts:
                 hosts.append((host.internal_ip, host.external_ip))
 
+        if self._ipset:
+            addresses = self.__host_addresses(self._platform.get_private_ip(),
+                                    self._platform.get_public_ip())
+            for local_ip, public_ip in hosts:
+                addresses += self.__host_addresses(local_ip, public_ip)
+            self._ipset.add(addresses)
+            rules = [self._ipset.rule('tcp', port)
+                     for port in self._ports]
+        else:
+            rules = self.__accept_rules(hosts)
+
+        # Deny from all
+        drop_rules = []
+        for port in self._ports:
+            drop_rules.append(self.__create_drop_rule(port))
+
+        with self._iptables.Batch() as batch:
+            batch.ensure(self._iptables.FIREWALL.name, rules)
+            batch.ensure(self._iptables.FIREWALL.name, drop_rules, append=True)
+
+
+    def __accept_rules(self, hosts):
         rules = []
         for port in self._ports:
             # TODO: this will be duplicated, because current host is in the
@@ -733,14 +771,7 @@ class FarmSecurityMixin(object):
                                     self._platform.get_public_ip(), port)
             for local_ip, public_ip in hosts:
                 rules += self.__accept_host(local_ip, public_ip, port)
-
-        # Deny from all
-        drop_rules = []
-        for port in self._ports:
-            drop_rules.append(self.__create_drop_rule(port))
-
-        self._iptables.FIREWALL.ensure(rules)
-        self._iptables.FIREWALL.ensure(drop_rules, append=True)
+        return rules
 
 
 def build_tags(purpose=None, state=None, set_owner=True, **kwargs):
@@ -258,11 +258,10 @@ class PostgreSqlHander(ServiceCtlHandler):
 
 
     def accept_all_clients(self):
-        farm_hosts = self.farm_hosts
-        for ip in farm_hosts:
-                self.postgresql.register_client(ip, force=False)
-        if farm_hosts:
-            self.postgresql.service.reload('Granting access to all servers within farm.', force=True)
+        # Single pg_hba.conf write and reload for all farm servers
+        with self.postgresql.access_batch():
+            for ip in self.farm_hosts:
+                self.postgresql.register_client(ip)
 
 
     @property
@@ -31,6 +31,10 @@ LOG = logging.getLogger(__name__)
 IPTABLES_BIN = '/sbin/iptables'
 IPTABLES_SAVE = '/sbin/iptables-save'
 IPTABLES_RESTORE = '/sbin/iptables-restore'
+IPSET_BIN = '/usr/sbin/ipset'
+
+# _Chain.ensure() applies more missing rules than this with single iptables-restore
+BATCH_THRESHOLD = 1
 
 # from iptables --help, must cover all short options
 _OPTIONS = {
@@ -63,25 +67,47 @@ _OPTIONS = {
 }
 
 
-def iptables(**long_kwds):
-
+def _ordered(long_kwds):
     ordered_long = OrderedDict()
     for key in ("protocol", "match"):
         if key in long_kwds:
             ordered_long[key] = long_kwds.pop(key)
     ordered_long.update(long_kwds)
-    args0 = linux.build_cmd_args(
-            executable=IPTABLES_BIN,
-            long=ordered_long)
+    return ordered_long
+
+
+def _negate(args0):
     args = []
     for arg in args0:
         if arg.startswith('--not-'):
             args.extend(('!', arg.replace('not-', '')))
         else:
             args.append(arg)
+    return args
+
+
+def iptables(**long_kwds):
+    args = _negate(linux.build_cmd_args(
+            executable=IPTABLES_BIN,
+            long=_ordered(long_kwds)))
     return linux.system(args)
 
 
+def _restore_line(command, rule):
+    """
+    Rule as iptables-restore line, e.g. '-I INPUT 1 -p tcp -m tcp --dport 80 -j ACCEPT'
+    """
+    rule = copy(rule)
+    rule.pop('table', None)
+    args = _negate(linux.build_cmd_args(long=_ordered(rule)))
+    quoted = []
+    for arg in args:
+        if not arg or re.search(r'\s|"', arg):
+            arg = '"%s"' % arg.replace('"', '\\"')
+        quoted.append(arg)
+    return ' '.join([command] + quoted)
+
+
 def iptables_save(filename=None, *short_args, **long_kwds):
     # file name is a path string or file-like object
     # if filename is None return output
@@ -338,19 +364,28 @@ class _Chain(object):
         if not 'filter' in tables:
             tables.append('filter')
 
-        existing = []
+        existing = set()
         for table in tables:
-            existing.extend(self.list(table))
+            existing.update(map(_rule_key, self.list(table)))
 
+        missing = []
         for rule in reversed(rules):
-            rule_repr = _to_inner(rule)
-            if rule_repr not in existing:
-                if not append:
-                    self.insert(None, rule)
-                    existing.insert(0, rule_repr)
-                else:
-                    self.append(rule)
-                    existing.append(rule_repr)
+            key = _rule_key(rule)
+            if key not in existing:
+                existing.add(key)
+                missing.append(rule)
+
+        if len(missing) > BATCH_THRESHOLD:
+            # Already diffed, skip iptables-save
+            batch = Batch(existing={})
+            batch.ensure(self.name, missing[::-1], append)
+            batch.commit()
+            return
+        for rule in missing:
+            if not append:
+                self.insert(None, rule)
+            else:
+                self.append(rule)
 
 
 #? Group this two functions in a Rule class?
@@ -389,6 +424,30 @@ def _to_inner(rule):
     return inner
 
 
+def _rule_key(rule):
+    """
+    Hashable canonical form of rule for set lookups.
+    Numbers are compared as iptables-save strings, implicit protocol match (-p tcp --dport 80 == -p tcp -m tcp --dport 80)
+    and order of matches are ignored
+    """
+    inner = _to_inner(rule)
+    if inner.get('table') == 'filter':
+        del inner['table']
+    match = inner.get('match', [])
+    match = set(match if hasattr(match, '__iter__') else [match])
+    if inner.get('protocol') in ('tcp', 'udp') and ('dport' in inner or 'sport' in inner):
+        match.add(inner['protocol'])
+    if match:
+        inner['match'] = frozenset(match)
+    def canonical(val):
+        if isinstance(val, type([])):
+            return tuple(map(canonical, val))
+        if isinstance(val, (int, long)) and not isinstance(val, bool):
+            return str(val)
+        return val
+    return frozenset((key, canonical(val)) for key, val in inner.items())
+
+
 def _is_plain_ip(s):
     return [n.isdigit() and 0 <= int(n) <= 255 for n in s.split('.')] == \
                [True] * 4
@@ -450,6 +509,135 @@ def ensure(chain_rules, append=False):
         chains[chain].ensure(rules, append)
 
 
+class Batch(object):
+    """
+    Rule changes applied with single `iptables-restore --noflush` call,
+    atomically per table. Current rules are read once with iptables-save
+    and diffed with set lookups, so ensure() skips existing rules
+    and remove() skips missing ones.
+
+        with iptables.Batch() as batch:
+            batch.ensure('INPUT', accept_rules)
+            batch.ensure('INPUT', drop_rules, append=True)
+            batch.remove('INPUT', old_rules)
+    """
+
+    def __init__(self, existing=None):
+        """
+        :param existing: {(table, chain): set of _rule_key()}, read from iptables-save by default
+        """
+        self._existing = existing
+        self._lines = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if not exc_info[0]:
+            self.commit()
+
+    def _load(self):
+        existing = {}
+        table = None
+        chain_lines = OrderedDict()
+        for line in iptables_save().splitlines():
+            if line.startswith('*'):
+                table = line[1:].strip()
+            elif line.startswith('-A '):
+                chain = line.split(None, 2)[1]
+                chain_lines.setdefault((table, chain), []).append(line)
+        for (table, chain), lines in chain_lines.items():
+            rules = chains[chain]._parse_list_rules('\n'.join(lines))
+            if table != 'filter':
+                for rule in rules:
+                    rule['table'] = table
+            existing[(table, chain)] = set(map(_rule_key, rules))
+        return existing
+
+    def _rules(self, table, chain):
+        if self._existing is None:
+            self._existing = self._load()
+        return self._existing.setdefault((table, chain), set())
+
+    def _add(self, rule, command):
+        self._lines.setdefault(rule.get('table') or 'filter', []).append(_restore_line(command, rule))
+
+    def ensure(self, chain, rules, append=False):
+        """
+        Insert missing rules on top of the chain (in the given order) or append them
+        """
+        for rule in (rules if append else reversed(rules)):
+            existing = self._rules(rule.get('table') or 'filter', chain)
+            key = _rule_key(rule)
+            if key not in existing:
+                existing.add(key)
+                self._add(rule, '-A %s' % chain if append else '-I %s 1' % chain)
+
+    def remove(self, chain, rules):
+        for rule in rules:
+            existing = self._rules(rule.get('table') or 'filter', chain)
+            key = _rule_key(rule)
+            if key in existing:
+                existing.discard(key)
+                self._add(rule, '-D %s' % chain)
+
+    @property
+    def script(self):
+        script = []
+        for table, lines in self._lines.items():
+            script.append('*%s' % table)
+            script.extend(lines)
+            script.append('COMMIT')
+        return '\n'.join(script) + '\n'
+
+    def commit(self):
+        if not self._lines:
+            return
+        LOG.debug('Applying %d iptables changes', sum(map(len, self._lines.values())))
+        linux.system(linux.build_cmd_args(executable=IPTABLES_RESTORE,
+                long={'noflush': True}), stdin=self.script)
+        self._lines = OrderedDict()
+
+
+class IPSet(object):
+    """
+    ipset of addresses for rules like
+    `-p tcp --dport 6379 -m set --match-set <name> src -j ACCEPT`,
+    so granting access to a host is O(1) set membership change instead of rules per host
+    """
+
+    def __init__(self, name, type='hash:ip'):
+        self.name = name
+        self.type = type
+
+    def _restore(self, lines):
+        if lines:
+            linux.system((IPSET_BIN, 'restore', '-exist'), stdin='\n'.join(lines) + '\n')
+
+    def create(self):
+        self._restore(['create %s %s' % (self.name, self.type)])
+
+    def add(self, addresses):
+        self._restore(['add %s %s' % (self.name, address) for address in addresses])
+
+    def remove(self, addresses):
+        self._restore(['del %s %s' % (self.name, address) for address in addresses])
+
+    def rule(self, protocol, dport, jump='ACCEPT'):
+        return OrderedDict((
+            ('protocol', protocol),
+            ('dport', str(dport)),
+            ('match', 'set'),
+            ('match-set', [self.name, 'src']),
+            ('jump', jump)))
+
+
+def ipset_enabled():
+    if not int(__node__['base'].get('firewall_ipset', 0)):
+        return False
+    return os.access(IPSET_BIN, os.X_OK)
+
+
 def enabled():
     if int(__node__['base'].get('disable_firewall_management', 0)):
         LOG.debug('base.disable_firewall_management: 1, skipping')
@@ -11,10 +11,17 @@ import time
 import threading
 import copy
 import sys
+import atexit
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 from scalarizr.bus import bus
 from scalarizr.messaging import MessageService, Message, Queues, MetaOptions, MessagingError
 from scalarizr.messaging.p2p.security import P2pMessageSecurity
+from scalarizr.util import metrics
+from scalarizr.util import sqlite_server
 
 
 """
@@ -32,6 +39,8 @@ class P2pConfigOptions:
     PRODUCER_SENDER                                 = "producer_sender"
     CONSUMER_URL                                    = "consumer_url"
     MSG_HANDLER_ENABLED                             = 'msg_handler_enabled'
+    PRODUCER_BATCH_WINDOW                   = 'producer_batch_window'
+    PRODUCER_BATCH_SIZE                     = 'producer_batch_size'
 
 
 class P2pMessageService(MessageService):
@@ -68,6 +77,8 @@ class P2pMessageService(MessageService):
             self._default_producer = self.new_producer(
                     endpoint=self._params[P2pConfigOptions.PRODUCER_URL],
                     retries_progression=self._params[P2pConfigOptions.PRODUCER_RETRIES_PROGRESSION],
+                    batch_window=self._params.get(P2pConfigOptions.PRODUCER_BATCH_WINDOW),
+                    batch_size=self._params.get(P2pConfigOptions.PRODUCER_BATCH_SIZE)
                     )
         return self._default_producer
 
@@ -85,18 +96,80 @@ class P2pMessageService(MessageService):
 def new_service(**kwargs):
     return P2pMessageService(**kwargs)
 
+
+P2P_MESSAGE_INDEXES = (
+    # load(), mark_as_handled(), _mark_as_delivered(), response lookups
+    'CREATE INDEX IF NOT EXISTS p2p_message_message_id '
+        'ON p2p_message (message_id, is_ingoing)',
+    # _get_unhandled_from_db()
+    'CREATE INDEX IF NOT EXISTS p2p_message_unhandled '
+        'ON p2p_message (is_ingoing, in_is_handled, id, queue, message_id)',
+    # get_undelivered()
+    'CREATE INDEX IF NOT EXISTS p2p_message_undelivered '
+        'ON p2p_message (is_ingoing, out_is_delivered, out_sender, id, queue, message_id)'
+)
+
 class _P2pMessageStore:
     _logger = None
 
     TAIL_LENGTH = 50
+    '''
+    Maximum number of messages kept in p2p_message table
+    '''
+
+    TAIL_SIZE = 10 * 1024 * 1024
+    '''
+    Maximum total size of messages kept in p2p_message table, in bytes
+    '''
+
+    ROTATE_EVERY = 50
+    '''
+    Rotate table in background after this number of inserts
+    '''
+
+    ROTATE_INTERVAL = 3600
+    '''
+    Seconds between rotations by periodical executor
+    '''
+
+    MAX_UNDELIVERED = 10000
+    '''
+    Maximum number of undelivered outgoing messages kept while Scalr is unreachable,
+    older ones are deleted by rotate()
+    '''
+
+    ROTATE_BATCH = 1000
+    '''
+    Maximum number of rows deleted by a single DELETE statement
+    '''
+
+    WRITE_BEHIND = 0.05
+    '''
+    Seconds to accumulate message state transitions before they are
+    written in a single transaction. 0 disables write-behind
+    '''
 
     def __init__(self):
         self._logger = logging.getLogger(__name__)
         self._local_storage_lock = threading.Lock()
+        self._unhandled_cond = threading.Condition(self._local_storage_lock)
+        self._put_seq = 0
+        self._received_at = {}
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._flush_timer = None
+        self._inserts_since_rotate = 0
+        self._rotate_thread = None
+        # Time spent in put_ingoing/put_outgoing
+        self.put_latency = metrics.Timings()
+        # Time from state transition request to it's commit
+        self.transition_latency = metrics.Timings()
+        atexit.register(self.flush)
         ex = bus.periodical_executor
         if ex:
             self._logger.debug('Add rotate messages table task for periodical executor')
-            ex.add_task(self.rotate, 3600, 'Rotate messages sqlite table') # execute rotate task each hour
+            ex.add_task(self.rotate, self.ROTATE_INTERVAL, 'Rotate messages sqlite table')
 
     def _conn(self):
         return bus.db
@@ -110,18 +183,88 @@ class _P2pMessageStore:
 
 
     def rotate(self):
+        """
+        Delete messages beyond TAIL_LENGTH rows or TAIL_SIZE bytes.
+        Unhandled ingoing and undelivered outgoing messages are kept, except
+        undelivered ones beyond MAX_UNDELIVERED newest, which are dropped with a warning.
+        Old rows are deleted in ROTATE_BATCH chunks, so concurrent writers
+        are never blocked for long
+        """
+        self.flush()
         conn = self._conn()
         cur = conn.cursor()
-        cur.execute('SELECT * FROM p2p_message ORDER BY id DESC LIMIT %d, 1' % self.TAIL_LENGTH)
-        row = cur.fetchone()
-        if row:
-            self._logger.debug('Deleting messages older then messageid: %s', row['message_id'])
-            cur.execute('DELETE FROM p2p_message WHERE id <= ?', (row['id'],))
-        conn.commit()
+        try:
+            bound = None
+            cur.execute('SELECT id FROM p2p_message ORDER BY id DESC LIMIT 1 OFFSET ?', [self.TAIL_LENGTH])
+            row = cur.fetchone()
+            if row:
+                bound = row[0]
+
+            cur.execute('SELECT id, length(message) FROM p2p_message ORDER BY id DESC LIMIT ?', [self.TAIL_LENGTH])
+            size = 0
+            for i, row in enumerate(cur.fetchall() or []):
+                size += row[1] or 0
+                # Always keep the latest message
+                if i and size > self.TAIL_SIZE:
+                    bound = max(bound or 0, row[0])
+                    break
+
+            if bound:
+                self._logger.debug('Deleting messages older then id: %s', bound)
+                self._delete_batched(conn, cur, 'id <= ? '
+                                     'AND NOT (is_ingoing = 1 AND in_is_handled = 0) '
+                                     'AND NOT (is_ingoing = 0 AND out_is_delivered = 0)', bound)
+
+            cur.execute('SELECT id FROM p2p_message WHERE is_ingoing = 0 AND out_is_delivered = 0 '
+                        'ORDER BY id DESC LIMIT 1 OFFSET ?', [self.MAX_UNDELIVERED])
+            row = cur.fetchone()
+            if row:
+                deleted = self._delete_batched(conn, cur, 'id <= ? '
+                                               'AND is_ingoing = 0 AND out_is_delivered = 0', row[0])
+                self._logger.warn('Deleted %d oldest undelivered messages, '
+                                  'more then %d are waiting for delivery', deleted, self.MAX_UNDELIVERED)
+        finally:
+            cur.close()
+
+    def _delete_batched(self, conn, cur, where, bound):
+        deleted = 0
+        while True:
+            cur.execute('DELETE FROM p2p_message WHERE id IN '
+                        '(SELECT id FROM p2p_message WHERE %s ORDER BY id LIMIT ?)' % where,
+                        [bound, self.ROTATE_BATCH])
+            conn.commit()
+            deleted += cur.rowcount
+            if cur.rowcount < self.ROTATE_BATCH:
+                return deleted
+
+    def _inserted(self):
+        """
+        Start rotation in background every ROTATE_EVERY inserts,
+        so writers never wait for it
+        """
+        with self._pending_lock:
+            self._inserts_since_rotate += 1
+            if self._inserts_since_rotate < self.ROTATE_EVERY:
+                return
+            if self._rotate_thread and self._rotate_thread.isAlive():
+                return
+            self._inserts_since_rotate = 0
+            self._rotate_thread = threading.Thread(target=self._rotate_background,
+                                                   name='Rotate messages table')
+            self._rotate_thread.setDaemon(True)
+            self._rotate_thread.start()
+
+    def _rotate_background(self):
+        try:
+            self.rotate()
+        except:
+            self._logger.warn('Failed to rotate messages table', exc_info=sys.exc_info())
 
     def put_ingoing(self, message, queue, consumer_id):
+        start = time.time()
         with self._local_storage_lock:
-            self._unhandled_messages.append((queue, message))
+            frozen = _FrozenMessage(message)
+            self._unhandled_messages.append((queue, frozen))
 
             conn = self._conn()
             cur = conn.cursor()
@@ -131,7 +274,7 @@ class _P2pMessageStore:
                         'VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?)'
 
                 #self._logger.debug('Representation mes: %s', repr(str(message)))
-                cur.execute(sql, [message.tojson().decode('utf-8'), message.id, message.name, queue, 1, 0, consumer_id, 'json'])
+                cur.execute(sql, [frozen.json.decode('utf-8'), message.id, message.name, queue, 1, 0, consumer_id, 'json'])
                 '''
                 cur.execute(sql, [str(message), message.id.decode('utf-8'),
                                 message.name.decode('utf-8'), queue.encode('utf-8'), 1, 0,
@@ -147,17 +290,52 @@ class _P2pMessageStore:
                 self._logger.debug("Commited put_ingoing")
             finally:
                 cur.close()
+                self._received_at[message.id] = time.time()
+                self._put_seq += 1
+                self._unhandled_cond.notifyAll()
+        self.put_latency.add(time.time() - start)
+        self._inserted()
+
+    @property
+    def unhandled_seq(self):
+        '''
+        Number of messages put into store since start.
+        Take it before get_unhandled() and pass to wait_unhandled()
+        '''
+        with self._local_storage_lock:
+            return self._put_seq
+
+    def wait_unhandled(self, seq, timeout=None):
+        '''
+        Block until a message newer then `seq` is put into store,
+        wakeup() is called or timeout expires
+        @return: current unhandled_seq
+        '''
+        with self._unhandled_cond:
+            if self._put_seq == seq:
+                self._unhandled_cond.wait(timeout)
+            return self._put_seq
+
+    def wakeup(self):
+        with self._unhandled_cond:
+            self._unhandled_cond.notifyAll()
+
+    def received_at(self, message_id):
+        '''
+        Time when ingoing message was put into store, None for messages restored from db
+        '''
+        return self._received_at.get(message_id)
 
 
     def get_unhandled(self, consumer_id):
+        '''
+        Return private copies of unhandled messages.
+        Copies share serialized form with the store and decode it on first access
+        @return: [(queue, message), ...]
+        '''
         with self._local_storage_lock:
-            ret = []
-            for queue, message in self._unhandled_messages:
-                msg_copy = P2pMessage()
-                msg_copy.fromjson(message.tojson())
-                ret.append((queue, msg_copy))
-
-            return ret
+            return list((queue, _P2pMessageSnapshot(frozen))
+                        for queue, frozen in self._unhandled_messages)
 
 
     def _get_unhandled_from_db(self):
@@ -174,7 +352,7 @@ class _P2pMessageStore:
 
             ret = []
             for r in cur.fetchall():
-                ret.append((r["queue"], self.load(r["message_id"], True)))
+                ret.append((r["queue"], _FrozenMessage(self.load(r["message_id"], True))))
             return ret
         finally:
             cur.close()
@@ -182,37 +360,92 @@ class _P2pMessageStore:
 
     def mark_as_handled(self, message_id):
         with self._local_storage_lock:
+            frozen = None
+            for _, msg in self._unhandled_messages:
+                if msg.id == message_id:
+                    frozen = msg
+                    break
             filter_fn = lambda x: x[1].id != message_id
             self._unhandled = filter(filter_fn, self._unhandled_messages)
-
-        for _ in xrange(0, 5):
-            try:
-                msg = self.load(message_id, True)
-                break
-            except:
-                self._logger.debug('Failed to load message %s', message_id, exc_info=sys.exc_info())
-                time.sleep(1)
+            self._received_at.pop(message_id, None)
+
+        if frozen:
+            msg_s = frozen.json
+            if '"platform_access_data"' in msg_s:
+                json_obj = json.loads(msg_s)
+                json_obj['body'].pop('platform_access_data', None)
+                msg_s = json.dumps(json_obj, ensure_ascii=True)
+            sql = 'UPDATE p2p_message SET in_is_handled = ?, message = ?, out_last_attempt_time = datetime("now")' \
+                'WHERE message_id = ? AND is_ingoing = ?'
+            self._write_behind(sql, [1, msg_s.decode('utf-8'), message_id, 1])
         else:
-            self._logger.debug("Cant load message in several attempts, assume it doesn't exists. Leaving")
-            return
+            self._logger.debug("Message %s is not in unhandled list, only updating it's state", message_id)
+            sql = 'UPDATE p2p_message SET in_is_handled = ?, out_last_attempt_time = datetime("now")' \
+                'WHERE message_id = ? AND is_ingoing = ?'
+            self._write_behind(sql, [1, message_id, 1])
 
 
-        if 'platform_access_data' in msg.body:
-            del msg.body['platform_access_data']
-        msg_s = msg.tojson().decode('utf-8')
+    def _write_behind(self, sql, params):
+        """
+        Queue state transition UPDATE. Bursts of transitions that come within
+        WRITE_BEHIND seconds are committed in one transaction
+        """
+        with self._pending_lock:
+            self._pending.append((sql, params, time.time()))
+            if not self.WRITE_BEHIND:
+                schedule = False
+            elif self._flush_timer:
+                return
+            else:
+                schedule = True
+                self._flush_timer = threading.Timer(self.WRITE_BEHIND, self.flush)
+                self._flush_timer.setDaemon(True)
+                self._flush_timer.start()
+        if not schedule:
+            self.flush()
 
-        conn = self._conn()
-        cur = conn.cursor()
-        try:
-            sql = 'UPDATE p2p_message SET in_is_handled = ?, message = ?, out_last_attempt_time = datetime("now")' \
-                'WHERE message_id = ? AND is_ingoing = ?'
-            cur.execute(sql, [1, msg_s, message_id, 1])
-            conn.commit()
-        finally:
-            cur.close()
+
+    def flush(self):
+        """
+        Write all queued state transitions in a single transaction
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+                if self._flush_timer:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+            if not pending:
+                return
+
+            statements = [(sql, params) for sql, params, _ in pending]
+            cur = self._conn().cursor()
+            try:
+                if hasattr(cur, 'execute_batch'):
+                    # SqliteServer proxy or WAL per-thread connection
+                    cur.execute_batch(statements)
+                else:
+                    sqlite_server.execute_batch(cur, statements)
+            except:
+                self._logger.warn('Failed to write %d message state transitions, will retry',
+                        len(pending), exc_info=sys.exc_info())
+                with self._pending_lock:
+                    self._pending[0:0] = pending
+                    if not self._flush_timer:
+                        self._flush_timer = threading.Timer(1, self.flush)
+                        self._flush_timer.setDaemon(True)
+                        self._flush_timer.start()
+                return
+            finally:
+                cur.close()
+
+            now = time.time()
+            for _, _, queued_at in pending:
+                self.transition_latency.add(now - queued_at)
 
 
     def put_outgoing(self, message, queue, sender):
+        start = time.time()
         conn = self._conn()
         cur = conn.cursor()
         try:
@@ -226,12 +459,15 @@ class _P2pMessageStore:
             conn.commit()
         finally:
             cur.close()
+        self.put_latency.add(time.time() - start)
+        self._inserted()
 
 
     def get_undelivered(self, sender):
         """
         Return list of undelivered messages in outgoing order
         """
+        self.flush()
         cur = self._conn().cursor()
         try:
             sql = 'SELECT queue, message_id FROM p2p_message ' \
@@ -252,18 +488,13 @@ class _P2pMessageStore:
         return self._mark_as_delivered(message_id, 0)
 
     def _mark_as_delivered (self, message_id, delivered):
-        conn = self._conn()
-        cur = conn.cursor()
-        try:
-            sql = 'UPDATE p2p_message SET out_delivery_attempts = out_delivery_attempts + 1, ' \
-                        'out_last_attempt_time = datetime("now"), out_is_delivered = ? ' \
-                    'WHERE message_id = ? AND is_ingoing = ?'
-            cur.execute(sql, [int(bool(delivered)), message_id, 0])
-            conn.commit()
-        finally:
-            cur.close()
+        sql = 'UPDATE p2p_message SET out_delivery_attempts = out_delivery_attempts + 1, ' \
+                    'out_last_attempt_time = datetime("now"), out_is_delivered = ? ' \
+                'WHERE message_id = ? AND is_ingoing = ?'
+        self._write_behind(sql, [int(bool(delivered)), message_id, 0])
 
     def load(self, message_id, is_ingoing):
+        self.flush()
         cur = self._conn().cursor()
         try:
             cur.execute('SELECT * FROM p2p_message ' \
@@ -287,6 +518,7 @@ class _P2pMessageStore:
 
 
     def is_delivered(self, message_id):
+        self.flush()
         cur = self._conn().cursor()
         try:
             cur.execute('SELECT is_delivered FROM p2p_message ' \
@@ -356,3 +588,53 @@ class P2pMessage(Message):
 
     def get_response(self):
         return self._store.get_response(self.id)
+
+
+class _FrozenMessage(object):
+    """
+    Immutable serialized form of a message
+    """
+    __slots__ = ('id', 'name', 'json')
+
+    def __init__(self, message):
+        self.id = message.id
+        self.name = message.name
+        self.json = message.tojson()
+
+
+class _P2pMessageSnapshot(P2pMessage):
+    """
+    Copy-on-read message backed by _FrozenMessage.
+    Creating a snapshot is O(1): meta and body are decoded only when touched,
+    and modifications never reach the frozen original
+    """
+
+    def __init__(self, frozen):
+        self.__dict__['_frozen'] = frozen
+        self.__dict__['_store'] = P2pMessageStore()
+        object.__setattr__(self, 'id', frozen.id)
+        object.__setattr__(self, 'name', frozen.name)
+
+    def _thaw(self):
+        if not '_body' in self.__dict__:
+            json_obj = json.loads(self._frozen.json)
+            self.__dict__.setdefault('_meta', json_obj['meta'])
+            self.__dict__['_body'] = json_obj['body']
+
+    def _get_meta(self):
+        self._thaw()
+        return self.__dict__['_meta']
+
+    def _set_meta(self, value):
+        self.__dict__['_meta'] = value
+
+    def _get_body(self):
+        self._thaw()
+        return self.__dict__['_body']
+
+    def _set_body(self, value):
+        self._thaw()
+        self.__dict__['_body'] = value
+
+    meta = property(_get_meta, _set_meta)
+    body = property(_get_body, _set_body)
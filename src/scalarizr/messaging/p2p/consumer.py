@@ -13,6 +13,7 @@ from scalarizr.messaging import MessageConsumer, MessagingError
 from scalarizr.messaging.p2p import P2pMessageStore, P2pMessage
 from scalarizr.config import STATE
 from scalarizr.util import wait_until, parse_bool, system2
+from scalarizr.util import metrics
 
 # Stdlibs
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
@@ -38,6 +39,15 @@ class P2pMessageConsumer(MessageConsumer):
     handler_locked = False
     handler_status = 'stopped'
     handing_message_id = None
+    wait_timeout = 1.0
+    '''
+    Maximum time message handler sleeps without a wakeup from message store
+    '''
+    dispatch_latency = None
+    '''
+    @ivar dispatch_latency: Time between message arrival and listeners notification
+    @type dispatch_latency: scalarizr.util.metrics.Timings
+    '''
 
     def __init__(self, endpoint=None, msg_handler_enabled=True):
         MessageConsumer.__init__(self)
@@ -53,6 +63,7 @@ class P2pMessageConsumer(MessageConsumer):
         self.subhandler_exc_info = None
         self.ack_event = threading.Event()
         self.special_case = None
+        self.dispatch_latency = metrics.Timings()
         #self._not_empty = threading.Event()
 
     def start(self):
@@ -164,7 +175,6 @@ class P2pMessageConsumer(MessageConsumer):
                 try:
                     store = P2pMessageStore()
                     store.put_ingoing(message, queue, self.consumer.endpoint)
-                    #self.consumer._not_empty.set()
                 except (BaseException, Exception), e:
                     logger.exception(e)
                     self.send_response(500, str(e))
@@ -199,15 +209,17 @@ class P2pMessageConsumer(MessageConsumer):
 
         self._logger.debug("Shutdown message handler")
         self.handler_locked = True
+        P2pMessageStore().wakeup()
         if not force:
             t = 120
             self._logger.debug('Waiting for message handler to complete it`s task. Timeout: %d seconds', t)
             wait_until(lambda: self.handler_status in ('idle', 'stopped'),
                             timeout=t, error_text='Message consumer is busy', logger=self._logger)
 
+        store = P2pMessageStore()
         if self.handing_message_id:
-            store = P2pMessageStore()
             store.mark_as_handled(self.handing_message_id)
+        store.flush()
 
         if self._handler_thread:
             self._handler_thread.join()
@@ -220,6 +232,9 @@ class P2pMessageConsumer(MessageConsumer):
             self.handler_status = 'running'
             self._logger.debug('Notify message listeners (message_id: %s)', message.id)
             self.handing_message_id = message.id
+            received_at = store.received_at(message.id)
+            if received_at:
+                self.dispatch_latency.add(time.time() - received_at)
             for ln in list(self.listeners):
                 ln(message, queue)
         except (BaseException, Exception), e:
@@ -238,6 +253,7 @@ class P2pMessageConsumer(MessageConsumer):
         self.result_msg = None
         self.special_case = 'HostInit'
         self.ack_event.clear()
+        P2pMessageStore().wakeup()
         self._logger.debug('Waiting message acknowledge event: %s', message.name)
         self.ack_event.wait()
         self._logger.debug('Fired message acknowledge event: %s', message.name)
@@ -276,6 +292,7 @@ class P2pMessageConsumer(MessageConsumer):
         self._logger.debug('Starting message handler')
 
         while self.running:
+            seq = store.unhandled_seq
             if not self.handler_locked:
                 try:
                     if self.message_to_ack:
@@ -303,7 +320,8 @@ class P2pMessageConsumer(MessageConsumer):
                                     return
                                 self._logger.debug('Found a message and continue message handler')
                                 break
-                        time.sleep(0.1)
+                        else:
+                            store.wait_unhandled(seq, self.wait_timeout)
                         continue
 
                     for queue, message in store.get_unhandled(self.endpoint):
@@ -311,7 +329,9 @@ class P2pMessageConsumer(MessageConsumer):
 
                 except (BaseException, Exception), e:
                     self._logger.exception(e)
-            time.sleep(0.1)
+            # Sleep until put_ingoing() signals a new message.
+            # Timeout is a safety net for lost wakeups and handler_locked changes
+            store.wait_unhandled(seq, self.wait_timeout)
 
         self.handler_status = 'stopped'
         self._logger.debug('Message handler stopped')
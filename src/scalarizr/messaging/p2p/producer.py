@@ -5,14 +5,24 @@ Created on Dec 5, 2009
 @author: marat
 '''
 
+import atexit
 import logging
 import threading
 import time
 import uuid
+import socket
 import httplib
 import urllib2
 import sys
 from copy import deepcopy
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    from collections import OrderedDict
+except ImportError:
+    from scalarizr.externals.collections import OrderedDict
 
 from scalarizr import messaging, util
 from scalarizr.bus import bus
@@ -31,7 +41,20 @@ class P2pMessageProducer(messaging.MessageProducer):
     _logger = None
     _stop_delivery = None
 
-    def __init__(self, endpoint=None, retries_progression=None):
+    BATCH_MESSAGES = ('Log', 'DeployLog', 'RebundleLog', 'OperationProgress')
+    '''
+    Messages that may be coalesced into one envelope when batching is enabled.
+    Envelope has the same name, meta['batch'] = 1 and
+    body {'entries': [{'id': id, 'meta': meta, 'body': body}, ...]}.
+    Entries are stored as outgoing messages when queued, envelope itself is never stored
+    '''
+
+    def __init__(self, endpoint=None, retries_progression=None, batch_window=None, batch_size=None):
+        '''
+        @param batch_window: Seconds to accumulate BATCH_MESSAGES before sending
+            them as one envelope. Batching is disabled when empty
+        @param batch_size: Send envelope earlier when it's body exceeds this number of bytes
+        '''
         messaging.MessageProducer.__init__(self)
         self.endpoint = endpoint
         if retries_progression:
@@ -45,17 +68,169 @@ class P2pMessageProducer(messaging.MessageProducer):
 
         self._local = threading.local()
         self._local_defaults = dict(interval=None, next_retry_index=0, delivered=False)
+        self._pool = urltool.HTTPConnectionPool()
+
+        self.batch_window = float(batch_window or 0)
+        self.batch_size = int(batch_size or 64 * 1024)
+        self._batches = OrderedDict()
+        self._batch_lock = threading.Lock()
+        self._batch_timer = None
+        # Held while sending to the queue, so batches and ordinary messages keep their order
+        self._queue_locks = {}
+        if self.batch_window:
+            atexit.register(self.flush)
+
+    @property
+    def connection_stats(self):
+        '''
+        Connections opened, reused and evicted by keep-alive pool
+        '''
+        return self._pool.stats.snapshot()
 
     def shutdown(self):
+        self.flush()
         self._stop_delivery.set()
+        self._store.flush()
+        self._pool.clear()
 
     def send(self, queue, message):
+        if self.batch_window:
+            if message.name in self.BATCH_MESSAGES and not message.meta.get('batch'):
+                self._add_to_batch(queue, message)
+                return
+            with self._queue_lock(queue):
+                # Preserve order: pending entries go before this message
+                self._send_batches(self._pop_batches(queue))
+                self._send(queue, message)
+            return
+        self._send(queue, message)
+
+    def _queue_lock(self, queue):
+        with self._batch_lock:
+            return self._queue_locks.setdefault(queue, threading.RLock())
+
+    def _add_to_batch(self, queue, message):
+        if message.id is None:
+            message.id = str(uuid.uuid4())
+        # Store entry right away, so it's not lost if we crash before envelope is sent
+        self._store.put_outgoing(message, queue, self.sender)
+        entry = dict(id=message.id, meta=dict(message.meta), body=message.body)
+        key = (queue, message.name)
+        with self._batch_lock:
+            batch = self._batches.setdefault(key, dict(entries=[], size=0))
+            batch['entries'].append(entry)
+            batch['size'] += len(json.dumps(entry))
+            full = batch['size'] >= self.batch_size
+            if not full:
+                self._start_batch_timer(self.batch_window)
+        if full:
+            with self._queue_lock(queue):
+                self._send_batches(self._pop_batches(queue))
+
+    def _start_batch_timer(self, interval):
+        # Called with _batch_lock held
+        if not self._batch_timer:
+            self._batch_timer = threading.Timer(interval, self._on_batch_timer)
+            self._batch_timer.setDaemon(True)
+            self._batch_timer.start()
+
+    def _pop_batches(self, queue):
+        # Oldest batch first
+        with self._batch_lock:
+            keys = [key for key in self._batches if key[0] == queue]
+            return [(key, self._batches.pop(key)) for key in keys]
+
+    def _envelope(self, name, batch):
+        self._logger.debug("Sending %d '%s' messages in one envelope", len(batch['entries']), name)
+        envelope = P2pMessage(name, body=dict(entries=batch['entries']))
+        envelope.meta['batch'] = 1
+        return envelope
+
+    def _send_batches(self, batches):
+        for (queue, name), batch in batches:
+            self._send(queue, self._envelope(name, batch))
+
+    def _send_once(self, queue, name, batch):
+        envelope = self._envelope(name, batch)
+        delivered = []
+        try:
+            self.fire("before_send", queue, envelope)
+            self._send0(queue, envelope, lambda q, m: delivered.append(m))
+        except:
+            self._logger.warn("Dropped '%s' envelope, entries are left undelivered", name,
+                              exc_info=sys.exc_info())
+            return True
+        return bool(delivered)
+
+    def _send_batches_once(self):
+        '''
+        Make a single delivery attempt for each pending envelope, oldest first.
+        After a failure later envelopes to the same queue are kept to preserve order.
+        Return batches that were not delivered, their entries stay undelivered in store
+        '''
+        with self._batch_lock:
+            keys = self._batches.keys()
+        failed = []
+        failed_queues = set()
+        for key in keys:
+            queue, name = key
+            if queue in failed_queues:
+                continue
+            with self._queue_lock(queue):
+                with self._batch_lock:
+                    batch = self._batches.pop(key, None)
+                if batch and not self._send_once(queue, name, batch):
+                    failed.append((key, batch))
+                    failed_queues.add(queue)
+        return failed
+
+    def _on_batch_timer(self):
+        with self._batch_lock:
+            self._batch_timer = None
+        failed = self._send_batches_once()
+        if failed:
+            with self._batch_lock:
+                # Put them back before entries queued meanwhile
+                pending = self._batches.items()
+                self._batches.clear()
+                self._batches.update(failed)
+                for key, batch in pending:
+                    if key in self._batches:
+                        self._batches[key]['entries'].extend(batch['entries'])
+                        self._batches[key]['size'] += batch['size']
+                    else:
+                        self._batches[key] = batch
+                self._start_batch_timer(self._retry_interval())
+
+    def _retry_interval(self):
+        if self.retries_progression:
+            return int(self.retries_progression[0]) * 60.0
+        return self.batch_window
+
+    def flush(self):
+        '''
+        Send all pending batches with a single attempt, so shutdown never hangs
+        when Scalr is unreachable. Entries of undelivered envelopes stay undelivered in store
+        '''
+        with self._batch_lock:
+            if self._batch_timer:
+                self._batch_timer.cancel()
+                self._batch_timer = None
+        failed = self._send_batches_once()
+        with self._batch_lock:
+            left = len(failed) + len(self._batches)
+            self._batches.clear()
+        if left:
+            self._logger.warn('%d message envelopes were not delivered', left)
+
+    def _send(self, queue, message):
         self._logger.debug("Sending message '%s' into queue '%s'", message.name, queue)
 
         if message.id is None:
             message.id = str(uuid.uuid4())
         self.fire("before_send", queue, message)
-        self._store.put_outgoing(message, queue, self.sender)
+        if not message.meta.get('batch'):
+            self._store.put_outgoing(message, queue, self.sender)
 
         if not self.no_retry:
             if not hasattr(self._local, "interval"):
@@ -109,7 +284,8 @@ class P2pMessageProducer(messaging.MessageProducer):
             if message.name not in ('Log',
                                     'OperationDefinition',
                                     'OperationProgress',
-                                    'OperationResult'):
+                                    'OperationResult') \
+                    and self._logger.isEnabledFor(logging.DEBUG):
                 msg_copy = P2pMessage(message.name, message.meta.copy(), deepcopy(message.body))
                 try:
                     del msg_copy.body['chef']['validator_name']
@@ -123,9 +299,7 @@ class P2pMessageProducer(messaging.MessageProducer):
                 data = f(self, queue, data, headers)
 
             url = self.endpoint + "/" + queue
-            req = urllib2.Request(url, data, headers)
-            opener = urllib2.build_opener(urltool.HTTPRedirectHandler())
-            opener.open(req)
+            self._post(url, data, headers)
 
             self._message_delivered(queue, message, success_callback)
 
@@ -167,12 +341,30 @@ class P2pMessageProducer(messaging.MessageProducer):
                 fail_callback(queue, message, e)
 
 
+    def _post(self, url, data, headers):
+        try:
+            resp = self._pool.request('POST', url, data, headers)
+        except socket.error, e:
+            raise urllib2.URLError(e)
+        if 300 <= resp.status < 400:
+            # Rare case, let urllib2 follow redirects
+            req = urllib2.Request(url, data, headers)
+            opener = urllib2.build_opener(urltool.HTTPRedirectHandler())
+            opener.open(req)
+        elif resp.status >= 400:
+            raise urllib2.HTTPError(url, resp.status, resp.reason, resp.msg, None)
+
+
     def _message_delivered(self, queue, message, callback=None):
         if message.name not in ('Log', 'OperationDefinition',
                                                 'OperationProgress', 'OperationResult'):
             self._logger.debug("Message '%s' delivered (message_id: %s)",
                                             message.name, message.id)
-        self._store.mark_as_delivered(message.id)
+        if message.meta.get('batch'):
+            for entry in message.body['entries']:
+                self._store.mark_as_delivered(entry['id'])
+        else:
+            self._store.mark_as_delivered(message.id)
         self.fire("send", queue, message)
         if callback:
             callback(queue, message)
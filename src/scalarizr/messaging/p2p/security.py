@@ -13,7 +13,10 @@ from scalarizr.messaging import MessagingError
 from scalarizr.util import cryptotool
 
 # Stdlibs
-import logging, binascii, sys
+import logging, sys, os
+
+
+_SPECIAL_CHARS = ''.join(chr(i) for i in range(0, 31))
 
 
 class P2pMessageSecurity(object):
@@ -25,16 +28,23 @@ class P2pMessageSecurity(object):
         self.server_id = server_id
         self.crypto_key_path = crypto_key_path
 
+    def _read_crypto_key(self):
+        # Same lookup as cnf.read_key(), decoded key is cached until the file changes
+        path = self.crypto_key_path
+        if not os.path.isabs(path):
+            path = bus.cnf.key_path(path)
+        return cryptotool.read_key(path)
+
     def in_protocol_filter(self, consumer, queue, message):
+        crypto_key = None
         try:
             # Decrypt message
-            cnf = bus.cnf
             self._logger.debug('Decrypting message')
-            crypto_key = binascii.a2b_base64(cnf.read_key(self.crypto_key_path))
+            crypto_key = self._read_crypto_key()
             xml = cryptotool.decrypt(message, crypto_key)
 
             # Remove special chars
-            return xml.strip(''.join(chr(i) for i in range(0, 31)))
+            return xml.strip(_SPECIAL_CHARS)
 
         except:
             self._logger.debug('Decryption error', exc_info=sys.exc_info())
@@ -45,9 +55,8 @@ class P2pMessageSecurity(object):
     def out_protocol_filter(self, producer, queue, message, headers):
         try:
             # Encrypt message
-            cnf = bus.cnf
             self._logger.debug('Encrypting message')
-            crypto_key = binascii.a2b_base64(cnf.read_key(self.crypto_key_path))
+            crypto_key = self._read_crypto_key()
             data = cryptotool.encrypt(message, crypto_key)
 
             # Generate signature
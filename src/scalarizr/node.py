@@ -5,10 +5,16 @@ import re
 import ConfigParser
 import sys
 import copy
+import logging
+import threading
 try:
     import json
 except ImportError:
     import simplejson as json 
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 from scalarizr import linux
 from scalarizr import util
@@ -22,6 +28,92 @@ private_dir = base_dir + '/private.d'
 public_dir = base_dir + '/public.d'
 storage_dir = private_dir + '/storage'
 
+LOG = logging.getLogger(__name__)
+
+
+class _FileStamps(object):
+    '''
+    Tells file-backed stores whether a file changed since they've read it.
+    By default stamp is (mtime, size, inode) from os.stat(). In inotify mode
+    it's a per file counter bumped by inotify events on its directory,
+    so lookups make no syscalls at all
+    '''
+
+    MASK = 0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._notifier = None
+        self._manager = None
+        self._dirs = {}
+        self._versions = {}
+
+    @property
+    def inotify(self):
+        return self._notifier is not None
+
+    def stamp(self, filename):
+        if self._notifier and self._watch(os.path.dirname(filename)):
+            return self._versions.get(filename, 0)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def _watch(self, dirname):
+        watched = self._dirs.get(dirname)
+        if watched is None:
+            with self._lock:
+                if not self._manager:
+                    return False
+                wdd = self._manager.add_watch(dirname, self.MASK, quiet=True)
+                watched = self._dirs[dirname] = wdd.get(dirname, -1) >= 0
+        return watched
+
+    def _changed(self, event):
+        self._versions[event.pathname] = self._versions.get(event.pathname, 0) + 1
+
+    def start_inotify(self):
+        if not pyinotify:
+            return False
+        with self._lock:
+            if not self._notifier:
+                self.MASK = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | \
+                        pyinotify.IN_MOVED_FROM | pyinotify.IN_CREATE | pyinotify.IN_DELETE
+                self._manager = pyinotify.WatchManager()
+                self._notifier = pyinotify.ThreadedNotifier(self._manager, self._changed)
+                self._notifier.setDaemon(True)
+                self._notifier.start()
+                self._dirs.clear()
+        return True
+
+    def stop_inotify(self):
+        with self._lock:
+            notifier, self._notifier, self._manager = self._notifier, None, None
+            self._dirs.clear()
+        if notifier:
+            notifier.stop()
+
+
+_stamps = _FileStamps()
+
+
+def enable_inotify():
+    '''
+    Invalidate cached Ini/Json/File values on inotify events instead of
+    os.stat() on every lookup. Changes made by other processes become visible
+    once the event is processed. Returns False when pyinotify isn't installed
+    '''
+    enabled = _stamps.start_inotify()
+    if not enabled:
+        LOG.debug('pyinotify is not available, node stores keep validating by stat()')
+    return enabled
+
+
+def disable_inotify():
+    _stamps.stop_inotify()
+
 
 class Store(object):
 
@@ -103,9 +195,11 @@ class Json(Store):
         self.filename = filename
         self.fn = fn
         self._obj = None
+        self._stamp = None
 
     def __getitem__(self, key):
-        if not self._obj:
+        stamp = _stamps.stamp(self.filename)
+        if not self._obj or stamp != self._stamp:
             try:
                 with open(self.filename, 'r') as fp:
                     kwds = json.load(fp)
@@ -115,6 +209,7 @@ class Json(Store):
                 if isinstance(self.fn, basestring):
                     self.fn = _import(self.fn)
                 self._obj = self.fn(**kwds)
+                self._stamp = stamp
         return self._obj
 
 
@@ -127,6 +222,8 @@ class Json(Store):
             os.makedirs(dirname)
         with open(self.filename, 'w+') as fp:
             json.dump(value, fp)
+        # write-through: keep the object we've just stored
+        self._stamp = _stamps.stamp(self.filename)
 
 
 class Ini(Store):
@@ -137,20 +234,35 @@ class Ini(Store):
         self.section = section
         self.ini = None
         self.mapping = mapping or {}
+        # stamps of files self.ini was read from, None when it has to be reread
+        self._stamps = None
+
+
+    def _file_stamps(self):
+        return tuple(_stamps.stamp(filename) for filename in self.filenames)
 
 
     def _reload(self, only_last=False):
-        self.ini = ConfigParser.ConfigParser()
+        # stamp before reading, so concurrent write forces another reload
+        stamps = None if only_last else self._file_stamps()
+        ini = ConfigParser.ConfigParser()
         if only_last:
-            self.ini.read(self.filenames[-1])
+            ini.read(self.filenames[-1])
         else:
             for filename in self.filenames:
                 if os.path.exists(filename):
-                    self.ini.read(filename)
+                    ini.read(filename)
+        self.ini = ini
+        self._stamps = stamps
+
+
+    def _load(self):
+        if self.ini is None or self._stamps is None or self._file_stamps() != self._stamps:
+            self._reload()
 
 
     def __getitem__(self, key):
-        self._reload()
+        self._load()
         if key in self.mapping:
             key = self.mapping[key]
         try:
@@ -174,6 +286,9 @@ class Ini(Store):
         self.ini.set(self.section, key, value)
         with open(self.filenames[0], 'w+') as fp:
             self.ini.write(fp)
+        if len(self.filenames) == 1:
+            # write-through: parser content is what we've just written
+            self._stamps = self._file_stamps()
 
 
 class RedisIni(Ini):
@@ -222,19 +337,27 @@ class IniOption(Ini):
 class File(Store):
     def __init__(self, filename):
         self.filename = filename
+        self._value = None
+        self._stamp = None
 
 
     def __getitem__(self, key):
-        try:
-            with open(self.filename) as fp:
-                return fp.read().strip()
-        except:
-            raise KeyError(key)
+        stamp = _stamps.stamp(self.filename)
+        if self._value is None or stamp != self._stamp:
+            try:
+                with open(self.filename) as fp:
+                    value = fp.read().strip()
+            except:
+                raise KeyError(key)
+            self._value, self._stamp = value, stamp
+        return self._value
 
 
     def __setitem__(self, key, value):
+        value = str(value).strip()
         with open(self.filename, 'w+') as fp:
-            fp.write(str(value).strip())
+            fp.write(value)
+        self._value, self._stamp = value, _stamps.stamp(self.filename)
 
 
 class BoolFile(Store):
@@ -326,7 +449,7 @@ node = {
         'server_id,role_id,farm_id,farm_role_id,env_id,role_name,server_index,queryenv_url':
                                 Ini(os.path.join(private_dir, 'config.ini'), 'general'),
         'message_format,producer_url': Ini(os.path.join(private_dir, 'config.ini'), 'messaging_p2p'),
-        'platform_name,crypto_key_path': Ini(os.path.join(public_dir, 'config.ini'), 'general'),
+        'platform_name,crypto_key_path,db_backend': Ini(os.path.join(public_dir, 'config.ini'), 'general'),
         'platform': Attr('scalarizr.bus', 'bus.platform'),
         'behavior': IniOption([public_dir + '/config.ini', private_dir + '/config.ini'], 
                               'general', 'behaviour',
@@ -363,7 +486,11 @@ node['global_timeout'] = 2400
 node['defaults'] = {
     'base': {
         'api_port': 8010,
-        'messaging_port': 8013
+        'messaging_port': 8013,
+        # 0 workers: thread per connection
+        'api_workers': 8,
+        'api_queue_size': 64,
+        'api_gzip': 1
     }
 }
 
@@ -415,7 +542,7 @@ node['mongodb'] = Compound({
 })
 
 node['nginx'] = Compound({
-    'app_port,upstream_app_role':
+    'app_port,upstream_app_role,upstream_update_delay':
         Ini('%s/%s.ini' % (public_dir, 'www'), 'www')
 })
 
@@ -22,7 +22,7 @@ from scalarizr import node
 from scalarizr.bus import bus
 from scalarizr import linux
 from scalarizr.util import metadata
-from scalarizr.util import LocalPool, NullPool
+from scalarizr.util import LocalPool, NullPool, KeyedLocalPool
 if linux.os.windows_family:
     import win32com.client
 else:
@@ -116,6 +116,10 @@ class PlatformFeatures:
     SNAPSHOTS       = 'snapshots'
 
 
+# Pooled cloud connection that wasn't used for that long is recreated
+CONN_MAX_IDLE = 300
+
+
 class Platform():
     name = None
     _arch = None
@@ -123,12 +127,30 @@ class Platform():
     _logger = logging.getLogger(__name__)
     features = []
     scalrfs = None
+    # access data properties connections are bound to,
+    # pools are disposed when they change
+    _conn_access_props = ()
 
 
     def __init__(self):
         self.scalrfs = self._scalrfs(self)
+        self._conn_pools = []
         node.__node__['access_data'] = {}
 
+    def _new_conn_pool(self, creator, check=None):
+        '''
+        @param check: cheap API call, connection idle for CONN_MAX_IDLE
+        is reused when check(conn) succeeds and recreated otherwise
+        '''
+        pool = KeyedLocalPool(creator, key_fn=self._conn_access_key,
+                              max_idle=CONN_MAX_IDLE, check=check)
+        self._conn_pools.append(pool)
+        return pool
+
+    def _conn_access_key(self):
+        access_data = node.__node__['access_data'] or {}
+        return tuple(access_data.get(prop) for prop in self._conn_access_props)
+
     def get_private_ip(self):
         return self.get_public_ip()
 
@@ -142,7 +164,11 @@ class Platform():
             return meta.user_data()
 
     def set_access_data(self, access_data):
+        old_key = self._conn_access_key()
         node.__node__['access_data'] = access_data
+        if self._conn_access_key() != old_key:
+            for pool in self._conn_pools:
+                pool.dispose_all()
 
     def get_access_data(self, prop=None):
         if prop:
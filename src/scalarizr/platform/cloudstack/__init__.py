@@ -9,7 +9,6 @@ import logging
 from scalarizr import platform
 from scalarizr import node
 from scalarizr.bus import bus
-from scalarizr.util import LocalPool
 from scalarizr.platform import Platform, PlatformFeatures, PlatformError
 from scalarizr.platform import ConnectionError, NoCredentialsError, InvalidCredentialsError
 from . import storage
@@ -36,6 +35,11 @@ def _create_connection():
     return conn
 
 
+def _check_connection(conn):
+    conn.listZones()
+    return True
+
+
 class CloudStackConnectionProxy(platform.ConnectionProxy):
     pass
 
@@ -47,11 +51,12 @@ class CloudStackPlatform(Platform):
     _dhcp_leases_mtime = None
     _dhcp_leases_path = None
     _router_addr = None
+    _conn_access_props = ('api_url', 'api_key', 'secret_key')
 
     def __init__(self):
         Platform.__init__(self)
         self._metadata = {}
-        self._conn_pool = LocalPool(_create_connection)
+        self._conn_pool = self._new_conn_pool(_create_connection, _check_connection)
         self.refresh_virtual_router_addr()
 
     def refresh_virtual_router_addr(self):
@@ -9,7 +9,6 @@ import logging
 from scalarizr.bus import bus
 from scalarizr.node import __node__
 from scalarizr import platform
-from scalarizr.util import NullPool
 from scalarizr.platform import Ec2LikePlatform, PlatformError, PlatformFeatures
 from scalarizr.platform import NoCredentialsError, InvalidCredentialsError, ConnectionError
 from scalarizr.storage.transfer import Transfer
@@ -77,6 +76,16 @@ def _create_s3_connection():
     return conn
 
 
+def _check_ec2_connection(conn):
+    conn.get_all_zones()
+    return True
+
+
+def _check_s3_connection(conn):
+    conn.get_all_buckets()
+    return True
+
+
 class Ec2ConnectionProxy(platform.ConnectionProxy):
 
     def invoke(self, *args, **kwds):
@@ -121,11 +130,12 @@ class Ec2Platform(Ec2LikePlatform):
     _cnf = None
 
     features = [PlatformFeatures.SNAPSHOTS, PlatformFeatures.VOLUMES]
+    _conn_access_props = ('key_id', 'key')
 
     def __init__(self):
         platform.Ec2LikePlatform.__init__(self)
-        self._ec2_conn_pool = NullPool(_create_ec2_connection)
-        self._s3_conn_pool = NullPool(_create_s3_connection)
+        self._ec2_conn_pool = self._new_conn_pool(_create_ec2_connection, _check_ec2_connection)
+        self._s3_conn_pool = self._new_conn_pool(_create_s3_connection, _check_s3_connection)
 
     def get_account_id(self):
         return self.get_access_data("account_id").encode("ascii")
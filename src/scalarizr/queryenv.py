@@ -3,7 +3,6 @@ Created on Dec 23, 2009
 
 @author: Dmytro Korsakov
 '''
-import binascii
 import logging
 import sys
 import urllib
@@ -83,9 +82,7 @@ class QueryEnvService(object):
             for key, value in params.items():
                 request_body[key] = value
 
-        file = open(self.key_path)
-        key = binascii.a2b_base64(file.read())
-        file.close()
+        key = cryptotool.read_key(self.key_path)
 
         signature, timestamp = cryptotool.sign_http_request(request_body, key)
 
@@ -18,6 +18,7 @@ import urlparse
 import struct
 import socket
 import traceback
+import threading
 from threading import local
 import logging
 from copy import deepcopy
@@ -124,53 +125,139 @@ class RequestHandler(object):
     def handle_error(self):
         LOG.exception('Caught exception')
 
+    # batch requests are executed by that many threads
+    batch_workers = 4
+    max_batch_size = 100
+
     def handle_request(self, data, namespace=None):
+        '''
+        Handles single request or JSON-RPC 2.0 batch (list of requests).
+        Method name of a batch item may be prefixed with namespace, e.g. "system.cpu_stat",
+        so one batch can call methods from different namespaces
+        '''
+        try:
+            req = self._parse_request(data) if isinstance(data, basestring) else data
+        except ServiceError, e:
+            return json.dumps({'error': self._service_error(e), 'id': ''})
+        if isinstance(req, list):
+            return self._handle_batch(req, namespace)
+
+        resp, log_it = self._handle(req, namespace)
+        ret = self._serialize(resp)
+        if log_it:
+            LOG.debug('response: %s', ret)
+        return ret
+
+
+    def _handle(self, req, namespace, batch_item=False):
         id, result, error = '', None, None
         log_it = False
         try:
-            req = self._parse_request(data) if isinstance(data, basestring) else data
             id, method, params = self._translate_request(req)
+            if batch_item and '.' in method:
+                namespace, method = method.rsplit('.', 1)
             svs = self._find_service(namespace)
             fn = self._find_method(svs, method)
             if fn._jsonrpc == 'command':
                 log_it = True
-                data_to_log = self._clear_request_data(data)
+                data_to_log = self._clear_request_data(req)
                 LOG.debug('request: %s', json.dumps(data_to_log))
             result = self._invoke_method(fn, params)
-            # important to test json serializarion before serialize the whole result
-            json.dumps(result)
-
         except ServiceError, e:
-            error = {'code': e.code,
-                            'message': e.message,
-                            'data': e.data}
+            error = self._service_error(e)
         except:
-            E, e = sys.exc_info()[:2]
-            if E in (SystemExit, KeyboardInterrupt):
-                raise
-            code = E.__name__
-            if E in (KeyError, IndexError):
-                # file/line/def where exception occurred formatted like exception stacktrace 
-                where = traceback.format_list([traceback.extract_tb(sys.exc_info()[2])[-1]])[0].strip()  
-                message = '{0}: {1} in {2}'.format(E.__name__, e, where)
-            else:
-                message = '{0}: {1}'.format(E.__name__, e)
-            LOG.warn('Caught API exception. {0}'.format(message), exc_info=sys.exc_info())
-            error = {'code': ServiceError.INTERNAL,
-                            'message': message,
-                            'data': None}
+            error = self._internal_error()
+
+        if error:
+            resp = {'error': error, 'id': id}
+        else:
+            resp = {'result': result, 'id': id}
+        if isinstance(req, dict) and 'jsonrpc' in req:
+            resp['jsonrpc'] = req['jsonrpc']
+        return resp, log_it
+
+
+    def _serialize(self, resp):
+        try:
+            # result is serialized once, together with the response
+            return json.dumps(resp)
+        except (TypeError, ValueError):
+            error_resp = {'error': self._internal_error(), 'id': resp['id']}
+            if 'jsonrpc' in resp:
+                error_resp['jsonrpc'] = resp['jsonrpc']
+            return json.dumps(error_resp)
+
+
+    def _handle_batch(self, reqs, namespace):
+        if not reqs or len(reqs) > self.max_batch_size:
+            e = InvalidRequestError('Batch should contain 1..%d requests' % self.max_batch_size)
+            return json.dumps({'error': self._service_error(e), 'id': ''})
+
+        resps = [None] * len(reqs)
+        indexes = iter(xrange(len(reqs)))
+        lock = threading.Lock()
+        def work():
+            while True:
+                with lock:
+                    i = next(indexes, None)
+                if i is None:
+                    return
+                resps[i] = self._handle(reqs[i], namespace, batch_item=True)
+
+        workers = [threading.Thread(target=work)
+                        for _ in range(min(self.batch_workers, len(reqs)) - 1)]
+        for t in workers:
+            t.start()
+        try:
+            work()
         finally:
-            if not error:
-                resp = {'result': result}
-            else:
-                resp = {'error': error}
-            resp['id'] = id
-        ret = json.dumps(resp)
-        if log_it:
+            for t in workers:
+                t.join()
+
+        for i, resp in enumerate(resps):
+            if resp is None:
+                # worker was killed by SystemExit/KeyboardInterrupt in the middle
+                req = reqs[i]
+                resp = {'error': {'code': ServiceError.INTERNAL,
+                                  'message': 'Request was interrupted',
+                                  'data': None},
+                        'id': req.get('id', '') if isinstance(req, dict) else ''}
+                if isinstance(req, dict) and 'jsonrpc' in req:
+                    resp['jsonrpc'] = req['jsonrpc']
+                resps[i] = (resp, False)
+
+        try:
+            ret = json.dumps([resp for resp, _ in resps])
+        except (TypeError, ValueError):
+            # find out which results aren't serializable
+            ret = '[%s]' % ', '.join(self._serialize(resp) for resp, _ in resps)
+        if any(log_it for _, log_it in resps):
             LOG.debug('response: %s', ret)
         return ret
 
 
+    def _service_error(self, e):
+        return {'code': e.code,
+                        'message': e.message,
+                        'data': e.data}
+
+
+    def _internal_error(self):
+        E, e = sys.exc_info()[:2]
+        if E in (SystemExit, KeyboardInterrupt):
+            raise
+        if E in (KeyError, IndexError):
+            # file/line/def where exception occurred formatted like exception stacktrace 
+            where = traceback.format_list([traceback.extract_tb(sys.exc_info()[2])[-1]])[0].strip()  
+            message = '{0}: {1} in {2}'.format(E.__name__, e, where)
+        else:
+            message = '{0}: {1}'.format(E.__name__, e)
+        LOG.warn('Caught API exception. {0}'.format(message), exc_info=sys.exc_info())
+        return {'code': ServiceError.INTERNAL,
+                        'message': message,
+                        'data': None}
+
+
     def _parse_request(self, data):
         try:
             return json.loads(data)
@@ -212,11 +299,110 @@ class RequestHandler(object):
         '''
 
 
+class BatchCall(object):
+    '''
+    Call queued in a Batch, result is available after Batch.execute()
+    '''
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.error = None
+        self.done = False
+        self._result = None
+
+    @property
+    def result(self):
+        if not self.done:
+            raise ValueError('Batch call %s is not executed yet' % self.method)
+        if self.error:
+            raise self.error
+        return self._result
+
+
+class _BatchMethod(object):
+
+    def __init__(self, batch, path):
+        self._batch = batch
+        self._path = path
+
+    def __getattr__(self, name):
+        return _BatchMethod(self._batch, self._path + [name])
+
+    def __call__(self, **kwds):
+        return self._batch.add('.'.join(self._path), kwds)
+
+
+class Batch(object):
+    '''
+    Sends calls queued through ServiceProxy.batch() in one JSON-RPC batch request
+
+    >> with proxy.batch() as batch:
+    >>     cpu = batch.system.cpu_stat()
+    >>     la = batch.system.load_average()
+    >> cpu.result, la.result
+    '''
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self.calls = []
+
+    def __getattr__(self, name):
+        return _BatchMethod(self, [name])
+
+    def add(self, method, params=None):
+        call = BatchCall(method, params or {})
+        self.calls.append(call)
+        return call
+
+    def execute(self):
+        '''
+        Sends queued calls, returns their results in order. Raises ServiceError
+        of the first failed call, other results are still set in BatchCall objects
+        '''
+        calls, self.calls = self.calls, []
+        if not calls:
+            return []
+        req = json.dumps([{'method': call.method, 'params': call.params, 'id': i}
+                        for i, call in enumerate(calls)])
+        resp = json.loads(self._proxy.exchange_batch(req))
+        if isinstance(resp, dict):
+            error = resp['error']
+            raise ServiceError(error.get('code'), error.get('message'), error.get('data'))
+        for item in resp:
+            call = calls[item['id']]
+            if 'error' in item:
+                error = item['error']
+                call.error = ServiceError(error.get('code'), error.get('message'), error.get('data'))
+            else:
+                call._result = item['result']
+            call.done = True
+        return [call.result for call in calls]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if not exc_info[0]:
+            self.execute()
+
+
 class ServiceProxy(object):
 
     def __init__(self):
         self.local = local()
 
+    def batch(self):
+        return Batch(self)
+
+    def exchange_batch(self, request):
+        # batch is sent to the root namespace, methods are prefixed with their namespaces
+        self.local.method = []
+        try:
+            return self.exchange(request)
+        finally:
+            self.local.method = []
+
     def __getattr__(self, name):
         try:
             self.__dict__['local'].method.append(name)
@@ -25,6 +25,7 @@ SERVICE_NAME = 'haproxy'
 HAPROXY_EXEC = '/usr/sbin/haproxy'
 HAPROXY_CFG_PATH = '/etc/haproxy/haproxy.cfg'
 HAPROXY_LENS_DIR = os.path.join(__node__['share_dir'], 'haproxy_lens')
+STATS_SOCKET = '/var/run/haproxy-stats.sock'
 
 
 LOG = logging.getLogger(__name__)
@@ -212,7 +213,7 @@ class StatSocket(object):
     '''
     haproxy unix socket API
     - one-to-one naming
-    - connect -> request -> disconnect
+    - connect -> request(s) -> disconnect
 
     Create object:
     >> ss = StatSocket('/var/run/haproxy-stats.sock')
@@ -221,34 +222,76 @@ class StatSocket(object):
     >> ss.show_stat()
     [{'status': 'UP', 'lastchg': '68', 'weight': '1', 'slim': '', 'pid': '1', 'rate_lim': '',
     'check_duration': '0', 'rate': '0', 'req_rate': '', 'check_status': 'L4OK', 'econ': '0',
-    ...'''
+    ...
 
-    def __init__(self, address='/var/run/haproxy-stats.sock'):
-        try:
-            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            self.sock.connect(address)
-            self.adress = address
-        except:
-            raise Exception, "Couldn't connect to socket on address: %s%s" % (address, sys.exc_info()[1]), sys.exc_info()[2]
+    Runtime server state changes (socket should be configured with `level admin`),
+    several commands are sent over a single connection:
+    >> ss.disable_server(('scalr:backend:80', '10-0-0-1:80'), ('scalr:backend:81', '10-0-0-1:81'))
+    '''
 
+    def __init__(self, address=STATS_SOCKET):
+        self.address = address
 
-    def show_stat(self):
+    def execute(self, *commands):
         '''
-        @rtype: list[dict]
+        Runs semicolon delimited commands in one connection, returns raw output
         '''
         try:
-            self.sock.send('show stat\n')
-            stat = self.sock.makefile('r').read()
-
-            fieldnames = filter(None, stat[2:stat.index('\n')].split(','))
-            reader = csv.DictReader(cStringIO.StringIO(stat[stat.index('\n'):]), fieldnames)
-            res=[]
-            for row in reader:
-                res.append(row)
-            return res
-        except:
-            raise Exception, "Error working with sockets. Details: %s" % sys.exc_info()[1],\
-                    sys.exc_info()[2]
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.address)
+                sock.sendall('; '.join(commands) + '\n')
+                chunks = []
+                while True:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    chunks.append(data)
+                return ''.join(chunks)
+            finally:
+                sock.close()
+        except socket.error:
+            raise HAProxyError, "Couldn't execute '%s' on socket %s: %s" % (
+                    '; '.join(commands), self.address, sys.exc_info()[1]), sys.exc_info()[2]
+
+    def show_stat(self, types=None):
+        '''
+        @param types: bitmask of proxy types: 1 frontends, 2 backends, 4 servers
+        @rtype: list[dict]
+        '''
+        command = 'show stat' if types is None else 'show stat -1 %d -1' % types
+        return parse_stat(self.execute(command))
+
+    def _server_command(self, command, servers):
+        out = self.execute(*['%s server %s/%s' % (command, backend, server)
+                            for backend, server in servers])
+        if out.strip():
+            # success is silent, e.g. 'No such server.' or 'Permission denied'
+            raise HAProxyError("'%s server' failed: %s" % (command, out.strip()))
+
+    def enable_server(self, *servers):
+        '''
+        @param servers: (backend, server) pairs
+        '''
+        self._server_command('enable', servers)
+
+    def disable_server(self, *servers):
+        '''
+        Put servers into maintenance mode
+        @param servers: (backend, server) pairs
+        '''
+        self._server_command('disable', servers)
+
+
+def parse_stat(stat):
+    '''
+    Parses `show stat` CSV output into list of dicts
+    '''
+    if not stat.startswith('# '):
+        raise HAProxyError('Unexpected `show stat` output: %s' % stat[:200])
+    header, _, body = stat[2:].partition('\n')
+    fieldnames = filter(None, header.split(','))
+    return list(csv.DictReader(cStringIO.StringIO(body), fieldnames))
 
 
 class HAProxyInitScript(initdv2.InitScript):
@@ -14,10 +14,18 @@ import glob
 import shlex
 import shutil
 import logging
+import threading
+import contextlib
 import subprocess
 
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
 from scalarizr.util import firstmatched, wait_until
 from scalarizr.config import BuiltinBehaviours
+from scalarizr import util
 from scalarizr.util import initdv2, system2, PopenError, software, Singleton
 from scalarizr.linux.coreutils import chown_r
 from scalarizr.services import BaseService, BaseConfig, lazy, PresetProvider, backup
@@ -43,6 +51,9 @@ ROOT_USER = "scalr"
 MASTER_USER = "scalr_master"
 DEFAULT_USER = "postgres"
 
+PG_SOCKET_DIRS = ('/var/run/postgresql', '/tmp')
+PG_POOL_SIZE = 4
+
 STORAGE_DATA_DIR = "data"
 TRIGGER_NAME = "trigger"
 PRESET_FNAME = 'postgresql.conf'
@@ -107,6 +118,8 @@ class PostgreSql(BaseService):
     _objects = None
     _instance = None
     service = None
+    _reload_reasons = None
+    _reload_force = False
         
         
     def __new__(cls, *args, **kwargs):
@@ -172,16 +185,43 @@ class PostgreSql(BaseService):
         self.service.start()
         
         
+    @contextlib.contextmanager
+    def access_batch(self):
+        '''
+        Group register_*/unregister_* calls: pg_hba.conf is written once
+        and service is reloaded once after the block, if anything changed
+        '''
+        if self._reload_reasons is not None:
+            yield
+            return
+        self._reload_reasons = []
+        try:
+            with self.pg_hba_conf.batch():
+                yield
+            reasons, force = self._reload_reasons, self._reload_force
+        finally:
+            self._reload_reasons, self._reload_force = None, False
+        if reasons:
+            self.service.reload(', '.join(reasons), force=force)
+
+    def _reload(self, reason, force=True):
+        if self._reload_reasons is not None:
+            self._reload_reasons.append(reason)
+            self._reload_force = self._reload_force or force
+        else:
+            self.service.reload(reason, force=force)
+
+
     def register_slave(self, slave_ip, force_restart=True):
         self.pg_hba_conf.add_standby_host(slave_ip, self.root_user.name)
         self.postgresql_conf.max_wal_senders += 1
         if force_restart:
-            self.service.reload(reason='Registering slave', force=True)
+            self._reload('Registering slave', force=True)
             
             
     def register_client(self, ip, force=True):
-        self.pg_hba_conf.add_client(ip)
-        self.service.reload('Allowing access for new app instance: %s' % ip, force=force)
+        if self.pg_hba_conf.add_client(ip):
+            self._reload('Allowing access for new app instance: %s' % ip, force=force)
         
         
     def change_primary(self, primary_ip, primary_port, username):
@@ -189,12 +229,12 @@ class PostgreSql(BaseService):
     
     
     def unregister_slave(self, slave_ip):
-        self.pg_hba_conf.delete_standby_host(slave_ip, self.root_user.name)
-        self.service.reload(reason='Unregistering slave', force=True)
+        if self.pg_hba_conf.delete_standby_host(slave_ip, self.root_user.name):
+            self._reload('Unregistering slave', force=True)
         
     def unregister_client(self, ip):
-        self.pg_hba_conf.delete_client(ip)
-        self.service.reload(reason='Unregistering terminated instance: %s' % ip, force=True)
+        if self.pg_hba_conf.delete_client(ip):
+            self._reload('Unregistering terminated instance: %s' % ip, force=True)
 
 
     def stop_replication(self):
@@ -520,7 +560,7 @@ class PgUser(object):
             
     def change_role_password(self, password):
         LOG.debug('Changing password for pg role %s' % self.name)
-        self.psql.execute("ALTER USER %s WITH PASSWORD '%s';" % (self.name, password), silent=True)
+        self.psql.fetchall("ALTER USER %s WITH PASSWORD %%s;" % self.name, (password, ), silent=True)
         
     def _create_pg_database(self):
         if self._is_pg_database_exist:
@@ -557,31 +597,114 @@ class PgUser(object):
             fp.write(key_str)
         
         
+class PgSQLError(PopenError):
+    """
+    Query failed on server or in driver.
+    PopenError subclass, so callers written for psql subprocess keep working
+    """
+
+
+def get_socket_dir():
+    for path in PG_SOCKET_DIRS:
+        if glob.glob(os.path.join(path, '.s.PGSQL.*')):
+            return path
+    return None
+
+
+class PgConnectionPool(object):
+    """
+    Driver connections to local PostgreSQL over unix socket, keyed by (user, database).
+    Connections are in autocommit mode, like psql -c.
+    Up to size idle connections per key are kept open
+    """
+
+    def __init__(self, size=PG_POOL_SIZE):
+        self.size = size
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def connect(self, user, database=None):
+        kwds = {'user': user}
+        if database:
+            kwds['database'] = database
+        socket_dir = get_socket_dir()
+        if socket_dir:
+            kwds['host'] = socket_dir
+        conn = psycopg2.connect(**kwds)
+        conn.autocommit = True
+        return conn
+
+    def get(self, user, database=None):
+        """
+        :returns: (connection, reused)
+        """
+        with self._lock:
+            idle = self._idle.get((user, database))
+            conn = idle.pop() if idle else None
+        if conn is not None and not conn.closed:
+            return conn, True
+        return self.connect(user, database), False
+
+    def put(self, conn, user, database=None):
+        if conn.closed:
+            return
+        with self._lock:
+            idle = self._idle.setdefault((user, database), [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
 class PSQL(object):
     path = PSQL_PATH
     user = None
-    
-    def __init__(self, user=DEFAULT_USER):  
+    pool = PgConnectionPool()
+
+    def __init__(self, user=DEFAULT_USER, database=None):
+        """
+        Queries go through pooled psycopg2 connections,
+        or through psql subprocess when driver isn't installed
+
+        :param database: defaults to user name, like in psql
+        """
         self.user = user
+        self.database = database
+
+    @property
+    def use_driver(self):
+        return psycopg2 is not None
 
-    def test_connection(self):
+    def test_connection(self, timeout=120):
         LOG.debug('Checking PostgreSQL service status')
-        
-        def test_recursive(attempt):
+        deadline = time.time() + timeout
+        while True:
             try:
-                self.execute('SELECT 1;', silent=True)
+                self.fetchone('SELECT 1;', silent=True)
             except PopenError, e:
-                if 'could not connect to server' in str(e):
+                # libpq < 14 and >= 14 messages
+                if 'could not connect to server' in str(e) or \
+                        'connection to server on socket' in str(e):
                     return False
                 elif 'the database system is starting up' in str(e):
-                    if not attempt:
+                    if time.time() > deadline:
                         raise BaseException('Postgresql service stuck on starting up database system')
-                    time.sleep(10)
-                    return test_recursive(attempt-1)
+                    time.sleep(1)
+                    continue
             return True
-        return test_recursive(12)
-        
+
     def execute(self, query, silent=False):
+        """
+        Run query with psql and return its text output.
+        Use fetchall(), fetchone() or execute_batch() for typed results
+        """
         try:
             out = system2([SU_EXEC, '-', self.user, '-c', 'export LANG=en_US; %s -c "%s"' % (self.path, query)], silent=True)[0]
             return out  
@@ -590,34 +713,115 @@ class PSQL(object):
                 LOG.error('Unable to execute query %s from user %s: %s' % (query, self.user, e))
             raise       
 
+    def fetchall(self, query, args=None, silent=False):
+        """
+        :param args: query parameters for %s placeholders
+
+        :returns: list of row tuples. Values are python typed with driver
+            and strings in psql subprocess mode
+        """
+        return self._fetch(query, args, silent)
+
+    def _fetch(self, query, args=None, silent=False, single_transaction=False):
+        try:
+            if self.use_driver:
+                return self._fetch_driver(query, args)
+            return self._fetch_psql(query, args, single_transaction)
+        except PopenError, e:
+            if not silent:
+                LOG.error('Unable to execute query %s from user %s: %s' % (query, self.user, e))
+            raise
+
+    def fetchone(self, query, args=None, silent=False):
+        rows = self.fetchall(query, args, silent)
+        return rows[0] if rows else None
+
+    def execute_batch(self, queries, silent=False):
+        """
+        Execute several statements in one round trip, as one implicit transaction.
+        Statements that can't run in transaction block (e.g. DROP DATABASE)
+        should be executed separately
+
+        :returns: rows of the last statement
+        """
+        return self._fetch(';\n'.join(query.rstrip().rstrip(';') for query in queries) + ';',
+                           silent=silent, single_transaction=True)
+
+    def _fetch_driver(self, query, args=None):
+        conn = None
+        try:
+            conn, reused = self.pool.get(self.user, self.database)
+            try:
+                rows = self._cursor_fetch(conn, query, args)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                conn.close()
+                if not reused:
+                    raise
+                # Pooled connection is broken (e.g. server restart), retry once with new one
+                conn = self.pool.connect(self.user, self.database)
+                rows = self._cursor_fetch(conn, query, args)
+        except psycopg2.Error, e:
+            if conn is not None:
+                if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                    conn.close()
+                self.pool.put(conn, self.user, self.database)
+            raise PgSQLError(str(e).strip())
+        self.pool.put(conn, self.user, self.database)
+        return rows
+
+    def _cursor_fetch(self, conn, query, args):
+        cur = conn.cursor()
+        try:
+            cur.execute(query, args)
+            return cur.fetchall() if cur.description else []
+        finally:
+            cur.close()
+
+    def _fetch_psql(self, query, args=None, single_transaction=False):
+        if args:
+            query = query % tuple(map(self._literal, args))
+        # Not -1 by default: DROP DATABASE and alike can't run inside transaction block
+        cmd = 'export LANG=en_US; %s -X -q -A -t -F \'\x1f\' -v ON_ERROR_STOP=1 -f -' % self.path
+        if single_transaction:
+            cmd += ' -1'
+        if self.database:
+            cmd += ' -d %s' % self.database
+        out = system2([SU_EXEC, '-', self.user, '-c', cmd], stdin=query, silent=True)[0]
+        return [tuple(line.split('\x1f')) for line in out.splitlines() if line]
+
+    def _literal(self, value):
+        if value is None:
+            return 'NULL'
+        if isinstance(value, (int, long, float)):
+            return str(value)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return "'%s'" % str(value).replace("'", "''")
+
     def list_pg_roles(self):
-        out = self.execute('SELECT rolname FROM pg_roles;')
-        roles = out.split()[2:-2]
-        return roles
+        return [row[0] for row in self.fetchall('SELECT rolname FROM pg_roles;')]
     
     def list_pg_databases(self):
-        out = self.execute('SELECT datname FROM pg_database where not datistemplate;')
-        roles = out.split()[2:-2]
-        return roles    
+        return [row[0] for row in self.fetchall('SELECT datname FROM pg_database where not datistemplate;')]
     
     def delete_pg_role(self, name):
-        out = self.execute('DROP ROLE IF EXISTS %s;' % name)
-        LOG.debug(out)
+        self.fetchall('DROP ROLE IF EXISTS %s;' % name)
+        LOG.debug('Role %s deleted', name)
 
     def delete_pg_database(self, name):
-        out = self.execute('DROP DATABASE IF EXISTS %s;' % name)
-        LOG.debug(out)
+        self.fetchall('DROP DATABASE IF EXISTS %s;' % name)
+        LOG.debug('Database %s deleted', name)
         
     def start_backup(self):
         try:
-            out = self.execute("SELECT pg_start_backup('label', true);")
+            out = self.fetchone("SELECT pg_start_backup('label', true);")
             LOG.debug(out)
         except PopenError, e:
             LOG.warning('Cannot start backup: %s' % e)
 
     def stop_backup(self):
         try:
-            out = self.execute("SELECT pg_stop_backup();")
+            out = self.fetchone("SELECT pg_stop_backup();")
             LOG.debug(out)
         except PopenError, e:
             LOG.warning('Cannot stop backup: %s' % e)
@@ -1063,13 +1267,15 @@ class PgHbaRecord(object):
             raise ParseError('Cannot parse pg_hba.conf entry: %s. No auth method found' % entry)
         return PgHbaRecord(host, database, user, auth_method, address, ip, mask, auth_options)
     
+    @property
+    def key(self):
+        '''
+        Records with the same key are similar (differ only in auth)
+        '''
+        return (self.host, self.database, self.user, self.address, self.ip, self.mask)
+
     def is_similar_to(self, other):
-        return  self.host == other.host and \
-        self.database == other.database and \
-        self.user == other.user and \
-        self.address == other.address and \
-        self.ip == other.ip and \
-        self.mask == other.mask 
+        return self.key == other.key
     
     def __eq__(self, other):
         return self.is_similar_to(other) and \
@@ -1091,6 +1297,16 @@ class PgHbaRecord(object):
     
         
 class PgHbaConf(object):
+    '''
+    pg_hba.conf kept in memory as a list of lines (comments are preserved)
+    with records indexed by PgHbaRecord.key. File is re-read only when it was
+    changed on disk. Each modification is a batch of its own, group them with
+
+        with pg_hba_conf.batch():
+            ...
+
+    to write the file once
+    '''
     
     config_name = 'pg_hba.conf'
     path = None
@@ -1100,76 +1316,143 @@ class PgHbaConf(object):
     
     def __init__(self, path):
         self.path = path
+        self.writes = 0
+        self._lines = None
+        self._index = None
+        self._stat = None
+        self._batch_depth = 0
+        self._changed = False
+        self._lock = threading.RLock()
 
     @classmethod
     def find(cls, config_dir):
         return cls(os.path.join(config_dir.path, cls.config_name))
-    
-    @property
-    def records(self):
-        l = []
-        text = ''
+
+    def _load(self):
+        st = os.stat(self.path)
+        stat = (st.st_ino, st.st_size, st.st_mtime)
+        if stat == self._stat:
+            return
+        lines = []
+        index = {}
         with open(self.path, 'r') as fp:
             text = fp.read()
         for line in text.splitlines():
             if line.strip() and not line.strip().startswith('#'):
-                record = PgHbaRecord.from_string(line)
-                l.append(record)
-        return l
-    
+                line = PgHbaRecord.from_string(line)
+                index.setdefault(line.key, []).append(line)
+            lines.append(line)
+        self._lines, self._index, self._stat = lines, index, stat
+
+    def _write(self):
+        LOG.debug('Writing %s', self.path)
+        util.atomic_write(self.path, '\n'.join(map(str, self._lines)) + '\n')
+        self.writes += 1
+        # Our own write, no need to re-read
+        st = os.stat(self.path)
+        self._stat = (st.st_ino, st.st_size, st.st_mtime)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Apply all changes made inside the block with a single atomic file write.
+        Changes are discarded when the block raises. Nested batches join the outer one
+        '''
+        with self._lock:
+            if not self._batch_depth:
+                self._load()
+                self._changed = False
+            self._batch_depth += 1
+            try:
+                yield self
+            except:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    # Reload unchanged file on next access
+                    self._stat = None
+                raise
+            self._batch_depth -= 1
+            if not self._batch_depth and self._changed:
+                self._write()
+
+    @property
+    def records(self):
+        with self._lock:
+            if not self._batch_depth:
+                self._load()
+            return [line for line in self._lines if isinstance(line, PgHbaRecord)]
+
+    def _remove(self, records):
+        ids = set(map(id, records))
+        self._lines = [line for line in self._lines if id(line) not in ids]
+        for record in records:
+            similar = self._index[record.key]
+            similar.remove(record)
+            if not similar:
+                del self._index[record.key]
+        self._changed = True
+
     def add_record(self, record, replace_similar=False):
-        if replace_similar:
-            for old_record in self.records:
-                if old_record != record and old_record.is_similar_to(record):
-                    self.delete_record(old_record)
-        if record not in self.records:
-            LOG.debug('Adding record "%s" to %s' % (str(record),self.path))
-            with open(self.path, 'a') as fp:
-                fp.write('\n'+str(record)+'\n')
-        else:
-            LOG.debug('Record "%s" is already in %s. Nothing to add.' % (str(record),self.path))
+        '''
+        :returns: True if file content was changed
+        '''
+        with self.batch():
+            similar = self._index.get(record.key, [])
+            changed = False
+            if replace_similar:
+                old_records = [old_record for old_record in similar if old_record != record]
+                if old_records:
+                    LOG.debug('Removing records "%s" from %s' % (map(str, old_records), self.path))
+                    self._remove(old_records)
+                    changed = True
+            if record not in self._index.get(record.key, []):
+                LOG.debug('Adding record "%s" to %s' % (str(record),self.path))
+                self._lines.append(record)
+                self._index.setdefault(record.key, []).append(record)
+                self._changed = changed = True
+            else:
+                LOG.debug('Record "%s" is already in %s. Nothing to add.' % (str(record),self.path))
+            return changed
             
     def delete_record(self, record, delete_similar=False):
-        deleted = []
-        lines = []
-        changed = False
-        for old_record in self.records:
-            if (old_record == record) or (delete_similar and old_record.is_similar_to(record)):
-                deleted.append(str(old_record))
-                changed = True
-                continue
-            else:
-                lines.append(str(old_record))
-        if changed:
-            LOG.debug('Removing records "%s" from %s' % (deleted,self.path))
-            with open(self.path, 'w') as fp:
-                fp.write('\n'.join(lines))
+        '''
+        :returns: True if file content was changed
+        '''
+        with self.batch():
+            deleted = [old_record for old_record in self._index.get(record.key, [])
+                       if delete_similar or old_record == record]
+            if deleted:
+                LOG.debug('Removing records "%s" from %s' % (map(str, deleted), self.path))
+                self._remove(deleted)
+            return bool(deleted)
     
     def add_standby_host(self, ip, user='postgres'):
         record = self._make_standby_record(ip, user)
-        self.add_record(record)
+        return self.add_record(record)
 
     def delete_standby_host(self, ip, user='postgres'):
         record = self._make_standby_record(ip, user)
-        self.delete_record(record)
+        return self.delete_record(record)
         
     
     def add_client(self, ip):
         record = self._make_farm_server_record(ip)
-        self.add_record(record)
+        return self.add_record(record)
 
     def delete_client(self, ip):
         record = self._make_farm_server_record(ip)
-        self.delete_record(record)      
+        return self.delete_record(record)
     
     
     def set_trusted_access_mode(self):
-        self.delete_record(self.password_mode)
-        self.add_record(self.trusted_mode)
+        with self.batch():
+            self.delete_record(self.password_mode)
+            self.add_record(self.trusted_mode)
     
     def set_password_access_mode(self):
-        self.delete_record(self.trusted_mode)
-        self.add_record(self.password_mode)
+        with self.batch():
+            self.delete_record(self.trusted_mode)
+            self.add_record(self.password_mode)
 
     def allow_local_connections(self):
         record = PgHbaRecord('host', 'all', 'all', address='127.0.0.1/32', auth_method = 'md5')
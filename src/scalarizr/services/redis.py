@@ -6,9 +6,17 @@ Created on Aug 10, 2011
 '''
 
 import os
+import re
+import sys
 import signal
+import socket
+import select
 import logging
 import shutil
+import threading
+import contextlib
+
+from multiprocessing.pool import ThreadPool
 
 from scalarizr import storage2, node
 from scalarizr.util import initdv2, system2, PopenError, wait_until, Singleton
@@ -66,6 +74,9 @@ __redis__.update({
 SERVICE_NAME = 'redis'
 LOG = logging.getLogger(__name__)
 
+# Number of redis instances RedisInstances operates on simultaneously
+MAX_CONCURRENCY = 4
+
 
 class RedisInitScript(initdv2.ParametrizedInitScript):
     socket_file = None
@@ -199,7 +210,13 @@ class Redisd(object):
 
     @property
     def running(self):
-        for config_path in get_redis_processes():
+        return self.running_in(get_redis_processes())
+
+    def running_in(self, config_files):
+        """
+        :param config_files: get_redis_processes() result
+        """
+        for config_path in config_files:
             is_default_conf = config_path == __redis__['defaults']['redis.conf']
             is_default_port = int(self.port) == __redis__['defaults']['port']
             if (config_path == self.config_path) or (is_default_conf and is_default_port):
@@ -211,14 +228,9 @@ class Redisd(object):
         """
         Redis 2.8 seems to be unable to shutdown when it has child processes running
         """
-        try:
-            out = system2(('ps', '-G', 'redis', '-o', 'command', '--no-headers'))[0]
-        except:
-            out = ''
-        if out:
-            for line in out.split('\n'):
-                if "redis-aof-rewrite" in line and str(self.port) in line:
-                    return True
+        for line in _ps_redis():
+            if "redis-aof-rewrite" in line and str(self.port) in line:
+                return True
         return False
 
     @property
@@ -240,15 +252,63 @@ class Redisd(object):
         return pid
 
 
+class RedisInstancesError(ServiceError):
+
+    """
+    Operation failed on some of redis instances.
+    errors: {port: exc_info}
+    """
+
+    def __init__(self, operation, errors):
+        self.operation = operation
+        self.errors = errors
+        msg = '%s failed on %d redis instance(s): %s' % (operation, len(errors),
+                '; '.join('%s: %s' % (port, exc_info[1]) for port, exc_info in sorted(errors.items())))
+        super(RedisInstancesError, self).__init__(msg)
+
+
 class RedisInstances(object):
 
     __metaclass__ = Singleton
 
     instances = None
+    concurrency = MAX_CONCURRENCY
 
     def __init__(self):
         self.instances = []
 
+    def _map(self, operation, fn, instances=None):
+        """
+        Call fn(instance) in up to self.concurrency threads.
+        Failed instance doesn't stop others, errors are raised together afterwards
+
+        :returns: results in instances order
+        :raises RedisInstancesError:
+        """
+        instances = self.instances if instances is None else instances
+        errors = {}
+
+        def call(instance):
+            try:
+                return fn(instance)
+            except:
+                errors[instance.port] = sys.exc_info()
+                LOG.error('Redis %s on port %s failed: %s', operation, instance.port, sys.exc_info()[1])
+
+        if self.concurrency > 1 and len(instances) > 1:
+            pool = ThreadPool(min(self.concurrency, len(instances)))
+            try:
+                results = pool.map(call, instances, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(call, instances)
+
+        if errors:
+            raise RedisInstancesError(operation, errors)
+        return results
+
     @property
     def ports(self):
         return [instance.port for instance in self.instances]
@@ -314,56 +374,55 @@ class RedisInstances(object):
         LOG.debug('Total of redis processes: %d' % len(self.instances))
 
     def kill_processes(self, ports=[], remove_data=False):
-        for instance in self.instances:
-            if instance.port in ports:
-                instance.service.stop()
-                if remove_data and instance.db_path and os.path.exists(instance.db_path):
-                    os.remove(instance.db_path)
-                self.instances.remove(instance)
+        def kill(instance):
+            instance.service.stop()
+            if remove_data and instance.db_path and os.path.exists(instance.db_path):
+                os.remove(instance.db_path)
+
+        instances = [instance for instance in self.instances if instance.port in ports]
+        failed = {}
+        try:
+            self._map('stop', kill, instances)
+        except RedisInstancesError, e:
+            failed = e.errors
+            raise
+        finally:
+            for instance in instances:
+                if instance.port not in failed:
+                    self.instances.remove(instance)
 
     def start(self):
-        for redis in self.instances:
-            redis.service.start()
+        self._map('start', lambda redis: redis.service.start())
 
     def stop(self, reason = None):
-        for redis in self.instances:
-            redis.service.stop(reason)
+        self._map('stop', lambda redis: redis.service.stop(reason))
 
     def restart(self, reason = None):
-        for redis in self.instances:
-            redis.service.restart(reason)
+        self._map('restart', lambda redis: redis.service.restart(reason))
 
     def reload(self, reason = None):
-        for redis in self.instances:
-            redis.service.reload(reason)
+        self._map('reload', lambda redis: redis.service.reload(reason))
 
     def save_all(self):
-        for redis in self.instances:
-            if redis.service.running:
-                redis.redis_cli.save()
+        # Single ps call for all instances
+        config_files = get_redis_processes()
+        running = [redis for redis in self.instances if redis.service.running_in(config_files)]
+        self._map('save', lambda redis: redis.redis_cli.save(), running)
 
     def init_as_masters(self, mpoint):
-        passwords = []
-        ports = []
-        for redis in self.instances:
-            redis.init_master(mpoint)
-            passwords.append(redis.password)
-            ports.append(redis.port)
-        return ports, passwords
+        # Shared by all instances, prepare it once before they run concurrently
+        prepare_mpoint(mpoint)
+        self._map('init master', lambda redis: redis.init_master(mpoint, mpoint_ready=True))
+        return self.ports, self.passwords
 
     def init_as_slaves(self, mpoint, primary_ip):
-        passwords = []
-        ports = []
-        for redis in self.instances:
-            passwords.append(redis.password)
-            ports.append(redis.port)
-            redis.init_slave(mpoint, primary_ip, redis.port)
-        return ports, passwords
+        prepare_mpoint(mpoint)
+        self._map('init slave',
+                lambda redis: redis.init_slave(mpoint, primary_ip, redis.port, mpoint_ready=True))
+        return self.ports, self.passwords
 
     def wait_for_sync(self, link_timeout=None, sync_timeout=None):
-        #consider using threads
-        for redis in self.instances:
-            redis.wait_for_sync(link_timeout, sync_timeout)
+        self._map('sync', lambda redis: redis.wait_for_sync(link_timeout, sync_timeout))
 
 
 class Redis(BaseService):
@@ -377,17 +436,17 @@ class Redis(BaseService):
         self.port = port
         self.password = password
 
-    def init_master(self, mpoint):
+    def init_master(self, mpoint, mpoint_ready=False):
         self.service.stop('Configuring master. Moving Redis db files')
-        self.init_service(mpoint)
+        self.init_service(mpoint, mpoint_ready)
         self.redis_conf.masterauth = None
         self.redis_conf.slaveof = None
         self.service.start()
         return self.current_password
 
-    def init_slave(self, mpoint, primary_ip, primary_port):
+    def init_slave(self, mpoint, primary_ip, primary_port, mpoint_ready=False):
         self.service.stop('Configuring slave')
-        self.init_service(mpoint)
+        self.init_service(mpoint, mpoint_ready)
         self.change_primary(primary_ip, primary_port)
         self.service.start()
         return self.current_password
@@ -419,12 +478,12 @@ class Redis(BaseService):
         self.redis_conf.masterauth = self.password
         self.redis_conf.slaveof = (primary_ip, primary_port)
 
-    def init_service(self, mpoint):
-        if not os.path.exists(mpoint):
-            os.makedirs(mpoint)
-            LOG.debug('Created directory structure for redis db files: %s' % mpoint)
-
-        chown_r(mpoint, __redis__['defaults']['user'])
+    def init_service(self, mpoint, mpoint_ready=False):
+        """
+        :param mpoint_ready: mpoint is already created and owned by redis user
+        """
+        if not mpoint_ready:
+            prepare_mpoint(mpoint)
 
         self.redis_conf.requirepass = self.password
         self.redis_conf.daemonize = True
@@ -704,11 +763,154 @@ class RedisConf(BaseRedisConfig):
     port_default = __redis__['defaults']['port']
 
 
+class RedisResponseError(Exception):
+    pass
+
+
+class RedisConnection(object):
+    """
+    Minimal RESP client: one persistent authenticated socket per redis instance.
+    Commands passed to pipeline() are sent in a single write,
+    replies are read back in the same order
+    """
+
+    timeout = 30
+
+    def __init__(self, port, password=None, host='127.0.0.1'):
+        self.port = int(port)
+        self.password = password
+        self.host = host
+        self._sock = None
+        self._fp = None
+        self._lock = threading.RLock()
+
+
+    def connect(self):
+        self.close()
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock, self._fp = sock, sock.makefile('rb')
+        if self.password:
+            try:
+                self._roundtrip([('AUTH', self.password)], True)
+            except RedisResponseError, e:
+                #fix for redis 2.4 AUTH
+                if 'no password is set' not in str(e):
+                    self.close()
+                    raise
+
+
+    def close(self):
+        if self._sock:
+            try:
+                self._fp.close()
+                self._sock.close()
+            except socket.error:
+                pass
+        self._sock = self._fp = None
+
+
+    def pipeline(self, commands, raise_on_error=True):
+        """
+        :type commands: list
+        :param commands: list of argument tuples, e.g. [('CONFIG', 'GET', 'dir'), ('INFO',)]
+
+        :returns: list of replies. Error replies are RedisResponseError instances,
+            first of them is raised when raise_on_error is True
+        """
+        with self._lock:
+            if self._sock is not None and self._dropped():
+                # Server closed idle connection (timeout, restart)
+                self.close()
+            if self._sock is None:
+                self.connect()
+            try:
+                return self._roundtrip(commands, raise_on_error)
+            except (socket.error, EOFError):
+                # Commands could reach the server, never resend them
+                self.close()
+                raise
+
+
+    def _dropped(self):
+        # Nothing is expected on idle connection, readable socket means EOF or reset
+        try:
+            return bool(select.select([self._sock], [], [], 0)[0])
+        except (select.error, socket.error):
+            return True
+
+
+    def call(self, *args):
+        return self.pipeline([args])[0]
+
+
+    def _roundtrip(self, commands, raise_on_error):
+        self._sock.sendall(''.join(map(self._pack, commands)))
+        replies = [self._read_reply() for _ in commands]
+        if raise_on_error:
+            for reply in replies:
+                if isinstance(reply, RedisResponseError):
+                    raise reply
+        return replies
+
+
+    def _pack(self, args):
+        out = ['*%d\r\n' % len(args)]
+        for arg in args:
+            if isinstance(arg, unicode):
+                arg = arg.encode('utf-8')
+            else:
+                arg = str(arg)
+            out.append('$%d\r\n%s\r\n' % (len(arg), arg))
+        return ''.join(out)
+
+
+    def _read_reply(self):
+        line = self._fp.readline()
+        if not line.endswith('\r\n'):
+            raise EOFError('Connection to redis on port %s closed' % self.port)
+        prefix, rest = line[0], line[1:-2]
+        if prefix == '+':
+            return rest
+        elif prefix == '-':
+            return RedisResponseError(rest)
+        elif prefix == ':':
+            return int(rest)
+        elif prefix == '$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self._fp.read(length + 2)
+            if len(data) != length + 2:
+                raise EOFError('Connection to redis on port %s closed' % self.port)
+            return data[:-2]
+        elif prefix == '*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in xrange(length)]
+        raise RedisResponseError('Unknown reply type: %r' % line)
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(port, password=None):
+    """
+    Shared RedisConnection for redis instance on port
+    """
+    key = (int(port), password)
+    with _connections_lock:
+        if key not in _connections:
+            _connections[key] = RedisConnection(port, password)
+        return _connections[key]
+
+
 class RedisCLI(object):
 
     port = None
     password = None
-    path = __redis__['redis-cli']
 
 
     class no_keyerror_dict(dict):
@@ -722,9 +924,7 @@ class RedisCLI(object):
     def __init__(self, password=None, port=__redis__['defaults']['port']):
         self.port = port
         self.password = password
-
-        if not os.path.exists(self.path):
-            raise OSError('redis-cli not found')
+        self._local = threading.local()
 
 
     @classmethod
@@ -732,45 +932,91 @@ class RedisCLI(object):
         return cls(redis_conf.requirepass, port=redis_conf.port)
 
 
-    def execute(self, query, silent=False):
-        if not self.password:
-            full_query = query
-        else:
-            full_query = 'AUTH %s\n%s' % (self.password, query)
+    @property
+    def connection(self):
+        return get_connection(self.port, self.password)
 
-        execute_query = lambda: system2([self.path, '-p', self.port], stdin=full_query,silent=True, warn_stderr=False)
-        try:
-            out = execute_query()[0]
 
-            #fix for redis 2.4 AUTH
-            if 'Client sent AUTH, but no password is set' in out:
-                execute_query = lambda: system2([self.path], stdin=query, silent=True)
-                out = execute_query()[0]
+    def _format(self, reply):
+        # Mimic redis-cli output
+        if reply is None or reply == 'OK':
+            return ''
+        if isinstance(reply, list):
+            return '\n'.join(map(self._format, reply))
+        return str(reply)
 
-            if "Redis is loading the dataset in memory" in out:
+
+    def pipeline(self, commands, silent=False):
+        """
+        Execute several commands in one round trip
+
+        :type commands: list
+        :param commands: list of argument tuples, e.g. [('BGSAVE',), ('INFO',)]
+
+        :returns: list of raw replies
+        """
+        try:
+            try:
+                return self.connection.pipeline(commands)
+            except RedisResponseError, e:
+                if not str(e).startswith('LOADING'):
+                    raise
                 #[SCALARIZR-1604]
                 #test until service becomes available:
-                wait_until(lambda: "LOADING" not in system2([self.path], stdin='ping', silent=True)[0])
+                wait_until(self._ping_loaded)
                 #run query again:
-                out = execute_query()[0]
+                return self.connection.pipeline(commands)
+        except (RedisResponseError, socket.error, EOFError), e:
+            if not silent:
+                LOG.error('Unable to execute %s on redis port %s: %s', 
+                        ' '.join(map(str, commands[0])), self.port, e)
+            raise PopenError(str(e))
 
-            elif out.startswith('ERR'):
-                raise PopenError(out)
 
-            elif out.startswith('OK\n'):
-                out = out[3:]
-            if out.endswith('\n'):
-                out = out[:-1]
-            return out
-        except PopenError, e:
-            if not silent:
-                LOG.error('Unable to execute query %s with redis-cli: %s' % (query, e))
+    def _ping_loaded(self):
+        try:
+            self.connection.call('PING')
+            return True
+        except RedisResponseError, e:
+            if str(e).startswith('LOADING'):
+                return False
             raise
 
 
+    def execute(self, args, silent=False):
+        """
+        Execute one command, output is formatted like redis-cli does
+
+        :type args: list
+        :param args: command and its arguments, e.g. ['CONFIG', 'GET', 'dir']
+        """
+        reply = self.pipeline([tuple(args)], silent=silent)[0]
+        return self._format(reply)
+
+
+    @contextlib.contextmanager
+    def cached_info(self):
+        """
+        Serve INFO based properties inside the block from a single INFO reply:
+
+            with cli.cached_info():
+                if cli.role == 'slave' and cli.master_link_status == 'up': ...
+        """
+        if hasattr(self._local, 'info'):
+            yield
+            return
+        self._local.info = None
+        try:
+            yield
+        finally:
+            del self._local.info
+
+
     @property
     def info(self):
-        info = self.execute('info')
+        if getattr(self._local, 'info', None) is not None:
+            return self._local.info
+        info = self.execute(['INFO'])
         LOG.debug('Redis INFO: %s' % info)
         d = self.no_keyerror_dict()
         if info:
@@ -782,6 +1028,8 @@ class RedisCLI(object):
                         key, val = kv
                         if key:
                             d[key] = val
+        if hasattr(self._local, 'info'):
+            self._local.info = d
         return d
 
 
@@ -849,23 +1097,38 @@ class RedisCLI(object):
         return None
 
 
+    def _in_progress(self, command):
+        return getattr(self, '%s_in_progress' % command.lower())
+
+
+    def _start_background(self, command):
+        if not self._in_progress(command):
+            self.execute([command])
+
+
+    def _wait_background(self, command):
+        wait_until(lambda: not self._in_progress(command), sleep=5, timeout=900)
+
+
     def bgsave(self, wait_until_complete=True):
-        if not self.bgsave_in_progress:
-            self.execute('bgsave')
+        self._start_background('BGSAVE')
         if wait_until_complete:
-            wait_until(lambda: not self.bgsave_in_progress, sleep=5, timeout=900)
+            self._wait_background('BGSAVE')
 
 
     def bgrewriteaof(self, wait_until_complete=True):
-        if not self.bgrewriteaof_in_progress:
-            self.execute('bgrewriteaof')
+        self._start_background('BGREWRITEAOF')
         if wait_until_complete:
-            wait_until(lambda: not self.bgrewriteaof_in_progress, sleep=5, timeout=900)
+            self._wait_background('BGREWRITEAOF')
 
 
     def save(self):
         LOG.info('Flushing redis data to disk (cli on port %s)', self.port)
-        self.bgrewriteaof() if self.aof_enabled else self.bgsave()
+        # aof_enabled and *_in_progress checks are served by one INFO reply
+        with self.cached_info():
+            command = 'BGREWRITEAOF' if self.aof_enabled else 'BGSAVE'
+            self._start_background(command)
+        self._wait_background(command)
 
 
     @property
@@ -944,6 +1207,16 @@ backup.backup_types['snap_redis'] = RedisSnapBackup
 backup.restore_types['snap_redis'] = RedisSnapRestore
 
 
+def prepare_mpoint(mpoint):
+    """
+    Create redis db files directory and give it to redis user
+    """
+    if not os.path.exists(mpoint):
+        os.makedirs(mpoint)
+        LOG.debug('Created directory structure for redis db files: %s' % mpoint)
+    chown_r(mpoint, __redis__['defaults']['user'])
+
+
 def get_snap_db_filename(port=__redis__['defaults']['port']):
     return 'dump.%s.rdb' % port
 
@@ -994,46 +1267,54 @@ def create_redis_conf_copy(port=__redis__['defaults']['port']):
         LOG.debug('%s already exists.' % dst)
 
 
-def get_redis_processes():
-    config_files = list()
+def _ps_redis():
+    """
+    Command lines of processes running under redis group
+    """
     try:
-        out = system2(('ps', '-G', 'redis', '-o', 'command', '--no-headers'))[0]
+        out = system2(('ps', '-G', 'redis', '-o', 'command', '--no-headers'), silent=True)[0]
     except:
         out = ''
-    if out:
-        for line in out.split('\n'):
-            words = line.split()
-            if len(words) == 2 and words[0] == __redis__['redis-server']:
-                if words[1].startswith("*:"):  # XXX: 2.8 support
-                    config_files.append(get_redis_conf_path(words[1][2:]))
-                else:
-                    config_files.append(words[1])
+    return [line for line in out.split('\n') if line]
+
+
+def get_redis_processes():
+    config_files = list()
+    for line in _ps_redis():
+        words = line.split()
+        if len(words) == 2 and words[0] == __redis__['redis-server']:
+            if words[1].startswith("*:"):  # XXX: 2.8 support
+                config_files.append(get_redis_conf_path(words[1][2:]))
+            else:
+                config_files.append(words[1])
     return config_files
 
 
 def get_busy_ports():
-    busy_ports = []
-    args = ('ps', '-G', 'redis', '-o', 'command', '--no-headers')
-    try:
-        out = system2(args, silent=True)[0].split('\n')
-        p = [x for x in out if x and __redis__['redis-server'] in x]
-    except PopenError,e:
-        p = []
-    LOG.debug('Running redis processes: %s' % p)
-    for redis_process in p:
-        for port in __redis__['ports_range']:
-            conf_name = get_redis_conf_basename(port)
-            if conf_name in redis_process or str(port) in redis_process:
-                busy_ports.append(port)
+    """
+    Ports from __redis__['ports_range'] taken by running redis-server processes,
+    all candidates are checked in one pass over ps output
+    """
+    candidates = set(__redis__['ports_range'])
+    busy_ports = set()
+    processes = [line for line in _ps_redis() if __redis__['redis-server'] in line]
+    LOG.debug('Running redis processes: %s' % processes)
+    for line in processes:
+        if __redis__['defaults']['redis.conf'] in line:
+            busy_ports.add(__redis__['defaults']['port'])
+            continue
+        # redis.6380.conf or *:6380 (2.8)
+        for port in map(int, re.findall(r'\d+', line)):
+            if port in candidates:
+                busy_ports.add(port)
                 break
-            elif __redis__['defaults']['port'] == port and __redis__['defaults']['redis.conf'] in redis_process:
-                busy_ports.append(port)
+    busy_ports = sorted(busy_ports)
     LOG.debug('busy_ports: %s' % busy_ports)
     return busy_ports
 
 
 def get_available_ports():
-    busy_ports = get_busy_ports()
+    busy_ports = set(get_busy_ports())
     available = [port for port in __redis__['ports_range'] if port not in busy_ports]
     LOG.debug("Available ports: %s" % available)
     return available
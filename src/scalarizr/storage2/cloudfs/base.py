@@ -100,6 +100,33 @@ class CloudFileSystem(object):
     def _format_url(self, bucket, key):
         return '%s://%s/%s' % (self.schema, bucket, key)
 
+    def _open_source(self, src):
+        '''
+        put() accepts either local file path or seekable file-like object
+        (e.g. largetransfer.ChunkBuffer). File-like objects are rewound,
+        so put() retries start from the beginning
+        '''
+        if hasattr(src, 'read'):
+            src.seek(0)
+            return src
+        return open(src, 'rb')
+
+    def _source_name(self, src):
+        return os.path.basename(getattr(src, 'name', src))
+
+    def _destination(self, dst, url):
+        '''
+        get() accepts either local directory or writable file-like object
+        (e.g. largetransfer.ChunkBuffer). File-like objects are truncated,
+        so get() retries start from scratch
+
+        :returns: local file path or dst itself
+        '''
+        if hasattr(dst, 'write'):
+            dst.truncate()
+            return dst
+        return os.path.join(dst, os.path.basename(url))
+
     def exists(self, url):
         parent = os.path.dirname(url.rstrip('/'))
         # NOTE: s3 & gcs driver converts bucket names to lowercase while url
@@ -56,12 +56,12 @@ class GCSFileSystem(CloudFileSystem):
     def get(self, remote_path, local_path, report_to=None):
         LOG.debug('Downloading %s from cloud storage (local path: %s)', remote_path, local_path)
         bucket, name = self._parse_url(remote_path)
-        local_path = os.path.join(local_path, os.path.basename(remote_path))
+        local_path = self._destination(local_path, remote_path)
 
         request = self.cloudstorage.objects().get_media(
                 bucket=bucket, object=name)
 
-        f = open(local_path, 'w')
+        f = local_path if hasattr(local_path, 'write') else open(local_path, 'w')
         try:
             media = MediaIoBaseDownload(f, request, chunksize=self.chunk_size)
 
@@ -78,13 +78,13 @@ class GCSFileSystem(CloudFileSystem):
         finally:
             f.close()
 
-        LOG.debug("Finished downloading %s", os.path.basename(local_path))
+        LOG.debug("Finished downloading %s", os.path.basename(remote_path))
         return local_path
 
 
     def put(self, local_path, remote_path, report_to=None):
         LOG.debug('Uploading %s to cloud storage (remote path: %s)', local_path, remote_path)
-        filename = os.path.basename(local_path)
+        filename = self._source_name(local_path)
         bucket, name = self._parse_url(remote_path)
         if name.endswith("/"):
             name = os.path.join(name, filename)
@@ -93,7 +93,7 @@ class GCSFileSystem(CloudFileSystem):
         if bucket not in buckets:
             self._create_bucket(bucket)
 
-        fd = open(local_path, 'rb')
+        fd = self._open_source(local_path)
         try:
             media = MediaIoBaseUpload(fd,
                     'application/octet-stream',
@@ -125,7 +125,7 @@ class GCSFileSystem(CloudFileSystem):
                     time.sleep(sec_to_wait)
         finally:
             fd.close()
-        LOG.debug("Finished uploading %s", os.path.basename(local_path))
+        LOG.debug("Finished uploading %s", filename)
         return self._format_url(bucket, name)
 
 
@@ -1,3 +1,4 @@
+from __future__ import with_statement
 import logging
 import os
 import shutil
@@ -55,19 +56,26 @@ class LocalFileSystem(CloudFileSystem):
             if e.errno != 17:  # 17: already exists
                 raise
 
-        shutil.copy(src, path)
-
-        res = path
-        if res.endswith("/"):
-            res = os.path.join(res, os.path.basename(src))
-        return self._format_url(res)
+        if path.endswith("/"):
+            path = os.path.join(path, self._source_name(src))
+        if hasattr(src, 'read'):
+            fsrc = self._open_source(src)
+            with open(path, 'wb') as fdst:
+                shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        else:
+            shutil.copy(src, path)
+        return self._format_url(path)
 
     def get(self, url, dst, report_to=None):
         path = self._parse_url(url)
-        dst = os.path.join(dst, os.path.basename(path))
+        dst = self._destination(dst, path)
 
         LOG.debug("Downloading from '%s' to '%s'", path, dst)
-        shutil.copy(path, dst)
+        if hasattr(dst, 'write'):
+            with open(path, 'rb') as fsrc:
+                shutil.copyfileobj(fsrc, dst, 1024 * 1024)
+        else:
+            shutil.copy(path, dst)
         return dst
 
     def delete(self, url):
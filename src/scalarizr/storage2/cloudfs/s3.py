@@ -54,7 +54,7 @@ class S3FileSystem(CloudFileSystem):
         LOG.info("Uploading '%s' to S3 under '%s'", local_path, remote_path)
         bucket_name, key_name = self._parse_url(remote_path)
         if key_name.endswith("/"):
-            key_name = os.path.join(key_name, os.path.basename(local_path))
+            key_name = os.path.join(key_name, self._source_name(local_path))
         LOG.debug("Uploading '%s'", key_name)
 
         try:
@@ -79,11 +79,11 @@ class S3FileSystem(CloudFileSystem):
             try:
                 key = Key(self._bucket)
                 key.name = key_name
-                file_ = open(local_path, "rb")
-                LOG.debug("Actually uploading %s", os.path.basename(local_path))
+                file_ = self._open_source(local_path)
+                LOG.debug("Actually uploading %s", self._source_name(local_path))
                 key.set_contents_from_file(file_, policy=self.acl,
                         cb=report_to, num_cb=self.report_frequency)
-                LOG.debug("Finished uploading %s", os.path.basename(local_path))
+                LOG.debug("Finished uploading %s", self._source_name(local_path))
                 return self._format_url(bucket_name, key_name)
             finally:
                 if file_:
@@ -97,7 +97,7 @@ class S3FileSystem(CloudFileSystem):
     def get(self, remote_path, local_path, report_to=None):
         LOG.info('Downloading %s from S3 to %s', remote_path, local_path)
         bucket_name, key_name = self._parse_url(remote_path)
-        dest_path = os.path.join(local_path, os.path.basename(remote_path))
+        dest_path = self._destination(local_path, remote_path)
 
         connection = self._get_connection()
 
@@ -106,10 +106,14 @@ class S3FileSystem(CloudFileSystem):
         key = self._bucket.get_key(key_name)
         assert key, "No such key: %s" % key_name
 
-        LOG.debug("Actually downloading %s", os.path.basename(dest_path))
-        key.get_contents_to_filename(dest_path, cb=report_to,
-                num_cb=self.report_frequency)
-        LOG.debug("Finished downloading %s", os.path.basename(dest_path))
+        LOG.debug("Actually downloading %s", os.path.basename(remote_path))
+        if hasattr(dest_path, 'write'):
+            key.get_contents_to_file(dest_path, cb=report_to,
+                    num_cb=self.report_frequency)
+        else:
+            key.get_contents_to_filename(dest_path, cb=report_to,
+                    num_cb=self.report_frequency)
+        LOG.debug("Finished downloading %s", os.path.basename(remote_path))
         return dest_path
 
     def delete(self, remote_path):
@@ -39,9 +39,9 @@ class SwiftFileSystem(CloudFileSystem):
         LOG.info("Uploading '%s' to Swift under '%s'", local_path, remote_path)
         container, object_ = self._parse_url(remote_path)
         if object_.endswith("/"):
-            object_ = os.path.join(object_, os.path.basename(local_path))
+            object_ = os.path.join(object_, self._source_name(local_path))
 
-        fd = open(local_path, 'rb')
+        fd = self._open_source(local_path)
         try:
             conn = self._get_connection()
             try:
@@ -63,9 +63,9 @@ class SwiftFileSystem(CloudFileSystem):
         LOG.info('Downloading %s from Swift to %s', remote_path, local_path)
         container, object_ = self._parse_url(remote_path)
         #? join only if local_path.endswith("/")
-        dest_path = os.path.join(local_path, os.path.basename(remote_path))
+        dest_path = self._destination(local_path, remote_path)
 
-        fd = open(dest_path, 'w')
+        fd = dest_path if hasattr(dest_path, 'write') else open(dest_path, 'w')
         try:
             conn = self._get_connection()
             res = conn.get_object(container, object_)
@@ -1,6 +1,7 @@
 import os
 import re
 import sys
+import mmap
 import time
 import uuid
 import Queue
@@ -9,6 +10,8 @@ import bisect
 import signal
 import thread
 import logging
+import functools
+import collections
 import hashlib
 import tempfile
 import urlparse
@@ -35,6 +38,7 @@ DEFAULT_CALLBACK_INTERVAL = 2
 DEFAULT_CHUNK_SIZE = 100
 DEFAULT_SLEEP_TIME = 0.1
 DEFAULT_RETRY_NUMBER = 3
+DEFAULT_READ_BUFFER_SIZE = 4
 
 
 def raise_thread_error():
@@ -83,6 +87,125 @@ class FileInfo(object):
                 self.md5_sum = cryptotool.calculate_md5_sum(path)
 
 
+class ChunkBuffer(object):
+
+    """
+    Reusable in-memory (anonymous mmap) chunk storage.
+    Quacks like FileInfo for _Transfer and like a seekable file for cloudfs drivers:
+    put() reads it, get() truncates and writes it. md5 sum is calculated on write
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.name = self.path = None
+        self.size = 0
+        self._pos = 0
+        self._md5 = hashlib.md5()
+        self._mmap = mmap.mmap(-1, capacity)
+
+    def __repr__(self):
+        return '<ChunkBuffer %s size=%s>' % (self.name, self.size)
+
+    @property
+    def md5_sum(self):
+        return self._md5.hexdigest()
+
+    def fill(self, stream, name, buf=None):
+        """
+        Read up to capacity bytes from stream, calculating md5 sum in the same pass
+
+        :type buf: bytearray
+        :param buf: reusable read buffer
+
+        :returns: True on stream EOF
+        """
+        self.name = self.path = name
+        self.truncate()
+        for data in util.read_blocks(stream, buf, limit=self.capacity):
+            self.write(data)
+        self._pos = 0
+        return self.size < self.capacity
+
+    def truncate(self, size=0):
+        assert size == 0, 'ChunkBuffer can be truncated only to zero size'
+        self._mmap.seek(0)
+        self._md5 = hashlib.md5()
+        self.size = self._pos = 0
+
+    def write(self, data):
+        # Append only, drivers write downloaded data sequentially
+        if self.size + len(data) > self.capacity:
+            raise ValueError('%r overflow, capacity: %s' % (self, self.capacity))
+        self._mmap.write(data)
+        self._md5.update(data)
+        self.size += len(data)
+        self._pos = self.size
+
+    def flush(self):
+        pass
+
+    def write_to(self, stream, block_size=None):
+        """
+        Write buffer content to stream without copying it to a string
+        """
+        block_size = block_size or util.DEFAULT_READ_BUFFER_SIZE
+        for offset in xrange(0, self.size, block_size):
+            stream.write(buffer(self._mmap, offset, min(block_size, self.size - offset)))
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self._pos + size, self.size)
+        if end <= self._pos:
+            return ''
+        data = self._mmap[self._pos:end]
+        self._pos = end
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = max(0, min(offset, self.size))
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        # Buffer is owned by ChunkBufferPool, drivers may call close() after transfer
+        pass
+
+    def free(self):
+        self._mmap.close()
+
+
+class ChunkBufferPool(object):
+
+    """
+    Fixed set of ChunkBuffers. get() blocks until some buffer is released,
+    which bounds memory used by streaming transfer and throttles the reader
+    """
+
+    def __init__(self, count, capacity):
+        self._buffers = [ChunkBuffer(capacity) for _ in xrange(count)]
+        self._free = Queue.Queue()
+        for buf in self._buffers:
+            self._free.put(buf)
+
+    def get(self, block=True):
+        """
+        :raises Queue.Empty: when block is False and all buffers are in use
+        """
+        # Timeout keeps wait interruptable by SIGINT (see Transfer.stop)
+        return self._free.get(block, sys.maxint)
+
+    def release(self, buf):
+        self._free.put(buf)
+
+    def close(self):
+        map(ChunkBuffer.free, self._buffers)
+        self._buffers = []
+
+
 class NonBlockingLifoQueue(Queue.LifoQueue):
 
     """
@@ -164,7 +287,8 @@ class _Transfer(object):
             'size': src.size,
             'md5_sum': src.md5_sum,
             'fn': getattr(driver, self.method),
-            'args': (src.path, dst),
+            # ChunkBuffer is passed to driver as is
+            'args': (src if hasattr(src, 'read') else src.path, dst),
             'kwds': {'report_to': progress_cb},
             'retry': 0,
             'status': 'submitted',
@@ -421,7 +545,8 @@ class Upload(Transfer):
 
     def __init__(self, src, dst, transfer_id=None, manifest='manifest.json', description='', tags='',
                  gzip=True, use_pigz=True, simple=False, pool_size=None,
-                 chunk_size=None, progress_cb=None, cb_interval=None):
+                 chunk_size=None, progress_cb=None, cb_interval=None, streaming=False,
+                 read_buffer_size=None):
         """
         :type src: string / list / generator / iterator / NamedStream
         :param src: Transfer source, file path or stream
@@ -431,6 +556,14 @@ class Upload(Transfer):
 
         :type simple: bool
         :param simple: if True handle src as file path and don't use split and gzip
+
+        :type streaming: bool
+        :param streaming: upload chunks from pool_size + 1 in-memory buffers
+            instead of staging them in temporary directory.
+            Needs (pool_size + 1) * chunk_size MB of memory
+
+        :type read_buffer_size: int
+        :param read_buffer_size: source stream read size, MB
         """
         super(Upload, self).__init__(pool_size=pool_size, progress_cb=progress_cb,
                                      cb_interval=cb_interval)
@@ -444,6 +577,8 @@ class Upload(Transfer):
         self.use_pigz = use_pigz
 
         self._simple = simple
+        self._streaming = streaming
+        self._read_buffer_size = read_buffer_size or DEFAULT_READ_BUFFER_SIZE
         self._chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
         self._manifest = None
         self._manifest_queue = None
@@ -488,8 +623,48 @@ class Upload(Transfer):
             uploader.stop(wait=False)
             raise
 
+    def _upload_chunks(self, uploader, stream, extension, uploaded_chunks):
+        file_generator = split(stream, self._tmp_dir,
+                               chunk_size=self._chunk_size, extension=extension,
+                               read_buffer_size=self._read_buffer_size)
+
+        def on_chunk_complete(info):
+            self._on_file_complete(info)
+            if info['status'] == 'done':
+                data = (os.path.basename(info['src']), info['md5_sum'], info['size'])
+                bisect.insort(uploaded_chunks, data)
+            os.remove(info['src'])
+
+        for file_info in file_generator:
+            dst = os.path.join(self.dst, file_info.name)
+            uploader.apply_async(file_info, dst,
+                                 complete_cb=on_chunk_complete,
+                                 progress_cb=self._on_progress)
+            while not self._semaphore.acquire(False):
+                time.sleep(DEFAULT_SLEEP_TIME)
+
+    def _stream_chunks(self, uploader, stream, extension, uploaded_chunks, buffers):
+        def on_chunk_complete(info):
+            buf = info['src']
+            try:
+                self._on_file_complete(info)
+                if info['status'] == 'done':
+                    bisect.insort(uploaded_chunks, (buf.name, buf.md5_sum, buf.size))
+            finally:
+                buffers.release(buf)
+
+        for buf in split_to_buffers(stream, buffers, extension=extension,
+                                    read_buffer_size=self._read_buffer_size):
+            dst = os.path.join(self.dst, buf.name)
+            uploader.apply_async(buf, dst,
+                                 complete_cb=on_chunk_complete,
+                                 progress_cb=self._on_progress)
+
     def _large_upload(self):
         uploader = _Transfer('put', pool_size=self._pool_size)
+        buffers = None
+        if self._streaming:
+            buffers = ChunkBufferPool(self._pool_size + 1, self._chunk_size * 1024 * 1024)
         try:
             if self.gzip and self.use_pigz:
                 self._check_pigz()
@@ -524,8 +699,6 @@ class Upload(Transfer):
                         extension = 'gz'
                     stream = NamedStream(gzip_compressor(stream, self.use_pigz),
                                          stream.name, extension=extension, streamer=streamer)
-                file_generator = split(stream, self._tmp_dir,
-                                       chunk_size=self._chunk_size, extension=extension)
 
                 uploaded_chunks = []
 
@@ -538,20 +711,10 @@ class Upload(Transfer):
                 }
                 self._manifest['files'].append(file_info)
 
-                def on_chunk_complete(info):
-                    self._on_file_complete(info)
-                    if info['status'] == 'done':
-                        data = (os.path.basename(info['src']), info['md5_sum'], info['size'])
-                        bisect.insort(uploaded_chunks, data)
-                    os.remove(info['src'])
-
-                for file_info in file_generator:
-                    dst = os.path.join(self.dst, file_info.name)
-                    uploader.apply_async(file_info, dst,
-                                         complete_cb=on_chunk_complete,
-                                         progress_cb=self._on_progress)
-                    while not self._semaphore.acquire(False):
-                        time.sleep(DEFAULT_SLEEP_TIME)
+                if buffers:
+                    self._stream_chunks(uploader, stream, extension, uploaded_chunks, buffers)
+                else:
+                    self._upload_chunks(uploader, stream, extension, uploaded_chunks)
 
                 uploader.wait_completion()
 
@@ -578,6 +741,8 @@ class Upload(Transfer):
 
             uploader.wait_completion()
             uploader.stop()
+            if buffers:
+                buffers.close()
 
             self._manifest_queue.put(self._manifest)
         except:
@@ -601,10 +766,18 @@ class Upload(Transfer):
 class Download(Transfer):
 
     def __init__(self, src, dst=None, simple=False, use_pigz=True, pool_size=None,
-                 progress_cb=None, cb_interval=None):
+                 progress_cb=None, cb_interval=None, read_buffer_size=None, streaming=False):
         """
         :type src: string
         :param src: manifest file url
+
+        :type read_buffer_size: int
+        :param read_buffer_size: chunk files read size for md5 check and output, MB
+
+        :type streaming: bool
+        :param streaming: download chunks into pool_size + 1 in-memory buffers
+            and write them to output in order, without tmp dir.
+            Requires chunk sizes in manifest, otherwise tmp dir is used
         """
         super(Download, self).__init__(pool_size=pool_size, progress_cb=progress_cb,
                                        cb_interval=cb_interval)
@@ -621,6 +794,8 @@ class Download(Transfer):
         self.dst = dst
         self.use_pigz = use_pigz
         self.output = None
+        self._read_buffer_size = read_buffer_size or DEFAULT_READ_BUFFER_SIZE
+        self._streaming = streaming
 
     def apply_async(self):
         assert not self.running
@@ -652,6 +827,16 @@ class Download(Transfer):
             downloader.wait_completion()
             self._manifest.read(local_manifest_file)
 
+            if self._streaming:
+                if all(len(chunk_data) == 3
+                       for f in self._manifest['files'] for chunk_data in f['chunks']):
+                    for item in self._stream_chunks(downloader, os.path.dirname(self.src)):
+                        yield item
+                    downloader.wait_completion()
+                    downloader.stop()
+                    raise StopIteration
+                LOG.debug('Manifest has no chunk sizes, downloading chunks to tmp dir')
+
             # step 2
             # download chunks and yield them in right order
             yield_cntr = 0
@@ -661,7 +846,9 @@ class Download(Transfer):
             def on_chunk_complete(info):
                 self._on_file_complete(info)
                 if info['status'] == 'done':
-                    if cryptotool.calculate_md5_sum(info['result']) != info['md5_sum']:
+                    md5_sum = cryptotool.calculate_md5_sum(info['result'],
+                                                           self._read_buffer_size * 1024 * 1024)
+                    if md5_sum != info['md5_sum']:
                         raise MD5SumError('md5 sum mismatch', info)
                     priority = int(os.path.basename(info['src'])[-3:])
                     results[priority] = os.path.join(info['dst'], os.path.basename(info['src']))
@@ -699,6 +886,64 @@ class Download(Transfer):
             downloader.stop(wait=False)
             raise
 
+    def _stream_chunks(self, downloader, remote_dir):
+        """
+        Download chunks into ChunkBuffers and yield them in sorted order.
+        Buffer is released when consumer asks for the next chunk
+        """
+        capacity = max(chunk_data[2]
+                       for f in self._manifest['files'] for chunk_data in f['chunks'])
+        buffers = ChunkBufferPool(self._pool_size + 1, max(capacity, 1))
+
+        def on_chunk_complete(pending, info):
+            try:
+                self._on_file_complete(info)
+                if info['status'] == 'done' and info['dst'].md5_sum != info['md5_sum']:
+                    raise MD5SumError('md5 sum mismatch', info)
+            except:
+                pending['error'] = sys.exc_info()
+                raise
+            finally:
+                pending['event'].set()
+
+        def complete(pending):
+            # Timeout keeps wait interruptable by SIGINT
+            pending['event'].wait(sys.maxint)
+            if pending['error']:
+                raise pending['error'][0], pending['error'][1], pending['error'][2]
+            return pending['buf']
+
+        for f in self._manifest['files']:
+            queue = collections.deque()
+            for chunk_data in sorted(f['chunks']):
+                while True:
+                    try:
+                        buf = buffers.get(block=False)
+                        break
+                    except Queue.Empty:
+                        # All buffers are downloading or waiting for earlier chunk
+                        buf = complete(queue.popleft())
+                        yield buf, f['streamer'], f['compressor']
+                        buffers.release(buf)
+
+                chunk = FileInfo(os.path.join(remote_dir, chunk_data[0]),
+                                 md5_sum=chunk_data[1], size=chunk_data[2])
+                buf.name = buf.path = chunk_data[0]
+                pending = {'buf': buf, 'event': threading.Event(), 'error': None}
+                queue.append(pending)
+                downloader.apply_async(chunk, buf,
+                                       complete_cb=functools.partial(on_chunk_complete, pending),
+                                       progress_cb=self._on_progress)
+
+            while queue:
+                buf = complete(queue.popleft())
+                yield buf, f['streamer'], f['compressor']
+                buffers.release(buf)
+
+        # On error buffers are left to garbage collector:
+        # stopped workers may still write into them
+        buffers.close()
+
     def _simple_download(self):
         downloader = _Transfer('get', pool_size=1)
         try:
@@ -717,7 +962,7 @@ class Download(Transfer):
         stdout = os.fdopen(self._write_fd, 'wb')
         compressors = {}
 
-        for chunk_path, streamer, compressor in self._chunk_generator():
+        for chunk, streamer, compressor in self._chunk_generator():
             if compressor:
                 # create compressor if it dosn't exist
                 if compressor not in compressors:
@@ -740,8 +985,11 @@ class Download(Transfer):
             else:
                 stdin = stdout
 
-            util.write_file_to_stream(chunk_path, stdin)
-            os.remove(chunk_path)
+            if isinstance(chunk, ChunkBuffer):
+                chunk.write_to(stdin, self._read_buffer_size * 1024 * 1024)
+            else:
+                util.write_file_to_stream(chunk, stdin, self._read_buffer_size * 1024 * 1024)
+                os.remove(chunk)
 
         if stdin:
             stdin.close()
@@ -772,11 +1020,18 @@ def gzip_compressor(stream, use_pigz=True):
     return popen.stdout
 
 
-def split(stream, storage_dir, chunk_size=None, extension=None):
+def _read_buffer(read_buffer_size=None):
+    return bytearray((read_buffer_size or DEFAULT_READ_BUFFER_SIZE) * 1024 * 1024)
+
+
+def split(stream, storage_dir, chunk_size=None, extension=None, read_buffer_size=None):
     """
     Split incoming stream into chunks and save them on disk
+
+    :param read_buffer_size: stream is read by pieces of this size, MB
     """
     chunk_size = (chunk_size or DEFAULT_CHUNK_SIZE) * 1024 * 1024
+    buf = _read_buffer(read_buffer_size)
 
     if hasattr(stream, 'name'):
         name = os.path.basename(stream.name).strip('<>')
@@ -785,16 +1040,6 @@ def split(stream, storage_dir, chunk_size=None, extension=None):
     if extension:
         name += '.%s' % extension
 
-    def read_size():
-        while True:
-            size = 4096
-            for i in range(int(chunk_size / size)):
-                yield size
-            end = int(chunk_size - int(chunk_size / size) * size)
-            if end:
-                yield end
-            raise StopIteration
-
     chunk_idx = 0
 
     while True:
@@ -803,19 +1048,42 @@ def split(stream, storage_dir, chunk_size=None, extension=None):
 
         chunk_path = os.path.join(storage_dir, chunk_name)
 
-        eof = False
+        size = 0
         with open(chunk_path, 'wb') as f:
-            for size in read_size():
-                data = stream.read(size)
-                if not data:
-                    eof = True
-                    break
+            for data in util.read_blocks(stream, buf, limit=chunk_size):
                 f.write(data)
                 md5_sum.update(data)
+                size += len(data)
+        eof = size < chunk_size
 
-        file_info = FileInfo(chunk_path, md5_sum=md5_sum.hexdigest())
+        file_info = FileInfo(chunk_path, md5_sum=md5_sum.hexdigest(), size=size)
         yield file_info
         if eof:
             raise StopIteration
         else:
             chunk_idx += 1
+
+
+def split_to_buffers(stream, buffers, extension=None, read_buffer_size=None):
+    """
+    Split incoming stream into chunks held in ChunkBufferPool buffers.
+    Blocks while all buffers are in use
+    """
+    read_buf = _read_buffer(read_buffer_size)
+    if hasattr(stream, 'name'):
+        name = os.path.basename(stream.name).strip('<>')
+    else:
+        name = 'stream-%s' % hash(stream)
+    if extension:
+        name += '.%s' % extension
+
+    chunk_idx = 0
+
+    while True:
+        buf = buffers.get()
+        eof = buf.fill(stream, name + '.%03d' % chunk_idx, read_buf)
+        yield buf
+        if eof:
+            raise StopIteration
+        else:
+            chunk_idx += 1
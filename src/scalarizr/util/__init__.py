@@ -15,6 +15,12 @@ import pkgutil
 import traceback
 import platform
 import functools
+import tempfile
+import itertools
+try:
+    from collections import OrderedDict
+except ImportError:
+    from scalarizr.externals.collections import OrderedDict
 
 if sys.platform == 'win32':
     import win32com.client
@@ -22,6 +28,7 @@ if sys.platform == 'win32':
 
 from scalarizr.bus import bus
 from scalarizr import exceptions
+from scalarizr.util import metrics
 
 
 LOG = logging.getLogger(__name__)
@@ -95,6 +102,120 @@ class LocalPool(object):
         self._object = threading.local()
 
 
+class KeyedLocalPool(object):
+    '''
+    Keeps one connection per thread and key. Key is computed by key_fn on
+    every get() (e.g. from access data and region), when it changes thread's
+    connection is replaced, so rotated credentials are picked up without
+    explicit refresh. At most pool_size connections are kept alive, the least
+    recently used ones are dropped from the pool and closed and recreated on
+    next get() in their threads. Connection is closed only by the thread that
+    owns it, so it never goes away in the middle of a request.
+
+    Connection that wasn't used for max_idle seconds is passed to check(conn),
+    it's reused only when check returns True (no check: always replaced).
+
+    >> pool = KeyedLocalPool(create_conn, key_fn=lambda: access_data['key_id'])
+    >> conn = pool.get()
+    >> pool.stats.snapshot()
+    {'created': 1, 'reused': 0, 'refreshed': 0, 'expired': 0, 'evicted': 0, 'disposed': 0}
+    '''
+
+    def __init__(self, creator, key_fn=None, pool_size=50, max_idle=None, check=None):
+        self._creator = creator
+        self._key_fn = key_fn
+        self._check = check
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # token -> connection, in LRU order
+        self._conns = OrderedDict()
+        self._tokens = itertools.count()
+        self.size = pool_size
+        self.max_idle = max_idle
+        self.stats = metrics.Counters(
+                'created', 'reused', 'refreshed', 'expired', 'evicted', 'disposed')
+
+    def get(self):
+        key = self._key_fn() if self._key_fn else None
+        entry = getattr(self._local, 'entry', None)
+        if entry:
+            token, entry_key, conn, last_used = entry
+            if token not in self._conns:
+                # evicted or disposed by another thread
+                self._close(conn)
+                entry = None
+            elif entry_key != key:
+                self.stats.incr('refreshed')
+                self._discard(token)
+                entry = None
+            elif self.max_idle and time.time() - last_used > self.max_idle \
+                    and not self._healthy(conn):
+                self.stats.incr('expired')
+                self._discard(token)
+                entry = None
+            else:
+                self.stats.incr('reused')
+        if not entry:
+            conn = self._creator()
+            token = self._tokens.next()
+            self.stats.incr('created')
+            with self._lock:
+                self._conns[token] = conn
+                evicted = max(len(self._conns) - self.size, 0)
+                for _ in range(evicted):
+                    self._conns.popitem(last=False)
+            self.stats.incr('evicted', evicted)
+        else:
+            with self._lock:
+                if token in self._conns:
+                    # move to the end of LRU
+                    self._conns[token] = self._conns.pop(token)
+        self._local.entry = (token, key, conn, time.time())
+        return conn
+
+    def _healthy(self, conn):
+        if not self._check:
+            return False
+        try:
+            return bool(self._check(conn))
+        except:
+            LOG.debug('Connection %s failed health check: %s', conn, sys.exc_info()[1])
+            return False
+
+    def _discard(self, token):
+        with self._lock:
+            conn = self._conns.pop(token, None)
+        if conn is not None:
+            self._close(conn)
+
+    def _close(self, conn):
+        close = getattr(conn, 'close', None)
+        if close:
+            try:
+                close()
+            except:
+                LOG.debug('Failed to close connection %s: %s', conn, sys.exc_info()[1])
+
+    def __len__(self):
+        return len(self._conns)
+
+    def dispose_local(self):
+        entry = getattr(self._local, 'entry', None)
+        if entry:
+            self.stats.incr('disposed')
+            self._discard(entry[0])
+            del self._local.entry
+
+    def dispose_all(self):
+        """
+        Current thread's connection is closed now, others on next get() in their threads
+        """
+        self.dispose_local()
+        with self._lock:
+            disposed, self._conns = len(self._conns), OrderedDict()
+        self.stats.incr('disposed', disposed)
+
+
 class SqliteLocalObject(LocalPool):
     def do_create(self):
         return _SqliteConnection(self, self._creator)
@@ -625,6 +746,79 @@ class PeriodicalExecutor:
             if not self._shutdown:
                 time.sleep(1)
         
+
+
+class Debounce(object):
+    '''
+    Coalesces calls made within `delay` seconds into single fn() call
+    in a background thread. flush() runs pending call immediately.
+
+    >> persist = Debounce(cfg.save, delay=2)
+    >> persist()    # scheduled
+    >> persist()    # coalesced with the previous one
+    >> persist.flush()
+
+    @param delay: seconds, or callable returning them, so that the current
+    value of a caller's setting is used for each call
+    @param lock: held while fn() runs, pass a caller's RLock to serialize
+    fn() with code that calls flush() under that lock
+    '''
+
+    def __init__(self, fn, delay, lock=None, name=None):
+        self.fn = fn
+        self.delay = delay
+        self.name = name or getattr(fn, '__name__', 'debounce')
+        self._run_lock = lock or threading.RLock()
+        self._lock = threading.Lock()
+        self._timer = None
+        self.calls = 0
+        self.runs = 0
+
+    @property
+    def pending(self):
+        return self._timer is not None
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+            if self._timer:
+                return
+            delay = self.delay() if callable(self.delay) else self.delay
+            self._timer = threading.Timer(delay, self._fire)
+            self._timer.args = (self._timer, )
+            self._timer.setDaemon(True)
+            self._timer.start()
+
+    def _fire(self, timer):
+        with self._run_lock:
+            with self._lock:
+                if self._timer is not timer:
+                    # flushed or cancelled meanwhile
+                    return
+                self._timer = None
+            try:
+                self._run()
+            except:
+                LOG.exception('%s failed', self.name)
+
+    def _run(self):
+        self.runs += 1
+        self.fn()
+
+    def flush(self):
+        with self._run_lock:
+            if self.cancel():
+                self._run()
+
+    def cancel(self):
+        '''
+        Drops pending call, returns True if there was one
+        '''
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer:
+            timer.cancel()
+        return timer is not None
                 
                 
 def run_detached(binary, args=[], env=None):
@@ -897,11 +1091,69 @@ if platform.uname()[0] == 'Windows':
         return decorator
 
 
-def write_file_to_stream(path, stream):
+DEFAULT_READ_BUFFER_SIZE = 1024 * 1024
+
+
+def read_blocks(fp, buf=None, limit=None):
+    '''
+    Read fp in len(buf) pieces with readinto() into reused bytearray buf
+    and yield read-only views of data. View is valid until the next iteration.
+    Streams without readinto() fall back to read()
+
+    @param limit: stop after this number of bytes
+    '''
+    if buf is None:
+        buf = bytearray(DEFAULT_READ_BUFFER_SIZE)
+    view = memoryview(buf)
+    readinto = getattr(fp, 'readinto', None)
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = len(buf) if remaining is None else min(len(buf), remaining)
+        if readinto:
+            n = readinto(view[:size])
+            data = buffer(buf, 0, n)
+        else:
+            data = fp.read(size)
+            n = len(data)
+        if not n:
+            break
+        if remaining is not None:
+            remaining -= n
+        yield data
+
+
+def write_file_to_stream(path, stream, buffer_size=None):
     with open(path, 'rb') as f:
-        while True:
-            data = f.read(4096)
-            if not data:
-                break
+        for data in read_blocks(f, bytearray(buffer_size or DEFAULT_READ_BUFFER_SIZE)):
             stream.write(data)
 
+
+
+def atomic_write(path, data, mode=None):
+    '''
+    Replace file content with data via temporary file and rename(),
+    so readers see either old or new content, never a partially written file.
+    Permissions and ownership of existing file are preserved
+
+    @param mode: permissions for a new file
+    '''
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        if os.path.exists(path):
+            st = os.stat(path)
+            os.chmod(tmp_path, st.st_mode & 07777)
+            tmp_st = os.stat(tmp_path)
+            if (tmp_st.st_uid, tmp_st.st_gid) != (st.st_uid, st.st_gid):
+                os.chown(tmp_path, st.st_uid, st.st_gid)
+        else:
+            os.chmod(tmp_path, 0644 if mode is None else mode)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
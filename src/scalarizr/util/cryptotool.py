@@ -11,6 +11,9 @@ import hashlib
 import re
 import os
 import time
+import threading
+
+from scalarizr import util
 
 try:
     with_m2crypto = True
@@ -24,10 +27,45 @@ except ImportError:
 
 crypto_algo = dict(name="des_ede3_cbc", key_size=24, iv_size=8)
 
+# Per key objects reused between messages
+_CACHE_SIZE = 16
+
 
 def keygen(length=40):
     return binascii.b2a_base64(os.urandom(length))
 
+
+_keys = {}
+_keys_lock = threading.Lock()
+
+def read_key(path):
+    '''
+    Returns decoded crypto key from base64 encoded key file.
+    Key is cached until file mtime/size/inode changes or forget_key() call
+    '''
+    st = os.stat(path)
+    stamp = (st.st_mtime, st.st_size, st.st_ino)
+    cached = _keys.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    with open(path) as fp:
+        key = binascii.a2b_base64(fp.read().strip())
+    with _keys_lock:
+        if len(_keys) >= _CACHE_SIZE:
+            _keys.clear()
+        _keys[path] = (stamp, key)
+    return key
+
+def forget_key(path=None):
+    '''
+    Drop cached key for path (or all keys), called on key rotation
+    '''
+    with _keys_lock:
+        if path:
+            _keys.pop(path, None)
+        else:
+            _keys.clear()
+
 if with_m2crypto:
     def _init_cipher(key, op_enc=1):
         skey = key[0:crypto_algo["key_size"]]   # Use first n bytes as crypto key
@@ -49,24 +87,32 @@ if with_m2crypto:
         return ret
 
 else:
-    def _new_cipher(key):
-        skey = key[0:crypto_algo["key_size"]]   # Use first n bytes as crypto key
-        iv = key[-crypto_algo["iv_size"]:]      # Use last m bytes as IV
-        return Cipher(algorithms.TripleDES(skey), modes.CBC(iv), backend=default_backend())
+    # M2Crypto Cipher is single use, cryptography one creates
+    # any number of encryptors/decryptors
+    _ciphers = {}
+    _padding = padding.PKCS7(64)
 
-    def _new_padding():
-        return padding.PKCS7(64)
+    def _new_cipher(key):
+        cipher = _ciphers.get(key)
+        if cipher is None:
+            skey = key[0:crypto_algo["key_size"]]   # Use first n bytes as crypto key
+            iv = key[-crypto_algo["iv_size"]:]      # Use last m bytes as IV
+            cipher = Cipher(algorithms.TripleDES(skey), modes.CBC(iv), backend=default_backend())
+            if len(_ciphers) >= _CACHE_SIZE:
+                _ciphers.clear()
+            _ciphers[key] = cipher
+        return cipher
 
     def encrypt(s, key):
         enc = _new_cipher(key).encryptor()
-        pad = _new_padding().padder()
+        pad = _padding.padder()
         padded = pad.update(s) + pad.finalize()
         encrypted = enc.update(padded) + enc.finalize()
         return binascii.b2a_base64(encrypted)
 
     def decrypt(s, key):
         dec = _new_cipher(key).decryptor()
-        unpad = _new_padding().unpadder()
+        unpad = _padding.unpadder()
         encrypted = binascii.a2b_base64(s)
         padded = dec.update(encrypted) + dec.finalize()
         return unpad.update(padded) + unpad.finalize()
@@ -79,12 +125,28 @@ def _get_canonical_string (params=None):
         s = s + str(key) + str(value)
     return s
 
+_hmacs = {}
+
+def hmac_sha1(key, *data):
+    '''
+    HMAC-SHA1 digest of concatenated data. Keyed state is computed once per key
+    '''
+    base = _hmacs.get(key)
+    if base is None:
+        base = hmac.new(key, digestmod=hashlib.sha1)
+        if len(_hmacs) >= _CACHE_SIZE:
+            _hmacs.clear()
+        _hmacs[key] = base
+    h = base.copy()
+    for chunk in data:
+        h.update(chunk)
+    return h.digest()
+
 def sign_http_request(data, key, timestamp=None):
     date = time.strftime("%a %d %b %Y %H:%M:%S %Z", timestamp or time.gmtime())
     canonical_string = _get_canonical_string(data) if hasattr(data, "__iter__") else data
-    canonical_string += date
 
-    digest = hmac.new(key, canonical_string, hashlib.sha1).digest()
+    digest = hmac_sha1(key, canonical_string, date)
     sign = binascii.b2a_base64(digest)
     if sign.endswith('\n'):
         sign = sign[:-1]
@@ -93,13 +155,10 @@ def sign_http_request(data, key, timestamp=None):
 def pwgen(size):
     return re.sub('[^\w]', '', keygen(size*2))[:size]
 
-def calculate_md5_sum(path):
+def calculate_md5_sum(path, buffer_size=None):
     md5_sum = hashlib.md5()
     with open(path, 'rb') as f:
-        while True:
-            data = f.read(4096)
-            if not data:
-                break
+        for data in util.read_blocks(f, bytearray(buffer_size or util.DEFAULT_READ_BUFFER_SIZE)):
             md5_sum.update(data)
     return md5_sum.hexdigest()
 
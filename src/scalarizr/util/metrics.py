@@ -0,0 +1,81 @@
+from __future__ import with_statement
+'''
+Lightweight in-process metrics for scalarizr internals
+'''
+
+import threading
+import collections
+
+
+def _percentile(sorted_samples, p):
+    idx = int(round(p / 100.0 * len(sorted_samples) + 0.5)) - 1
+    return sorted_samples[max(0, min(idx, len(sorted_samples) - 1))]
+
+
+class Timings(object):
+    '''
+    Thread-safe sliding window of measured durations (in seconds).
+
+    >> t = Timings()
+    >> t.add(0.002)
+    >> t.summary()
+    {'count': 1, 'last': 0.002, 'avg': 0.002, 'p50': 0.002, 'p99': 0.002, 'max': 0.002}
+    '''
+
+    def __init__(self, window=1000):
+        self._samples = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.last = None
+
+    def add(self, value):
+        with self._lock:
+            self._samples.append(value)
+            self.count += 1
+            self.last = value
+
+    def percentile(self, p):
+        with self._lock:
+            samples = sorted(self._samples)
+        return _percentile(samples, p) if samples else None
+
+    def summary(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count, last = self.count, self.last
+        if not samples:
+            return dict(count=count, last=last, avg=None, p50=None, p99=None, max=None)
+        return dict(
+            count=count,
+            last=last,
+            avg=sum(samples) / len(samples),
+            p50=_percentile(samples, 50),
+            p99=_percentile(samples, 99),
+            max=samples[-1]
+        )
+
+
+class Counters(object):
+    '''
+    Thread-safe set of named counters.
+
+    >> c = Counters()
+    >> c.incr('opened')
+    >> c.snapshot()
+    {'opened': 1}
+    '''
+
+    def __init__(self, *names):
+        self._values = dict.fromkeys(names, 0)
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def __getitem__(self, name):
+        return self._values.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
@@ -23,6 +23,22 @@ class TimeoutError(Exception):
     pass
 
 
+def execute_batch(cur, statements):
+    '''
+    Execute [(sql, parameters), ...] in one transaction on sqlite3 cursor
+    of autocommit connection, that no other thread uses concurrently
+    '''
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        for sql, parameters in statements:
+            cur.execute(sql, parameters)
+        cur.execute('COMMIT')
+    except:
+        exc_info = sys.exc_info()
+        cur.execute('ROLLBACK')
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
 class Proxy(object):
 
 
@@ -64,9 +80,20 @@ class CursorProxy(Proxy):
         args = [sql]
         if parameters:
             args += [parameters]
+        return self._execute('cursor_execute', args)
+
+    def execute_batch(self, statements):
+        '''
+        Execute [(sql, parameters), ...] in one transaction. Server thread runs
+        the whole batch as a single job, so statements from other threads
+        never get into it
+        '''
+        return self._execute('cursor_execute_batch', [list(statements)])
+
+    def _execute(self, method, args):
         for _ in range(0, GLOBAL_TIMEOUT):
             try:
-                self._execute_result = self._call('cursor_execute', args)
+                self._execute_result = self._call(method, args)
                 break
             except sqlite3.OperationalError, e:
                 if 'database is locked' in str(e):
@@ -219,6 +246,18 @@ class SqliteServer(object):
             cur.close()
 
 
+    def _cursor_execute_batch(self, hash, statements):
+        cur = self._master_conn.cursor()
+        try:
+            execute_batch(cur, statements)
+            return {
+                    'data': [],
+                    'rowcount': cur.rowcount
+            }
+        finally:
+            cur.close()
+
+
     def _cursor_fetchone(self, hash):
         result = None
         if hash in self._cursors:
@@ -286,6 +325,136 @@ class SqliteServer(object):
             self._cursor_delete(hash)
 
 
+class LocalCursor(object):
+    '''
+    CursorProxy-compatible cursor for LocalConnection.
+    Result set is fetched eagerly, so WAL readers never hold a snapshot open
+    after execute() returns
+    '''
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._data = None
+        self._iter = None
+        self._rowcount = -1
+
+    def execute(self, sql, parameters=None):
+        args = [sql]
+        if parameters:
+            args += [parameters]
+        # busy_timeout already waits for locks inside sqlite,
+        # retry only a few times in case of a writers deadlock
+        for attempt in range(0, 3):
+            try:
+                cur = self._connection.get_connection().cursor()
+                try:
+                    cur.execute(*args)
+                    self._data = cur.fetchall()
+                    self._rowcount = cur.rowcount
+                finally:
+                    cur.close()
+                break
+            except sqlite3.OperationalError, e:
+                if 'database is locked' in str(e) and attempt < 2:
+                    LOG.debug('Caught %s, retrying', e)
+                    time.sleep(0.1)
+                else:
+                    raise
+        self._iter = iter(self._data or [None])
+        return self
+
+    def execute_batch(self, statements):
+        '''
+        Execute [(sql, parameters), ...] in one transaction
+        on this thread's own connection
+        '''
+        cur = self._connection.get_connection().cursor()
+        try:
+            execute_batch(cur, statements)
+            self._data = []
+            self._rowcount = cur.rowcount
+        finally:
+            cur.close()
+        self._iter = iter([None])
+        return self
+
+    def fetchone(self):
+        try:
+            return self._iter.next()
+        except StopIteration:
+            return None
+
+    def fetchall(self):
+        try:
+            return self._data
+        finally:
+            self._data = None
+
+    @property
+    def rowcount(self):
+        return self._rowcount
+
+    def close(self):
+        pass
+
+
+class LocalConnection(object):
+    '''
+    ConnectionProxy-compatible connection that gives every thread its own
+    sqlite3 connection to a WAL journaled database. Readers run in parallel
+    with a writer instead of queueing behind a single SqliteServer thread.
+    Connections work in autocommit mode, like SqliteServer's master connection
+    '''
+
+    def __init__(self, conn_creator, busy_timeout=GLOBAL_TIMEOUT):
+        self.conn_creator = conn_creator
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._factories = {}
+        self._factories_version = 0
+        # Switch journal mode once, it's persistent in database file
+        conn = self.get_connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+
+    def get_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.conn_creator()
+            conn.isolation_level = None
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=%d' % (self.busy_timeout * 1000))
+            self._local.conn = conn
+            self._local.factories_version = -1
+        if self._local.factories_version != self._factories_version:
+            for name, value in self._factories.items():
+                setattr(conn, name, value)
+            self._local.factories_version = self._factories_version
+        return conn
+
+    def cursor(self):
+        return LocalCursor(self)
+
+    def commit(self):
+        # no worries, autocommit is set
+        pass
+
+    def executescript(self, sql):
+        return self.get_connection().executescript(sql)
+
+    def _get_factory(self, name):
+        return getattr(self.get_connection(), name)
+
+    def _set_factory(self, name, f):
+        self._factories[name] = f
+        self._factories_version += 1
+
+    row_factory = property(lambda self: self._get_factory('row_factory'),
+                           lambda self, f: self._set_factory('row_factory', f))
+
+    text_factory = property(lambda self: self._get_factory('text_factory'),
+                            lambda self, f: self._set_factory('text_factory', f))
+
+
 class _NULL(object):
     pass
 
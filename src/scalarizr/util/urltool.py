@@ -5,7 +5,18 @@ Created on May 23, 2011
 @author: marat
 '''
 
+import time
+import errno
+import socket
+import base64
+import httplib
+import urllib
 import urllib2
+import urlparse
+import threading
+
+from scalarizr.util import metrics
+
 
 class HTTPRedirectHandler(urllib2.HTTPRedirectHandler):
 
@@ -41,3 +52,141 @@ class HTTPRedirectHandler(urllib2.HTTPRedirectHandler):
             raise urllib2.HTTPError(req.get_full_url(), code, msg, headers, fp)
 
     http_error_305 = urllib2.HTTPRedirectHandler.http_error_302
+
+
+class HTTPConnectionPool(object):
+    '''
+    Keep-alive HTTP(S) connections, pooled per (scheme, host, port, proxy).
+    Proxies are taken from environment like in urllib2 (http_proxy, https_proxy, no_proxy):
+    http requests are sent to proxy with absolute URI, https ones are tunneled with CONNECT.
+
+    >> pool = HTTPConnectionPool(maxsize=2)
+    >> resp = pool.request('POST', 'https://scalr.net/messaging/control', data, headers)
+    >> resp.status, resp.data
+    (201, '')
+    >> pool.stats.snapshot()
+    {'opened': 1, 'reused': 0, 'evicted': 0, 'retried': 0}
+    '''
+
+    def __init__(self, maxsize=4, idle_timeout=60, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.stats = metrics.Counters('opened', 'reused', 'evicted', 'retried')
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _key(self, url):
+        r = urlparse.urlparse(url)
+        port = r.port or (443 if r.scheme == 'https' else 80)
+        return r.scheme, r.hostname, port, self._proxy(r.scheme, r.hostname)
+
+    def _proxy(self, scheme, host):
+        proxy = urllib.getproxies().get(scheme)
+        if not proxy or urllib.proxy_bypass(host):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return proxy
+
+    def _connect(self, key):
+        scheme, host, port, proxy = key
+        if not proxy:
+            conn_cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+            return conn_cls(host, port, timeout=self.timeout)
+        p = urlparse.urlparse(proxy)
+        headers = self._proxy_headers(key)
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(p.hostname, p.port or 80, timeout=self.timeout)
+            conn.set_tunnel(host, port, headers)
+        else:
+            conn = httplib.HTTPConnection(p.hostname, p.port or 80, timeout=self.timeout)
+        return conn
+
+    def _proxy_headers(self, key):
+        p = urlparse.urlparse(key[3])
+        if not p.username:
+            return {}
+        creds = '%s:%s' % (urllib.unquote(p.username), urllib.unquote(p.password or ''))
+        return {'Proxy-Authorization': 'Basic ' + base64.b64encode(creds)}
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, released_at = idle.pop()
+                if now - released_at < self.idle_timeout:
+                    self.stats.incr('reused')
+                    return conn, True
+                conn.close()
+                self.stats.incr('evicted')
+        self.stats.incr('opened')
+        return self._connect(key), False
+
+    def _put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+        self.stats.incr('evicted')
+
+    def request(self, method, url, body=None, headers=None):
+        '''
+        Perform request and read response body.
+        Connection is returned to pool unless server asked to close it.
+        Request is retried on a new connection only when a reused one turned out
+        to be closed by server while idle: sending failed with connection reset /
+        broken pipe, or server closed it without sending a single response byte.
+        Timeouts and other errors are never retried, server may have
+        processed request already
+        '''
+        r = urlparse.urlparse(url)
+        path = r.path or '/'
+        if r.query:
+            path += '?' + r.query
+        key = self._key(url)
+        headers = dict(headers or {})
+        if key[3] and key[0] == 'http':
+            # Plain http proxy expects absolute URI
+            path = '%s://%s%s' % (r.scheme, r.netloc, path)
+            headers.update(self._proxy_headers(key))
+        while True:
+            conn, reused = self._get(key)
+            stale = False
+            try:
+                try:
+                    conn.request(method, path, body, headers)
+                except socket.error, e:
+                    stale = not isinstance(e, socket.timeout) and \
+                            e.args[0] in (errno.ECONNRESET, errno.EPIPE)
+                    raise
+                except httplib.CannotSendRequest:
+                    stale = True
+                    raise
+                try:
+                    resp = conn.getresponse()
+                except httplib.BadStatusLine:
+                    stale = True
+                    raise
+                resp.data = resp.read()
+            except:
+                conn.close()
+                if stale and reused:
+                    self.stats.incr('retried')
+                    continue
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._put(key, conn)
+            return resp
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
@@ -0,0 +1,79 @@
+'''
+Collecting node stats through HttpServiceProxy: six system.* calls, each one
+signed, encrypted and sent separately, vs one JSON-RPC batch request.
+
+    python tests/benchmarks/api_batch.py [rounds]
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+
+import benchutil
+
+from scalarizr import rpc
+from scalarizr.api.binding import jsonrpc_http
+from scalarizr.util import cryptotool
+
+
+METHODS = ('cpu_stat', 'mem_info', 'load_average', 'disk_stats', 'net_stats', 'statvfs')
+
+
+class SystemService(object):
+    pass
+
+
+def _stub(name):
+    def method(self, **kwds):
+        return dict(('%s_%d' % (name, i), i * 1024) for i in range(20))
+    method.__name__ = name
+    return rpc.query_method(method)
+
+for _name in METHODS:
+    setattr(SystemService, _name, _stub(_name))
+
+
+def one_by_one(client):
+    for name in METHODS:
+        getattr(client.system, name)()
+
+
+def batch(client):
+    with client.batch() as b:
+        for name in METHODS:
+            getattr(b.system, name)()
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    tmp_dir = tempfile.mkdtemp(prefix='szr-bench-')
+    try:
+        key_path = os.path.join(tmp_dir, 'crypto_key')
+        with open(key_path, 'w') as fp:
+            fp.write(cryptotool.keygen())
+        app = jsonrpc_http.WsgiApplication(
+                rpc.RequestHandler({'system': SystemService()}), key_path)
+        server = jsonrpc_http.make_server('127.0.0.1', 0, app, workers=4)
+        t = threading.Thread(target=server.serve_forever, args=(0.05,))
+        t.setDaemon(True)
+        t.start()
+        client = jsonrpc_http.HttpServiceProxy(
+                'http://127.0.0.1:%d' % server.server_address[1], key_path)
+        try:
+            rows = []
+            for name, fn in (('6 calls', one_by_one), ('1 batch of 6', batch)):
+                seconds = benchutil.measure(
+                        lambda: [fn(client) for _ in xrange(rounds)], repeat=3)
+                rows.append((name, seconds, rounds))
+            benchutil.report('%d rounds of %s, rounds/s' % (rounds, ', '.join(METHODS)), rows)
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
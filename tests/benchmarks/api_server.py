@@ -0,0 +1,120 @@
+'''
+API server load test: signed and encrypted JSON-RPC calls of a system.* like
+method from concurrent clients. Compares thread per connection HTTP/1.0 server
+(clients reconnect for every call) with PooledWsgiServer and keep-alive clients.
+
+    python tests/benchmarks/api_server.py [requests] [clients] [workers]
+'''
+
+import os
+import sys
+import time
+import shutil
+import httplib
+import tempfile
+import threading
+import wsgiref.simple_server
+
+import benchutil
+
+from scalarizr import rpc
+from scalarizr.api.binding import jsonrpc_http
+from scalarizr.util import cryptotool, metrics
+
+
+# thread per connection server logs every request to stderr
+wsgiref.simple_server.WSGIRequestHandler.log_message = lambda *args: None
+
+
+class SystemService(object):
+
+    @rpc.query_method
+    def disk_stats(self):
+        return dict(('sd%s' % chr(ord('a') + i), {
+                'read': {'num': 1000 + i, 'sectors': 20000, 'bytes': 10240000},
+                'write': {'num': 2000 + i, 'sectors': 40000, 'bytes': 20480000}
+        }) for i in range(16))
+
+
+def client(port, security, key, count, keep_alive, timings, errors):
+    request = security.encrypt_data(
+            '{"id": 1, "method": "disk_stats", "params": {}}')
+    conn = None
+    for _ in xrange(count):
+        start = time.time()
+        try:
+            if not conn:
+                conn = httplib.HTTPConnection('127.0.0.1', port)
+            sig, date = security.sign(request, key)
+            conn.request('POST', '/system', request, {
+                    'Date': date, 'X-Signature': sig, 'Accept-Encoding': 'gzip'})
+            resp = conn.getresponse()
+            data = resp.read()
+            if resp.status != 200:
+                raise Exception(resp.status)
+            if resp.getheader('Content-Encoding') == 'gzip':
+                data = jsonrpc_http.gunzip_data(data)
+            security.decrypt_data(data)
+        except:
+            errors.append(sys.exc_info()[1])
+            keep_alive = False
+        timings.add(time.time() - start)
+        if not keep_alive:
+            conn.close()
+            conn = None
+
+
+def run(app, port_holder, workers, count, clients, keep_alive):
+    server = jsonrpc_http.make_server('127.0.0.1', 0, app, workers=workers,
+                    queue_size=clients * 2)
+    t = threading.Thread(target=server.serve_forever, args=(0.05,))
+    t.setDaemon(True)
+    t.start()
+    port = server.server_address[1]
+    security, key = port_holder
+    timings = metrics.Timings(window=count)
+    errors = []
+    threads = [threading.Thread(target=client, args=(
+            port, security, key, count / clients, keep_alive, timings, errors))
+            for _ in xrange(clients)]
+    start = time.time()
+    for c in threads:
+        c.start()
+    for c in threads:
+        c.join()
+    elapsed = time.time() - start
+    server.shutdown()
+    server.server_close()
+    return elapsed, timings.summary(), len(errors)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    tmp_dir = tempfile.mkdtemp(prefix='szr-bench-')
+    try:
+        key_path = os.path.join(tmp_dir, 'crypto_key')
+        with open(key_path, 'w') as fp:
+            fp.write(cryptotool.keygen())
+        security = jsonrpc_http.Security(key_path)
+        key = cryptotool.read_key(key_path)
+        handler = rpc.RequestHandler({'system': SystemService()})
+
+        print('%d requests from %d clients' % (count, clients))
+        for name, gzip_min_size, w, keep_alive in (
+                ('thread per connection', None, 0, False),
+                ('%d workers, keep-alive' % workers, None, workers, True),
+                ('%d workers, keep-alive, gzip' % workers, jsonrpc_http.GZIP_MIN_SIZE,
+                        workers, True)):
+            app = jsonrpc_http.WsgiApplication(handler, key_path, gzip_min_size=gzip_min_size)
+            elapsed, summary, errors = run(app, (security, key), w, count, clients, keep_alive)
+            print('  %-32s %7.0f req/s  p50 %6.2f ms  p99 %6.2f ms  max %7.2f ms  errors %d' % (
+                    name, summary['count'] / elapsed, summary['p50'] * 1000,
+                    summary['p99'] * 1000, summary['max'] * 1000, errors))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
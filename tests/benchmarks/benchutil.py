@@ -0,0 +1,86 @@
+'''
+Helpers shared by scalarizr micro-benchmarks.
+
+Benchmarks are plain scripts, run them from the repository root:
+
+    python tests/benchmarks/p2p_store_snapshot.py
+'''
+
+import os
+import sys
+import time
+import sqlite3
+import logging
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from scalarizr.bus import bus
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def setup_db(path=None):
+    '''
+    Create scratch database from share/db.sql and publish it as bus.db
+    '''
+    if not path:
+        fd, path = tempfile.mkstemp(prefix='szr-bench-', suffix='.sqlite')
+        os.close(fd)
+    conn = sqlite3.connect(path, 5.0, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.text_factory = sqlite3.OptimizedUnicode
+    conn.executescript(open(os.path.join(ROOT, 'share', 'db.sql')).read())
+    conn.commit()
+    # Autocommit, like sqlite_server connections
+    conn.isolation_level = None
+    bus.db = conn
+    return path
+
+
+def setup_proxy_db(path=None):
+    '''
+    Like setup_db(), but publish thread-safe SQLiteServerThread proxy
+    (default scalarizr backend) as bus.db
+    '''
+    from scalarizr.util import sqlite_server
+
+    path = setup_db(path)
+    bus.db.close()
+
+    def connect():
+        conn = sqlite3.connect(path, 5.0)
+        conn.row_factory = sqlite3.Row
+        conn.text_factory = sqlite3.OptimizedUnicode
+        return conn
+
+    server = sqlite_server.SQLiteServerThread(connect)
+    server.setDaemon(True)
+    server.start()
+    sqlite_server.wait_for_server_thread(server)
+    bus.db = server.connection
+    return path
+
+
+def measure(fn, repeat=5):
+    '''
+    Run fn `repeat` times, return best wall time in seconds
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(title, rows):
+    '''
+    Print [(name, seconds, ops)] as a table
+    '''
+    print(title)
+    for name, seconds, ops in rows:
+        print('  %-40s %10.4f s %12.0f ops/s' % (name, seconds, ops / seconds if seconds else 0))
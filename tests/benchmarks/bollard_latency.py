@@ -0,0 +1,58 @@
+'''
+bollard: apply_async() -> AsyncResult.get() round trip of a no-op task.
+"push" is the default in-process notification from PullServer,
+"poll" forces the database polling path used by processes without Executor.
+
+    python tests/benchmarks/bollard_latency.py [tasks]
+'''
+
+import sys
+import time
+
+import benchutil
+
+from scalarizr import bollard
+from scalarizr.util import metrics
+
+
+@bollard.task()
+def noop():
+    return None
+
+
+def run(executor, count):
+    timings = metrics.Timings(window=count)
+    for _ in xrange(count):
+        start = time.time()
+        executor.apply_async(noop).get(timeout=30)
+        timings.add(time.time() - start)
+    return timings.summary()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    benchutil.setup_proxy_db()
+    executor = bollard.Executor(max_workers=2)
+    executor.start()
+    try:
+        # warm up workers
+        run(executor, 5)
+        push = run(executor, count)
+
+        started, bollard.Executor._started = bollard.Executor._started, 0
+        try:
+            poll = run(executor, min(count, 20))
+        finally:
+            bollard.Executor._started = started
+    finally:
+        executor.stop()
+
+    print('No-op task latency, ms')
+    for name, summary in (('push', push), ('poll', poll)):
+        print('  %-6s count %5d  avg %8.2f  p50 %8.2f  p99 %8.2f  max %8.2f' % (
+            name, summary['count'], summary['avg'] * 1000, summary['p50'] * 1000,
+            summary['p99'] * 1000, summary['max'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+'''
+Platform connection pools against a local stub HTTP endpoint:
+new connection per call (former NullPool for EC2/S3) vs KeyedLocalPool.
+Each call does one keep-alive GET, like a single EC2 API or S3 chunk request.
+
+    python tests/benchmarks/conn_pool.py [requests] [threads]
+'''
+
+import sys
+import httplib
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import benchutil
+
+from scalarizr.util import NullPool, KeyedLocalPool
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # one write per response, avoids Nagle delays on keep-alive connections
+    wbufsize = -1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    accepted = 0
+
+    def get_request(self):
+        self.accepted += 1
+        return BaseHTTPServer.HTTPServer.get_request(self)
+
+
+def run(pool, count, threads):
+    def worker():
+        for _ in xrange(count / threads):
+            conn = pool.get()
+            conn.request('GET', '/')
+            conn.getresponse().read()
+    workers = [threading.Thread(target=worker) for _ in xrange(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    server = Server(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever, args=(0.05,))
+    t.setDaemon(True)
+    t.start()
+    connect = lambda: httplib.HTTPConnection(*server.server_address)
+    try:
+        rows = []
+        for name, pool in (('NullPool', NullPool(connect)),
+                           ('KeyedLocalPool', KeyedLocalPool(connect))):
+            server.accepted = 0
+            seconds = benchutil.measure(lambda: run(pool, count, threads), repeat=1)
+            rows.append(('%s (%d TCP connects)' % (name, server.accepted), seconds, count))
+        benchutil.report('%d requests in %d threads, requests/s' % (count, threads), rows)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
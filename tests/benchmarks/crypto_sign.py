@@ -0,0 +1,62 @@
+'''
+Message encrypt+sign throughput: key file read and decoded, cipher and HMAC
+set up for every message (old behaviour) vs P2pMessageSecurity with cached
+key material, cipher and keyed HMAC state.
+
+    python tests/benchmarks/crypto_sign.py [messages]
+'''
+
+import os
+import sys
+import hmac
+import shutil
+import hashlib
+import binascii
+import tempfile
+
+import benchutil
+
+from scalarizr.util import cryptotool
+from scalarizr.messaging.p2p.security import P2pMessageSecurity
+
+
+def encrypt_sign_uncached(key_path, message):
+    # Former out_protocol_filter()
+    with open(key_path) as fp:
+        key = binascii.a2b_base64(fp.read().strip())
+    cryptotool._ciphers.clear()
+    data = cryptotool.encrypt(message, key)
+    date = 'Wed 01 Jan 2014 00:00:00 UTC'
+    return hmac.new(key, data + date, hashlib.sha1).digest()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    tmp_dir = tempfile.mkdtemp(prefix='szr-bench-')
+    try:
+        key_path = os.path.join(tmp_dir, 'default')
+        with open(key_path, 'w') as fp:
+            fp.write(cryptotool.keygen(40))
+        security = P2pMessageSecurity('server-id', key_path)
+
+        for size, title in ((1024, '1 KB'), (1024 * 1024, '1 MB')):
+            message = os.urandom(size)
+            n = count if size < 1024 * 1024 else max(count / 100, 5)
+
+            def uncached():
+                for _ in xrange(n):
+                    encrypt_sign_uncached(key_path, message)
+
+            def cached():
+                for _ in xrange(n):
+                    security.out_protocol_filter(None, None, message, {})
+
+            benchutil.report('encrypt+sign of %s message, messages/s' % title, [
+                ('key/cipher/HMAC per message', benchutil.measure(uncached, repeat=3), n),
+                ('cached key/cipher/HMAC', benchutil.measure(cached, repeat=3), n)])
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
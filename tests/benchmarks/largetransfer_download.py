@@ -0,0 +1,69 @@
+'''
+largetransfer.Download: chunks staged in tmp dir vs streamed through memory buffers.
+Restores from the local cloudfs driver (file://), gzip is off to measure transfer itself.
+
+    python tests/benchmarks/largetransfer_download.py [size_mb] [chunk_size_mb]
+'''
+
+import os
+import sys
+import hashlib
+import shutil
+import tempfile
+
+import benchutil
+
+from scalarizr.storage2 import largetransfer
+from scalarizr.storage2.cloudfs import NamedStream
+
+
+def make_backup(workdir, size_mb, chunk_size):
+    src_path = os.path.join(workdir, 'source')
+    block = os.urandom(1024 * 1024)
+    md5 = hashlib.md5()
+    with open(src_path, 'wb') as fp:
+        for _ in xrange(size_mb):
+            fp.write(block)
+            md5.update(block)
+    src = NamedStream(open(src_path, 'rb'), 'source')
+    try:
+        up = largetransfer.Upload(src, 'file://%s' % workdir, gzip=False,
+                                  chunk_size=chunk_size, streaming=True)
+        up.apply_async()
+        up.join()
+    finally:
+        src.close()
+        os.remove(src_path)
+    return up.manifest.cloudfs_path, md5.hexdigest()
+
+
+def download(manifest, streaming, md5_sum):
+    dl = largetransfer.Download(manifest, streaming=streaming)
+    dl.apply_async()
+    md5 = hashlib.md5()
+    while True:
+        data = dl.output.read(4 * 1024 * 1024)
+        if not data:
+            break
+        md5.update(data)
+    dl.join()
+    assert md5.hexdigest() == md5_sum, 'Downloaded data differs from source'
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    workdir = tempfile.mkdtemp(prefix='szr-bench-')
+    try:
+        manifest, md5_sum = make_backup(workdir, size_mb, chunk_size)
+        rows = []
+        for name, streaming in (('tmp-dir staging', False), ('streaming buffers', True)):
+            seconds = benchutil.measure(lambda: download(manifest, streaming, md5_sum), repeat=3)
+            rows.append(('%s (%d MB)' % (name, size_mb), seconds, size_mb))
+        benchutil.report('Download %d MB in %d MB chunks, MB/s' % (size_mb, chunk_size), rows)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+'''
+Read path throughput: largetransfer.split() and cryptotool.calculate_md5_sum()
+with 4 KB read() calls (old behaviour) vs readinto() into a reused MB-sized buffer.
+Source is a pipe from `head -c <size> /dev/zero`, like tar/xtrabackup output.
+
+    python tests/benchmarks/largetransfer_read.py [size_mb]
+'''
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+import benchutil
+
+from scalarizr.util import cryptotool
+from scalarizr.storage2 import largetransfer
+
+
+def source(size_mb):
+    cmd = ['head', '-c', str(size_mb * 1024 * 1024), '/dev/zero']
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=-1)
+
+
+def split_4k(stream, storage_dir, chunk_size):
+    # Former split() inner loop
+    chunk_size *= 1024 * 1024
+    chunk_idx = 0
+    while True:
+        path = os.path.join(storage_dir, 'stream.%03d' % chunk_idx)
+        md5_sum = hashlib.md5()
+        eof = False
+        with open(path, 'wb') as f:
+            for _ in xrange(chunk_size / 4096):
+                data = stream.read(4096)
+                if not data:
+                    eof = True
+                    break
+                f.write(data)
+                md5_sum.update(data)
+        yield path
+        if eof:
+            return
+        chunk_idx += 1
+
+
+def md5_4k(path):
+    md5_sum = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(4096)
+            if not data:
+                break
+            md5_sum.update(data)
+    return md5_sum.hexdigest()
+
+
+def run_split(size_mb, tmp_dir, read_buffer_size=None):
+    popen = source(size_mb)
+    if read_buffer_size:
+        chunks = (info.path for info in largetransfer.split(
+            popen.stdout, tmp_dir, chunk_size=100, read_buffer_size=read_buffer_size))
+    else:
+        chunks = split_4k(popen.stdout, tmp_dir, 100)
+    for path in chunks:
+        os.remove(path)
+    popen.wait()
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    tmp_dir = tempfile.mkdtemp(prefix='szr-bench-')
+    try:
+        rows = [('split, 4 KB read()', benchutil.measure(
+            lambda: run_split(size_mb, tmp_dir), repeat=2), size_mb)]
+        for mb in (1, 4, 16):
+            rows.append(('split, %d MB readinto()' % mb, benchutil.measure(
+                lambda: run_split(size_mb, tmp_dir, mb), repeat=2), size_mb))
+        benchutil.report('largetransfer.split() of %d MB stream, MB/s' % size_mb, rows)
+
+        path = os.path.join(tmp_dir, 'chunk')
+        with open(path, 'wb') as fp:
+            block = os.urandom(1024 * 1024)
+            for _ in xrange(256):
+                fp.write(block)
+        rows = [('md5, 4 KB read()', benchutil.measure(lambda: md5_4k(path)), 256)]
+        for mb in (1, 4, 16):
+            rows.append(('md5, %d MB readinto()' % mb, benchutil.measure(
+                lambda: cryptotool.calculate_md5_sum(path, mb * 1024 * 1024)), 256))
+        benchutil.report('cryptotool.calculate_md5_sum() of 256 MB file, MB/s', rows)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+'''
+largetransfer.Upload: chunks staged in tmp dir vs streamed from memory buffers.
+Uploads to the local cloudfs driver (file://), gzip is off to measure transfer itself.
+
+    python tests/benchmarks/largetransfer_upload.py [size_mb] [chunk_size_mb]
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+
+import benchutil
+
+from scalarizr.storage2 import largetransfer
+from scalarizr.storage2.cloudfs import NamedStream
+
+
+def make_source(path, size_mb):
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as fp:
+        for _ in xrange(size_mb):
+            fp.write(block)
+
+
+def upload(src_path, dst_dir, chunk_size, streaming):
+    src = NamedStream(open(src_path, 'rb'), 'source')
+    try:
+        up = largetransfer.Upload(src, 'file://%s' % dst_dir, gzip=False,
+                                  chunk_size=chunk_size, streaming=streaming)
+        up.apply_async()
+        up.join()
+    finally:
+        src.close()
+        shutil.rmtree(dst_dir, ignore_errors=True)
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    workdir = tempfile.mkdtemp(prefix='szr-bench-')
+    try:
+        src_path = os.path.join(workdir, 'source')
+        make_source(src_path, size_mb)
+        dst_dir = os.path.join(workdir, 'dst')
+
+        rows = []
+        for name, streaming in (('tmp-dir staging', False), ('streaming buffers', True)):
+            seconds = benchutil.measure(
+                lambda: upload(src_path, dst_dir, chunk_size, streaming), repeat=3)
+            rows.append(('%s (%d MB)' % (name, size_mb), seconds, size_mb))
+        benchutil.report('Upload %d MB in %d MB chunks, MB/s' % (size_mb, chunk_size), rows)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''
+__node__ store lookups: files re-read and re-parsed on every access (old behaviour)
+vs cached content validated by os.stat(), and by inotify when pyinotify is installed.
+
+    python tests/benchmarks/node_lookup.py [lookups]
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+
+import benchutil
+
+from scalarizr import node
+
+
+class UncachedIni(node.Ini):
+    def _load(self):
+        self._reload()
+
+
+class UncachedFile(node.File):
+    def __getitem__(self, key):
+        with open(self.filename) as fp:
+            return fp.read().strip()
+
+
+def lookups(store, key, count):
+    for _ in xrange(count):
+        store[key]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    tmp_dir = tempfile.mkdtemp(prefix='szr-bench-')
+    try:
+        ini_files = []
+        for name in ('mysql.ini', 'mysql-user.ini'):
+            ini_files.append(os.path.join(tmp_dir, name))
+            with open(ini_files[-1], 'w') as fp:
+                fp.write('[mysql]\n')
+                for i in xrange(20):
+                    fp.write('option_%d = value %d\n' % (i, i))
+                fp.write('root_password = Q9OgJxYf19ygFHpRprLF\n')
+        state_file = os.path.join(tmp_dir, '.state')
+        with open(state_file, 'w') as fp:
+            fp.write('running')
+
+        stores = [
+            ('Ini, 2 files', UncachedIni(ini_files, 'mysql'), node.Ini(ini_files, 'mysql'),
+                    'root_password'),
+            ('File', UncachedFile(state_file), node.File(state_file), 'state')
+        ]
+        rows = []
+        for name, uncached, cached, key in stores:
+            rows.append(('%s, re-read' % name, benchutil.measure(
+                lambda: lookups(uncached, key, count)), count))
+            rows.append(('%s, stat cache' % name, benchutil.measure(
+                lambda: lookups(cached, key, count)), count))
+            if node.enable_inotify():
+                try:
+                    rows.append(('%s, inotify cache' % name, benchutil.measure(
+                        lambda: lookups(cached, key, count)), count))
+                finally:
+                    node.disable_inotify()
+        benchutil.report('%d __node__ lookups, lookups/s' % count, rows)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
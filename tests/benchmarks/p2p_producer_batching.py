@@ -0,0 +1,68 @@
+'''
+Throughput of Log messages delivery: one HTTP POST per message
+vs. producer batching (producer_batch_window) against a local stub endpoint.
+'''
+
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import benchutil
+
+from scalarizr.node import __node__
+from scalarizr.messaging.p2p import P2pMessage
+from scalarizr.messaging.p2p.producer import P2pMessageProducer
+
+
+MESSAGES = 2000
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer response, otherwise Nagle delays every keep-alive response
+    wbufsize = -1
+    posts = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        _Handler.posts += 1
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    benchutil.setup_db()
+    dict.__setitem__(__node__, 'message_format', 'json')
+    server = _Server(('127.0.0.1', 0), _Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    endpoint = 'http://127.0.0.1:%d' % server.server_port
+
+    rows = []
+    for title, window in (('per-message', None), ('batched, 0.5 s window', 0.5)):
+        producer = P2pMessageProducer(endpoint, '1', batch_window=window)
+        _Handler.posts = 0
+
+        def run():
+            for i in range(MESSAGES):
+                producer.send('log', P2pMessage('Log', body={'message': 'Backup progress line %d' % i}))
+            producer.flush()
+
+        elapsed = benchutil.measure(run, 1)
+        producer.shutdown()
+        rows.append(('%s (%d POSTs)' % (title, _Handler.posts), elapsed, MESSAGES))
+    benchutil.report('%d Log messages' % MESSAGES, rows)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
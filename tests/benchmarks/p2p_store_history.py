@@ -0,0 +1,82 @@
+'''
+Message store operations on a p2p_message table with 100k historical rows,
+with and without P2P_MESSAGE_INDEXES.
+'''
+
+import time
+
+import benchutil
+
+from scalarizr.bus import bus
+from scalarizr.messaging.p2p import P2pMessageStore, P2pMessage
+
+
+HISTORY = 100000
+OPS = 200
+
+
+def _fill_history(conn):
+    body = '{"body": {"log": "%s"}, "meta": {}, "id": "%%s", "name": "Log"}' % ('x' * 200)
+    rows = []
+    for i in range(HISTORY):
+        is_ingoing = i % 2
+        rows.append((body % i, 'hist-%d' % i, 'Log', 'log', is_ingoing,
+                     1 - is_ingoing, 'daemon', is_ingoing, 'json'))
+    conn.execute('BEGIN')
+    conn.executemany('INSERT INTO p2p_message (message, message_id, message_name, queue, is_ingoing, '
+                     'out_is_delivered, out_sender, in_is_handled, format) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.execute('COMMIT')
+
+
+def _run(indexed):
+    benchutil.setup_db()
+    conn = bus.db
+    if not indexed:
+        for name in ('p2p_message_message_id', 'p2p_message_unhandled', 'p2p_message_undelivered'):
+            conn.execute('DROP INDEX IF EXISTS %s' % name)
+    _fill_history(conn)
+
+    store = P2pMessageStore()
+    store.__dict__.pop('_unhandled', None)
+    # Keep history until rotate() is measured
+    store.TAIL_LENGTH = HISTORY * 2
+    store.TAIL_SIZE = 1024 ** 3
+    tag = indexed and 'idx' or 'noidx'
+
+    def put_and_handle():
+        for i in range(OPS):
+            msg = P2pMessage('HostUp', body={'i': i})
+            msg.id = '%s-%d-%f' % (tag, i, time.time())
+            store.put_ingoing(msg, 'control', 'bench')
+            store.mark_as_handled(msg.id)
+        store.flush()
+
+    def load():
+        for i in range(OPS):
+            store.load('hist-%d' % (i * 2 + 1), True)
+
+    def undelivered():
+        store.get_undelivered('daemon')
+
+    def unhandled_from_db():
+        store._get_unhandled_from_db()
+
+    rows = [
+        ('put_ingoing + mark_as_handled', benchutil.measure(put_and_handle, 1), OPS),
+        ('load by message_id', benchutil.measure(load, 1), OPS),
+        ('get_undelivered', benchutil.measure(undelivered), 1),
+        ('_get_unhandled_from_db', benchutil.measure(unhandled_from_db), 1),
+    ]
+
+    del store.TAIL_LENGTH, store.TAIL_SIZE
+    rows.append(('rotate %d rows' % HISTORY, benchutil.measure(store.rotate, 1), 1))
+    benchutil.report('%s, %d historical rows' % (indexed and 'indexed' or 'no indexes', HISTORY), rows)
+
+
+def main():
+    _run(False)
+    _run(True)
+
+
+if __name__ == '__main__':
+    main()
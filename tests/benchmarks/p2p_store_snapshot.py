@@ -0,0 +1,52 @@
+'''
+Compare _P2pMessageStore.get_unhandled() snapshots with the former
+JSON round-trip copy at 1k pending HostInit-like messages.
+'''
+
+import benchutil
+
+from scalarizr.messaging.p2p import P2pMessageStore, P2pMessage
+
+
+PENDING = 1000
+
+
+def _host_init(i):
+    msg = P2pMessage('HostInit', body={
+        'server_id': 'server-%d' % i,
+        'local_ip': '10.0.%d.%d' % (i / 256, i % 256),
+        'behaviour': ['app', 'mysql2'],
+        'global_variables': [dict(name='VAR%d' % n, value='x' * 64) for n in range(50)],
+        'base': {'hostname': 'node-%d' % i}
+    })
+    msg.id = 'msg-%d' % i
+    return msg
+
+
+def main():
+    benchutil.setup_db()
+    store = P2pMessageStore()
+    for i in range(PENDING):
+        store.put_ingoing(_host_init(i), 'control', 'bench')
+
+    def json_roundtrip():
+        for queue, frozen in store.get_unhandled('bench'):
+            msg_copy = P2pMessage()
+            msg_copy.fromjson(frozen.tojson())
+
+    def snapshot():
+        store.get_unhandled('bench')
+
+    def snapshot_and_touch():
+        for queue, message in store.get_unhandled('bench'):
+            message.body.get('server_id')
+
+    benchutil.report('get_unhandled() with %d pending messages' % PENDING, [
+        ('json round-trip copy (legacy)', benchutil.measure(json_roundtrip), PENDING),
+        ('snapshot', benchutil.measure(snapshot), PENDING),
+        ('snapshot + body access', benchutil.measure(snapshot_and_touch), PENDING),
+    ])
+
+
+if __name__ == '__main__':
+    main()
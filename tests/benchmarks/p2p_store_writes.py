@@ -0,0 +1,49 @@
+'''
+Message state transitions throughput and latency with and without
+write-behind group commit in _P2pMessageStore.
+'''
+
+import time
+
+import benchutil
+
+from scalarizr.messaging.p2p import P2pMessageStore, P2pMessage
+
+
+BURST = 500
+
+
+def _run(store, write_behind, tag):
+    store.WRITE_BEHIND = write_behind
+    ids = []
+    for i in range(BURST):
+        msg = P2pMessage('OperationProgress', body={'i': i, 'platform_access_data': {'key': 'x' * 40}})
+        msg.id = '%s-%d' % (tag, i)
+        store.put_ingoing(msg, 'control', 'bench')
+        ids.append(msg.id)
+    start = time.time()
+    for message_id in ids:
+        store.mark_as_handled(message_id)
+        store.mark_as_delivered(message_id)
+    store.flush()
+    return time.time() - start
+
+
+def main():
+    benchutil.setup_db()
+    store = P2pMessageStore()
+    rows = []
+    for write_behind in (0, 0.05):
+        store.transition_latency = type(store.transition_latency)()
+        elapsed = _run(store, write_behind, 'wb%s' % write_behind)
+        rows.append(('WRITE_BEHIND=%s' % write_behind, elapsed, BURST * 2))
+        summary = store.transition_latency.summary()
+        print('WRITE_BEHIND=%s transition latency p50: %.4f s, p99: %.4f s' % (
+                write_behind, summary['p50'], summary['p99']))
+    benchutil.report('%d handled + %d delivered transitions' % (BURST, BURST), rows)
+    summary = store.put_latency.summary()
+    print('put_ingoing latency p50: %.4f s, p99: %.4f s' % (summary['p50'], summary['p99']))
+
+
+if __name__ == '__main__':
+    main()
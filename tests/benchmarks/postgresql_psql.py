@@ -0,0 +1,50 @@
+'''
+services.postgresql.PSQL: 1k small queries through psql subprocess
+(su - postgres -c psql, former behaviour) vs pooled psycopg2 connections
+over unix socket, one by one and with execute_batch().
+Needs local PostgreSQL with trusted local access for postgres user, run as root.
+
+    python tests/benchmarks/postgresql_psql.py [queries]
+'''
+
+import sys
+
+import benchutil
+
+from scalarizr.services import postgresql
+
+
+def run_subprocess(count):
+    psql = postgresql.PSQL()
+    for i in xrange(count):
+        psql.execute('SELECT %d;' % i)
+
+
+def run_driver(count):
+    psql = postgresql.PSQL()
+    for i in xrange(count):
+        psql.fetchone('SELECT %s;', (i, ))
+
+
+def run_batch(count, batch_size=100):
+    psql = postgresql.PSQL()
+    for i in xrange(0, count, batch_size):
+        psql.execute_batch(['SELECT %d' % j for j in xrange(i, i + batch_size)])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rows = [('psql subprocess', benchutil.measure(lambda: run_subprocess(count), repeat=1), count)]
+    if postgresql.psycopg2:
+        rows += [
+            ('psycopg2 pooled', benchutil.measure(lambda: run_driver(count)), count),
+            ('psycopg2 execute_batch(100)', benchutil.measure(lambda: run_batch(count)), count),
+        ]
+        postgresql.PSQL.pool.clear()
+    else:
+        print('psycopg2 is not installed, driver rows skipped')
+    benchutil.report('%d small queries, queries/s' % count, rows)
+
+
+if __name__ == '__main__':
+    main()
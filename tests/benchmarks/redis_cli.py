@@ -0,0 +1,154 @@
+'''
+services.redis.RedisCLI: forked redis-cli per query (former implementation)
+vs in-process RESP connection. Both talk to a local stand-in RESP server.
+Without redis-cli binary the subprocess row shows fork+exec of /bin/true,
+which is a lower bound for it.
+
+    python tests/benchmarks/redis_cli.py [queries] [redis-cli path]
+'''
+
+import os
+import sys
+import socket
+import threading
+import SocketServer
+
+import benchutil
+
+from scalarizr.util import system2
+from scalarizr.services import redis
+
+
+INFO = '\r\n'.join([
+    '# Server', 'redis_version:2.8.4', '# Replication', 'role:slave',
+    'master_host:10.0.0.1', 'master_port:6379', 'master_link_status:up',
+    'master_last_io_seconds_ago:1', 'master_sync_in_progress:0',
+    '# Persistence', 'aof_enabled:0', 'bgsave_in_progress:0',
+    'bgrewriteaof_in_progress:0', 'changes_since_last_save:0',
+]) + '\r\n'
+
+
+class RespHandler(SocketServer.StreamRequestHandler):
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if line.startswith('*'):
+                args = []
+                for _ in xrange(int(line[1:])):
+                    length = int(self.rfile.readline()[1:])
+                    args.append(self.rfile.read(length + 2)[:-2])
+            else:
+                args = line.split()
+            if not args:
+                continue
+            cmd = args[0].upper()
+            if cmd == 'INFO':
+                self.wfile.write('$%d\r\n%s\r\n' % (len(INFO), INFO))
+            elif cmd == 'PING':
+                self.wfile.write('+PONG\r\n')
+            else:
+                self.wfile.write('+OK\r\n')
+            self.wfile.flush()
+
+
+class Server(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SubprocessCLI(redis.RedisCLI):
+    # Former RedisCLI.execute(): redis-cli process with AUTH prepended to every query
+    path = None
+
+    def execute(self, args, silent=False):
+        query = ' '.join(args)
+        if not self.password:
+            full_query = query
+        else:
+            full_query = 'AUTH %s\n%s' % (self.password, query)
+        if self.path:
+            out = system2([self.path, '-p', str(self.port)], stdin=full_query,
+                          silent=True, warn_stderr=False)[0]
+        else:
+            system2(['/bin/true'], silent=True)
+            out = INFO if query == 'INFO' else 'OK\n'
+        if out.startswith('OK\n'):
+            out = out[3:]
+        if out.endswith('\n'):
+            out = out[:-1]
+        return out
+
+
+def poll_sync(cli, count):
+    # wait_for_sync() / RedisInstances loops: several INFO fields per check
+    for _ in xrange(count):
+        cli.master_link_status
+        cli.master_sync_in_progress
+
+
+def poll_sync_cached(cli, count):
+    for _ in xrange(count):
+        with cli.cached_info():
+            cli.master_link_status
+            cli.master_sync_in_progress
+
+
+def config_get(cli, count):
+    for _ in xrange(count):
+        cli.execute(['CONFIG', 'GET', 'dir'])
+
+
+def config_get_pipelined(cli, count):
+    commands = [('CONFIG', 'GET', 'dir')] * 10
+    for _ in xrange(count / 10):
+        cli.pipeline(commands)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    SubprocessCLI.path = sys.argv[2] if len(sys.argv) > 2 else \
+            redis.__redis__['redis-cli'] if os.path.exists(redis.__redis__['redis-cli']) else None
+
+    server = Server(('127.0.0.1', 0), RespHandler)
+    port = server.server_address[1]
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    subprocess_cli = SubprocessCLI('secret', port)
+    native_cli = redis.RedisCLI('secret', port)
+    try:
+        subprocess_name = 'redis-cli' if SubprocessCLI.path else 'fork /bin/true'
+
+        rows = [
+            ('%s, 2 INFO per check' % subprocess_name,
+                benchutil.measure(lambda: poll_sync(subprocess_cli, count)), count),
+            ('resp, 2 INFO per check',
+                benchutil.measure(lambda: poll_sync(native_cli, count)), count),
+            ('resp, cached_info()',
+                benchutil.measure(lambda: poll_sync_cached(native_cli, count)), count),
+        ]
+        benchutil.report('Replication status checks, %d checks' % count, rows)
+
+        rows = [
+            ('%s, query per process' % subprocess_name,
+                benchutil.measure(lambda: config_get(subprocess_cli, count)), count),
+            ('resp, query per round trip',
+                benchutil.measure(lambda: config_get(native_cli, count)), count),
+            ('resp, pipeline of 10',
+                benchutil.measure(lambda: config_get_pipelined(native_cli, count)), count),
+        ]
+        benchutil.report('CONFIG GET, %d queries' % count, rows)
+    finally:
+        native_cli.connection.close()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+'''
+Concurrency benchmark: SqliteServer proxy vs. WAL LocalConnection.
+
+Every worker thread performs a mix of p2p_message inserts, updates by
+message_id and selects, like message store, volume table and operation
+bookkeeping do at runtime.
+'''
+
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+
+import benchutil
+
+from scalarizr.util import sqlite_server
+
+
+THREADS = (1, 4, 16)
+OPS_PER_THREAD = 300
+
+
+def _creator(path):
+    def connect():
+        conn = sqlite3.connect(path, 5.0)
+        conn.row_factory = sqlite3.Row
+        return conn
+    return connect
+
+
+def _new_db():
+    fd, path = tempfile.mkstemp(prefix='szr-bench-', suffix='.sqlite')
+    os.close(fd)
+    benchutil.setup_db(path)
+    return path
+
+
+def _proxy(path):
+    t = sqlite_server.SQLiteServerThread(_creator(path))
+    t.setDaemon(True)
+    t.start()
+    sqlite_server.wait_for_server_thread(t)
+    return t.connection
+
+
+def _local(path):
+    return sqlite_server.LocalConnection(_creator(path))
+
+
+def _worker(conn, n):
+    for i in range(OPS_PER_THREAD):
+        message_id = '%d-%d' % (n, i)
+        cur = conn.cursor()
+        cur.execute('INSERT INTO p2p_message (message_id, message_name, message, is_ingoing, in_is_handled) '
+                    'VALUES (?, ?, ?, 1, 0)', [message_id, 'HostUp', '{}'])
+        cur.execute('UPDATE p2p_message SET in_is_handled = 1 WHERE message_id = ?', [message_id])
+        cur.execute('SELECT queue, message_id FROM p2p_message WHERE is_ingoing = 1 AND in_is_handled = 0')
+        cur.fetchall()
+
+
+def _run(conn, threads):
+    workers = [threading.Thread(target=_worker, args=(conn, n)) for n in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.time() - start
+
+
+def main():
+    rows = []
+    for backend, factory in (('proxy', _proxy), ('wal', _local)):
+        for threads in THREADS:
+            path = _new_db()
+            try:
+                elapsed = _run(factory(path), threads)
+            finally:
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+            rows.append(('%s, %d threads' % (backend, threads), elapsed, threads * OPS_PER_THREAD * 3))
+    benchutil.report('sqlite backends, %d ops per thread' % (OPS_PER_THREAD * 3), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import os
+import time
+import socket
+import httplib
+import tempfile
+import shutil
+import threading
+
+from nose.tools import eq_
+
+from scalarizr import rpc
+from scalarizr.api.binding import jsonrpc_http
+from scalarizr.util import cryptotool
+
+
+class MyService(object):
+
+    @rpc.service_method
+    def foo(self):
+        return 'bar' * 1000
+
+
+class OtherService(object):
+
+    @rpc.service_method
+    def baz(self):
+        return 'qux'
+
+
+class TestPooledWsgiServer(object):
+
+    def setup(self):
+        self.release = threading.Event()
+        self.release.set()
+        self.server = None
+
+    def teardown(self):
+        self.release.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _app(self, environ, start_response):
+        self.release.wait(5)
+        start_response('200 OK', [('Content-Length', '2')])
+        return ['ok']
+
+    def _serve(self, app=None, **kwds):
+        self.server = jsonrpc_http.make_server('127.0.0.1', 0, app or self._app, **kwds)
+        t = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        t.setDaemon(True)
+        t.start()
+        return self.server.server_address[1]
+
+    def test_keep_alive(self):
+        port = self._serve(workers=2)
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        for _ in range(3):
+            conn.request('GET', '/')
+            resp = conn.getresponse()
+            eq_(resp.read(), 'ok')
+            eq_(resp.version, 11)
+        conn.close()
+        eq_(self.server.stats['accepted'], 1)
+        eq_(self.server.stats['requests'], 3)
+
+    def test_max_keep_alive_requests(self):
+        port = self._serve(workers=1)
+        self.server.max_keep_alive_requests = 2
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        headers = []
+        for _ in range(3):
+            conn.request('GET', '/')
+            resp = conn.getresponse()
+            resp.read()
+            headers.append(resp.getheader('Connection'))
+        eq_(headers, [None, 'close', None])
+        eq_(self.server.stats['accepted'], 2)
+
+    def test_idle_connection_gives_worker_back(self):
+        port = self._serve(workers=1, keep_alive_timeout=30)
+        idle = httplib.HTTPConnection('127.0.0.1', port)
+        idle.request('GET', '/')
+        eq_(idle.getresponse().read(), 'ok')
+
+        # served by the only worker long before idle connection's keep-alive timeout
+        started = time.time()
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/')
+        eq_(conn.getresponse().read(), 'ok')
+        assert time.time() - started < 2
+        conn.close()
+        idle.close()
+
+    def test_close_without_content_length(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return ['o', 'k']
+        port = self._serve(app, workers=1)
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', '/')
+        resp = conn.getresponse()
+        eq_(resp.getheader('Connection'), 'close')
+        eq_(resp.read(), 'ok')
+
+    def test_queue_limit(self):
+        self.release.clear()
+        port = self._serve(workers=1, queue_size=1)
+        busy = []
+        for _ in range(2):
+            # first one is taken by worker, second waits in queue
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            busy.append(sock)
+        for _ in range(50):
+            if self.server.stats['accepted'] == 2 and self.server._queue.full():
+                break
+            threading.Event().wait(0.02)
+
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', '/')
+        eq_(conn.getresponse().status, 503)
+        eq_(self.server.stats['rejected'], 1)
+        self.release.set()
+        for sock in busy:
+            assert sock.recv(1024).startswith('HTTP/1.1 200')
+            sock.close()
+
+    def test_close_with_full_queue(self):
+        self.release.clear()
+        port = self._serve(workers=1, queue_size=1, keep_alive_timeout=1)
+        socks = []
+        for i in range(2):
+            # first one is taken by worker, second waits in queue
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            sock.settimeout(2)
+            socks.append(sock)
+            for _ in range(50):
+                if self.server.stats['accepted'] == i + 1 and self.server._queue.qsize() == i:
+                    break
+                threading.Event().wait(0.02)
+
+        server, self.server = self.server, None
+        server.shutdown()
+        t = threading.Thread(target=server.server_close)
+        t.setDaemon(True)
+        t.start()
+        # queued connection is closed without being served
+        eq_(socks[1].recv(1024), '')
+        self.release.set()
+        assert socks[0].recv(1024).startswith('HTTP/1.1 200')
+        t.join(5)
+        assert not t.isAlive()
+        for sock in socks:
+            sock.close()
+
+    def _client(self, tmp, gzip_min_size=None):
+        crypto_key_path = os.path.join(tmp, 'crypto_key')
+        with open(crypto_key_path, 'w') as fp:
+            fp.write(cryptotool.keygen())
+        handler = rpc.RequestHandler({'myservice': MyService(), 'other': OtherService()})
+        app = jsonrpc_http.WsgiApplication(handler, crypto_key_path, gzip_min_size=gzip_min_size)
+        port = self._serve(app, workers=1)
+        return jsonrpc_http.HttpServiceProxy('http://127.0.0.1:%d' % port, crypto_key_path)
+
+    def test_gzip(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            client = self._client(tmp, jsonrpc_http.GZIP_MIN_SIZE)
+            eq_(client.myservice.foo(), 'bar' * 1000)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_batch(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            client = self._client(tmp)
+            with client.batch() as batch:
+                foo = batch.myservice.foo()
+                baz = batch.other.baz()
+            eq_((foo.result, baz.result), ('bar' * 1000, 'qux'))
+            eq_(self.server.stats['requests'], 1)
+        finally:
+            shutil.rmtree(tmp)
@@ -7,6 +7,7 @@ import unittest
 import os
 import logging
 import shutil
+import mock
  
 from scalarizr.api import haproxy
 from scalarizr.services import haproxy as hap_serv
@@ -270,6 +271,79 @@ class TestHAProxyAPI(unittest.TestCase):
         LOG.debug('%s', stats)
         self.assertIsNotNone(stats)
  
+class TestRuntimeServerUpdates(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(hap_serv, 'HAProxyConfManager'),
+            mock.patch.object(hap_serv, 'HAProxyInitScript'),
+            mock.patch.object(hap_serv, 'StatSocket'),
+            mock.patch.object(haproxy.operation, 'OperationAPI'),
+            mock.patch('__builtin__.open')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.api = object.__new__(haproxy.HAProxyAPI)
+        self.api.__init__()
+        self.addCleanup(self.api._persist.cancel)
+        self.api.svc.status.return_value = 0
+        self.cfg = self.api.cfg
+        self.cfg.get_all_xpaths.return_value = ['backend[1]']
+        self.cfg.find_all_xpaths.return_value = ['backend[1]/server[1]']
+        self.cfg.get.side_effect = {
+            'backend[1]/name': 'scalr:backend:80',
+            'backend[1]/server[1]/name': '10-0-0-1:80'}.get
+
+    def test_remove_and_add_back_without_reload(self):
+        self.api.remove_server('10.0.0.1')
+
+        self.api._stat_socket.disable_server.assert_called_once_with(
+                ('scalr:backend:80', '10-0-0-1:80'))
+        self.cfg.remove.assert_called_once_with('backend[1]/server[1]')
+        self.assertTrue(self.api._persist.pending)
+        self.assertFalse(self.api.svc.reload.called)
+
+        self.api.add_server({'address': '10.0.0.1', 'port': 80})
+
+        self.api._stat_socket.enable_server.assert_called_once_with(
+                ('scalr:backend:80', '10-0-0-1:80'))
+        self.assertFalse(self.api.svc.reload.called)
+        # deferred write was flushed before add_server reloaded the tree
+        self.assertEqual(1, self.api._persist.runs)
+
+    def test_new_server_reloads(self):
+        self.api.add_server({'address': '10.0.0.2', 'port': 80})
+
+        self.assertFalse(self.api._stat_socket.enable_server.called)
+        self.assertTrue(self.cfg.save.called)
+        self.assertTrue(self.api.svc.reload.called)
+
+    def test_runtime_error_falls_back_to_reload(self):
+        self.api._stat_socket.disable_server.side_effect = hap_serv.HAProxyError('Permission denied')
+        self.api.remove_server('10.0.0.1')
+
+        self.assertTrue(self.api.svc.reload.called)
+        self.assertFalse(self.api._persist.pending)
+
+    def test_removed_server_is_not_in_health(self):
+        self.cfg.get.side_effect = {
+            'backend[1]/name': 'scalr:backend:80',
+            'backend[1]/server[1]/name': '10-0-0-1:80',
+            'global/stats_socket/path': hap_serv.STATS_SOCKET,
+            'global/stats_socket/level': 'admin',
+            'defaults/stats_enable': True}.get
+        self.api._stat_socket.show_stat.return_value = [
+            {'pxname': 'scalr:backend:80', 'svname': '10-0-0-1:80', 'status': 'UP'},
+            {'pxname': 'scalr:backend:80', 'svname': '10-0-0-2:80', 'status': 'UP'},
+            {'pxname': 'scalr:backend:80', 'svname': 'BACKEND', 'status': 'UP'}]
+        self.api.remove_server('10.0.0.1')
+
+        self.assertEqual(['10-0-0-2:80', 'BACKEND'],
+                         [stat['svname'] for stat in self.api.get_servers_health()])
+        self.assertEqual(['10-0-0-2:80'], [stat['svname'] for stat in self.api.health()])
+
+ 
 def tearDownModule():
     #os.remove(TEMP_PATH)
     pass
@@ -4,7 +4,10 @@ Created on Nov 2, 2012
 @author: uty
 '''
 import os
+import threading
 import mock
+import shutil
+import tempfile
 import StringIO
  
 from scalarizr.api import nginx
@@ -107,5 +110,90 @@ class TestNginxAPI(object):
         str_fp = StringIO.StringIO()
         conf.write_fp(str_fp, close=False)
         assert desired_config == str_fp, '%s' % str_fp.getvalue()
- 
- 
+
+
+class TestUpstreamChanges(object):
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.app_inc = os.path.join(self.tmp_dir, 'app-servers.include')
+        with open(self.app_inc, 'w') as fp:
+            fp.write('upstream backend {\n\tserver 127.0.0.1;\n}\n')
+        self.api = object.__new__(nginx.NginxAPI)
+        self.api.__init__(app_inc_dir=self.tmp_dir, proxies_inc_dir=self.tmp_dir)
+        self.api.upstream_update_delay = 60
+        self.api.service = mock.MagicMock()
+        self.api.service.status.return_value = nginx.initdv2.Status.RUNNING
+        self.api.backend_table = {'backend': [{'id': '1', 'servers': []}]}
+
+    def teardown(self):
+        self.api._apply_upstream_changes.cancel()
+        shutil.rmtree(self.tmp_dir)
+
+    def servers(self):
+        with open(self.app_inc) as fp:
+            return [line.split()[1].rstrip(';') for line in fp if 'server' in line]
+
+    def test_coalesce(self):
+        self.api.add_server_to_role('10.0.0.1', 1)
+        self.api.add_server_to_role('10.0.0.2', 1)
+        self.api.remove_server_from_role('10.0.0.1', 1)
+        self.api.add_server_to_role('10.0.0.3', 1)
+        assert self.servers() == ['127.0.0.1']
+
+        self.api.apply_upstream_changes()
+
+        assert self.servers() == ['10.0.0.2', '10.0.0.3'], self.servers()
+        assert self.api.backend_table['backend'][0]['servers'] == ['10.0.0.2', '10.0.0.3']
+        assert self.api.service.configtest.call_count == 1
+        assert self.api.service.reload.call_count == 1
+        assert self.api.get_upstream_stats() == \
+            {'queued': 4, 'coalesced': 1, 'applied': 2, 'reloads': 1}
+
+    def test_configtest_failure_restores_include(self):
+        self.api.service.configtest.side_effect = nginx.initdv2.InitdError('failed')
+        self.api.add_server_to_role('10.0.0.1', 1)
+        try:
+            self.api.apply_upstream_changes()
+            assert False, 'InitdError expected'
+        except nginx.initdv2.InitdError:
+            pass
+
+        assert self.servers() == ['127.0.0.1']
+        assert self.api.backend_table['backend'][0]['servers'] == []
+        assert not self.api.service.reload.called
+
+    def test_delay_from_ini(self):
+        with mock.patch.object(nginx, '__nginx__', {'upstream_update_delay': '0.5',
+                                                    'app_include_path': self.app_inc}):
+            with mock.patch.object(nginx, 'NginxInitScript'):
+                api = object.__new__(nginx.NginxAPI)
+                api.__init__()
+        assert api.upstream_update_delay == 0.5
+        api.upstream_update_delay = 0
+        assert api._apply_upstream_changes.delay() == 0
+
+    def test_add_proxy_waits_for_upstream_update(self):
+        started = threading.Event()
+
+        def add_proxy():
+            try:
+                self.api.add_proxy('test.com', backends=[{'host': '10.0.0.1'}])
+            except StopIteration:
+                pass
+
+        self.api._lock.acquire()
+        try:
+            with mock.patch.object(self.api, '_normalize_destinations',
+                                   side_effect=lambda backends: (started.set(), iter([]).next())):
+                t = threading.Thread(target=add_proxy)
+                t.setDaemon(True)
+                t.start()
+                # blocked while upstream changes are applied
+                assert not started.wait(0.2)
+                self.api._lock.release()
+                t.join(5)
+                assert started.isSet()
+        finally:
+            if self.api._lock._is_owned():
+                self.api._lock.release()
@@ -251,6 +251,42 @@ class TestSysInfoAPI(unittest.TestCase):
                 'eth0': {'receive': {'packets': '1160244', 'errors': '0', 'bytes': '1554522775'}, 'transmit': {'packets': '671950', 'errors': '0', 'bytes': '60669160'}}})
  
  
+    @mock.patch('scalarizr.api.system.time')
+    def test_disk_stats_rates(self, time_mock):
+        path = DISKSTATS + '.rates'
+        self.info._DISKSTATS = path
+        try:
+            with open(path, 'w') as fp:
+                fp.write('   8       0 sda 100 0 800 0 50 0 400 0 0 0 0\n')
+            time_mock.time.return_value = 1000.0
+            stats = self.info.disk_stats(rates=True)
+            self.assertEqual(stats['sda']['read']['iops'], None)
+
+            with open(path, 'w') as fp:
+                fp.write('   8       0 sda 300 0 1600 0 50 0 400 0 0 0 0\n')
+            # served from snapshot within ttl
+            time_mock.time.return_value = 1000.5
+            self.assertEqual(self.info.disk_stats()['sda']['read']['num'], 100)
+
+            time_mock.time.return_value = 1002.0
+            stats = self.info.disk_stats(rates=True)
+            self.assertEqual(stats['sda']['read']['num'], 300)
+            self.assertEqual(stats['sda']['read']['iops'], 100.0)
+            self.assertEqual(stats['sda']['read']['bytes_per_sec'], 400 * 512.0)
+            self.assertEqual(stats['sda']['write']['iops'], 0.0)
+        finally:
+            self.info._DISKSTATS = DISKSTATS
+            os.remove(path)
+
+
+    def test_mounts_parses_proc_mounts_once(self):
+        self.info._sampler.reset()
+        with mock.patch('scalarizr.linux.mount.mounts', wraps=system.mount.mounts) as mounts:
+            self.info.mounts()
+            self.info.statvfs(['/'])
+            self.assertEqual(mounts.call_count, 1)
+
+ 
     @mock.patch('scalarizr.api.system.bus')
     def test_scaling_metrics_read(self, bus_mock):
         bus_mock.queryenv_service = mock.Mock()
@@ -194,3 +194,57 @@ class TestIptables(object):
         iptables.chains["INPUT"].insert.assert_called_once_with(None, two_rules[0])
         assert not iptables.chains["INPUT"].append.called
  
+
+    def test_rule_key(self):
+        rule = {"protocol": "tcp", "match": "tcp", "dport": 22,
+                "source": "10.0.0.1", "jump": "ACCEPT"}
+        saved = {"protocol": "tcp", "dport": "22",
+                "source": "10.0.0.1/32", "jump": "ACCEPT"}
+        assert iptables._rule_key(rule) == iptables._rule_key(saved)
+        assert iptables._rule_key(dict(rule, table='filter')) == iptables._rule_key(rule)
+        assert iptables._rule_key(dict(rule, dport=23)) != iptables._rule_key(rule)
+
+    def test_batch(self):
+        iptables.linux.build_cmd_args = IPTABLES_LINUX.build_cmd_args
+        iptables.linux.system.return_value = ('\n'.join([
+            '*nat',
+            ':PREROUTING ACCEPT [0:0]',
+            '-A PREROUTING -p tcp -m tcp --dport 80 -j REDIRECT --to-ports 8080',
+            'COMMIT',
+            '*filter',
+            ':INPUT ACCEPT [0:0]',
+            '-A INPUT -s 10.0.0.1/32 -p tcp -m tcp --dport 6379 -j ACCEPT',
+            '-A INPUT -p tcp -m tcp --dport 6379 -j DROP',
+            '-A INPUT -m comment --comment "my local LAN" -i eth1 -j ACCEPT',
+            'COMMIT']), '', 0)
+
+        def accept(source):
+            return {"protocol": "tcp", "match": "tcp", "dport": "6379",
+                    "source": source, "jump": "ACCEPT"}
+
+        with iptables.Batch() as batch:
+            batch.ensure('INPUT', [accept('10.0.0.1'), accept('10.0.0.2'), accept('10.0.0.3')])
+            batch.ensure('INPUT', [{"protocol": "tcp", "match": "tcp",
+                    "dport": 6379, "jump": "DROP"}], append=True)
+            batch.ensure('INPUT', [{"in-interface": "eth1", "match": "comment",
+                    "comment": "my local LAN", "jump": "ACCEPT"}])
+            batch.remove('INPUT', [accept('10.0.0.1'), accept('10.0.0.4')])
+            batch.ensure('PREROUTING', [{"table": "nat", "protocol": "tcp", "match": "tcp",
+                    "dport": 80, "jump": "REDIRECT", "to-ports": 8080}])
+
+        # one iptables-save and one iptables-restore
+        assert iptables.linux.system.call_count == 2
+        args, kwds = iptables.linux.system.call_args
+        assert args[0] == ['/sbin/iptables-restore', '--noflush']
+        assert kwds['stdin'] == '\n'.join([
+            '*filter',
+            '-I INPUT 1 --protocol tcp --match tcp --dport 6379 --source 10.0.0.3 --jump ACCEPT',
+            '-I INPUT 1 --protocol tcp --match tcp --dport 6379 --source 10.0.0.2 --jump ACCEPT',
+            '-D INPUT --protocol tcp --match tcp --dport 6379 --source 10.0.0.1 --jump ACCEPT',
+            'COMMIT']) + '\n'
+
+    def test_batch_nothing_to_do(self):
+        iptables.linux.system.return_value = ('', '', 0)
+        with iptables.Batch() as batch:
+            batch.remove('INPUT', [{"source": "10.0.0.1", "jump": "ACCEPT"}])
+        assert iptables.linux.system.call_count == 1
@@ -0,0 +1,161 @@
+'''
+P2P message producer batching tests, run against a scratch sqlite database
+'''
+from __future__ import with_statement
+
+import json
+import time
+import socket
+import threading
+import unittest
+import urllib2
+
+import mock
+
+from scalarizr.messaging import Queues
+from scalarizr.messaging.p2p import _P2pMessageStore, P2pMessage
+from scalarizr.messaging.p2p.producer import P2pMessageProducer
+
+from scalarizrtests.messaging.p2p.test_store import setup_db, teardown_db
+
+
+class ProducerBatchingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = setup_db()
+        self.store = _P2pMessageStore()
+        self.node = mock.patch('scalarizr.messaging.p2p.producer.__node__', {'message_format': 'json'})
+        self.node.start()
+        self.producer = P2pMessageProducer('http://127.0.0.1:8813', retries_progression='1,2',
+                                           batch_window=60, batch_size=1024)
+        self.producer._store = self.store
+        self.producer._post = self.post
+        self.sent = []
+        self.down = False
+
+    def tearDown(self):
+        self.producer.shutdown()
+        self.node.stop()
+        self.store.flush()
+        teardown_db(self.db_path)
+
+    def post(self, url, data, headers):
+        if self.down:
+            raise urllib2.URLError(socket.error('Connection refused'))
+        self.sent.append((url.rsplit('/', 1)[1], json.loads(data)))
+
+    def names(self):
+        return [(queue, message['name']) for queue, message in self.sent]
+
+    def undelivered(self):
+        return [message.id for queue, message in self.store.get_undelivered(self.producer.sender)]
+
+    def send(self, queue, name, message_id=None, **body):
+        msg = P2pMessage(name, body=body)
+        msg.id = message_id
+        self.producer.send(queue, msg)
+        return msg
+
+    def test_coalesce_and_flush(self):
+        for i in range(3):
+            self.send(Queues.LOG, 'Log', message=str(i))
+        self.assertEqual(self.sent, [])
+        self.producer.flush()
+        self.assertEqual(len(self.sent), 1)
+        queue, envelope = self.sent[0]
+        self.assertEqual(queue, Queues.LOG)
+        self.assertEqual(envelope['name'], 'Log')
+        self.assertEqual(envelope['meta']['batch'], 1)
+        self.assertEqual([e['body']['message'] for e in envelope['body']['entries']], ['0', '1', '2'])
+
+    def test_entry_keeps_id_and_meta(self):
+        msg = P2pMessage('Log', meta={'server_id': 'abc'}, body={'message': 'x'})
+        msg.id = 'msg-1'
+        self.producer.send(Queues.LOG, msg)
+        self.producer.flush()
+        entry = self.sent[0][1]['body']['entries'][0]
+        self.assertEqual(entry['id'], 'msg-1')
+        self.assertEqual(entry['meta']['server_id'], 'abc')
+        self.assertEqual(entry['body'], {'message': 'x'})
+
+    def test_flush_in_insertion_order(self):
+        self.send(Queues.LOG, 'OperationProgress')
+        self.send(Queues.CONTROL, 'Log')
+        self.send(Queues.LOG, 'DeployLog')
+        self.producer.flush()
+        self.assertEqual(self.names(),
+                [(Queues.LOG, 'OperationProgress'), (Queues.CONTROL, 'Log'), (Queues.LOG, 'DeployLog')])
+
+    def test_size_budget(self):
+        for i in range(3):
+            self.send(Queues.LOG, 'Log', message='x' * 600)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(len(self.sent[0][1]['body']['entries']), 2)
+
+    def test_other_message_flushes_queue(self):
+        self.send(Queues.CONTROL, 'OperationProgress', step=1)
+        self.send(Queues.CONTROL, 'OperationResult')
+        self.assertEqual(self.names(), [(Queues.CONTROL, 'OperationProgress'),
+                                        (Queues.CONTROL, 'OperationResult')])
+
+    def test_shutdown_flushes(self):
+        self.send(Queues.LOG, 'DeployLog', message='done')
+        self.producer.shutdown()
+        self.assertEqual(len(self.sent), 1)
+
+    def test_entries_stored_when_queued(self):
+        self.send(Queues.LOG, 'Log', 'log-1', message='x')
+        self.send(Queues.LOG, 'Log', 'log-2', message='y')
+        # Survive a crash before envelope is sent
+        self.assertEqual(self.undelivered(), ['log-1', 'log-2'])
+        self.producer.flush()
+        self.store.flush()
+        self.assertEqual(self.undelivered(), [])
+
+    def test_shutdown_doesnt_hang_when_unreachable(self):
+        self.down = True
+        self.send(Queues.LOG, 'Log', 'log-1', message='x')
+        start = time.time()
+        self.producer.shutdown()
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(self.sent, [])
+        # Left for redelivery
+        self.assertEqual(self.undelivered(), ['log-1'])
+
+    def test_timer_flush_requeues_undelivered(self):
+        self.producer.batch_window = 0.05
+        self.producer.retries_progression = ['0']
+        self.down = True
+        self.send(Queues.LOG, 'Log', 'log-1', message='x')
+        time.sleep(0.2)
+        self.send(Queues.LOG, 'Log', 'log-2', message='y')
+        self.down = False
+        deadline = time.time() + 5
+        while not self.sent and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual([e['id'] for e in self.sent[0][1]['body']['entries']], ['log-1', 'log-2'])
+
+    def test_timer_flush_keeps_order_with_sends(self):
+        self.producer.batch_window = 0.01
+        posting = threading.Event()
+        release = threading.Event()
+
+        def slow_post(url, data, headers):
+            if json.loads(data)['name'] == 'Log':
+                posting.set()
+                release.wait(5)
+            self.post(url, data, headers)
+        self.producer._post = slow_post
+
+        self.send(Queues.LOG, 'Log', message='x')
+        posting.wait(5)
+        t = threading.Thread(target=self.send, args=(Queues.LOG, 'HostUpdate'))
+        t.start()
+        time.sleep(0.1)
+        release.set()
+        t.join(5)
+        self.assertEqual(self.names(), [(Queues.LOG, 'Log'), (Queues.LOG, 'HostUpdate')])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,326 @@
+'''
+P2P message store tests, run against a scratch sqlite database
+'''
+from __future__ import with_statement
+
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from scalarizr.bus import bus
+from scalarizr.util import sqlite_server
+from scalarizr.messaging import Queues
+from scalarizr.messaging.p2p import _P2pMessageStore, P2pMessage
+
+
+DB_SCRIPT = os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', '..', 'share', 'db.sql')
+
+
+def setup_db():
+    '''
+    Publish scratch database created from share/db.sql as bus.db
+    @return: database file path
+    '''
+    fd, path = tempfile.mkstemp(prefix='szr-p2p-', suffix='.sqlite')
+    os.close(fd)
+    conn = sqlite3.connect(path, 5.0, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.text_factory = sqlite3.OptimizedUnicode
+    conn.executescript(open(DB_SCRIPT).read())
+    conn.commit()
+    # Autocommit, like sqlite_server connections
+    conn.isolation_level = None
+    bus.db = conn
+    return path
+
+
+def setup_proxy_db():
+    '''
+    Like setup_db(), but bus.db is SQLiteServerThread proxy, as in scalarizr
+    '''
+    path = setup_db()
+    bus.db.close()
+
+    def connect():
+        conn = sqlite3.connect(path, 5.0)
+        conn.row_factory = sqlite3.Row
+        conn.text_factory = sqlite3.OptimizedUnicode
+        return conn
+
+    server = sqlite_server.SQLiteServerThread(connect)
+    server.setDaemon(True)
+    server.start()
+    sqlite_server.wait_for_server_thread(server)
+    bus.db = server.connection
+    return path
+
+
+def teardown_db(path):
+    if isinstance(bus.db, sqlite3.Connection):
+        bus.db.close()
+    bus.db = None
+    os.remove(path)
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = setup_db()
+        self.store = _P2pMessageStore()
+
+    def tearDown(self):
+        self.store.flush()
+        teardown_db(self.db_path)
+
+    def put_ingoing(self, message_id, name='HostUp', body=None):
+        msg = P2pMessage(name, body=body)
+        msg.id = message_id
+        self.store.put_ingoing(msg, Queues.CONTROL, 'test')
+        return msg
+
+    def in_is_handled(self, message_id):
+        cur = bus.db.cursor()
+        try:
+            cur.execute('SELECT in_is_handled FROM p2p_message WHERE message_id = ?', [message_id])
+            return cur.fetchone()[0]
+        finally:
+            cur.close()
+
+
+class MessageStoreWakeupTest(StoreTestCase):
+
+    def test_wait_unhandled_wakes_on_put(self):
+        seq = self.store.unhandled_seq
+        t = threading.Timer(0.2, self.put_ingoing, args=('wakeup-test', ))
+        t.start()
+        start = time.time()
+        self.assertEqual(self.store.wait_unhandled(seq, 10), seq + 1)
+        self.assertTrue(time.time() - start < 5)
+        t.join()
+        self.assertTrue(self.store.received_at('wakeup-test'))
+        self.store.mark_as_handled('wakeup-test')
+        self.assertEqual(self.store.received_at('wakeup-test'), None)
+
+    def test_wait_unhandled_timeout(self):
+        seq = self.store.unhandled_seq
+        self.assertEqual(self.store.wait_unhandled(seq, 0.1), seq)
+
+    def test_wakeup(self):
+        seq = self.store.unhandled_seq
+        t = threading.Timer(0.2, self.store.wakeup)
+        t.start()
+        start = time.time()
+        self.assertEqual(self.store.wait_unhandled(seq, 10), seq)
+        self.assertTrue(time.time() - start < 5)
+        t.join()
+
+
+class MessageStoreSnapshotTest(StoreTestCase):
+
+    def test_get_unhandled_returns_isolated_copies(self):
+        self.put_ingoing('snapshot-test', body={'local_ip': '10.0.0.1', 'roles': ['app']})
+
+        queue, copy1 = self.store.get_unhandled('test')[0]
+        self.assertEqual(queue, Queues.CONTROL)
+        self.assertEqual(copy1.id, 'snapshot-test')
+        self.assertEqual(copy1.name, 'HostUp')
+        self.assertEqual(copy1.local_ip, '10.0.0.1')
+        copy1.body['roles'].append('db')
+        copy1.local_ip = '10.0.0.2'
+        copy1.meta['request_id'] = 'changed'
+
+        queue, copy2 = self.store.get_unhandled('test')[0]
+        self.assertEqual(copy2.local_ip, '10.0.0.1')
+        self.assertEqual(copy2.roles, ['app'])
+        self.assertFalse('request_id' in copy2.meta)
+
+    def test_snapshot_is_lazy(self):
+        self.put_ingoing('lazy-test', body={'local_ip': '10.0.0.1'})
+        queue, snapshot = self.store.get_unhandled('test')[0]
+        self.assertFalse('_body' in snapshot.__dict__)
+        self.assertEqual(snapshot.name, 'HostUp')
+        self.assertFalse('_body' in snapshot.__dict__)
+        self.assertEqual(snapshot.body, {'local_ip': '10.0.0.1'})
+
+    def test_unhandled_restored_from_db(self):
+        self.put_ingoing('restore-test', body={'roles': ['app']})
+        store = _P2pMessageStore()
+        queue, snapshot = store.get_unhandled('test')[0]
+        self.assertEqual(snapshot.id, 'restore-test')
+        self.assertEqual(snapshot.roles, ['app'])
+        self.assertEqual(snapshot.tojson(), self.store.get_unhandled('test')[0][1].tojson())
+
+
+class MessageStoreWriteBehindTest(StoreTestCase):
+
+    def test_mark_as_handled_strips_access_data(self):
+        self.put_ingoing('write-behind-test', 'HostInitResponse',
+                         body={'platform_access_data': {'key': 'secret'}, 'roles': ['app']})
+
+        self.store.mark_as_handled('write-behind-test')
+        self.assertTrue(self.store.is_handled('write-behind-test'))
+        self.store.flush()
+
+        self.assertEqual(self.in_is_handled('write-behind-test'), 1)
+        body = self.store.load('write-behind-test', True).body
+        self.assertFalse('platform_access_data' in body)
+        self.assertEqual(body['roles'], ['app'])
+        self.assertEqual(self.store.transition_latency.count, 1)
+
+    def test_group_commit(self):
+        self.store.WRITE_BEHIND = 60
+        for i in range(3):
+            self.put_ingoing('in-%d' % i)
+        msg = P2pMessage('HostUpdate')
+        msg.id = 'out-0'
+        self.store.put_outgoing(msg, Queues.CONTROL, 'test')
+
+        for i in range(3):
+            self.store.mark_as_handled('in-%d' % i)
+        self.store.mark_as_delivered('out-0')
+        # nothing is written until flush
+        self.assertEqual(self.in_is_handled('in-0'), 0)
+
+        with mock.patch.object(sqlite_server, 'execute_batch',
+                               side_effect=sqlite_server.execute_batch) as execute_batch:
+            self.store.flush()
+        self.assertEqual(execute_batch.call_count, 1)
+        self.assertEqual(len(execute_batch.call_args[0][1]), 4)
+        self.assertEqual([self.in_is_handled('in-%d' % i) for i in range(3)], [1, 1, 1])
+        self.assertEqual(self.store.get_undelivered('test'), [])
+        self.assertEqual(self.store.transition_latency.count, 4)
+
+    def test_timer_flush(self):
+        self.store.WRITE_BEHIND = 0.05
+        self.put_ingoing('timer-test')
+        self.store.mark_as_handled('timer-test')
+        deadline = time.time() + 5
+        while self.store.transition_latency.count < 1 and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(self.in_is_handled('timer-test'), 1)
+
+    def test_failed_flush_is_retried(self):
+        self.store.WRITE_BEHIND = 60
+        self.put_ingoing('retry-test')
+        self.store.mark_as_handled('retry-test')
+        with mock.patch.object(sqlite_server, 'execute_batch',
+                               side_effect=sqlite3.OperationalError('database is locked')):
+            self.store.flush()
+        self.assertEqual(self.in_is_handled('retry-test'), 0)
+        self.store.flush()
+        self.assertEqual(self.in_is_handled('retry-test'), 1)
+
+
+class MessageStoreWriteBehindProxyTest(StoreTestCase):
+
+    def setUp(self):
+        self.db_path = setup_proxy_db()
+        self.store = _P2pMessageStore()
+
+    def test_group_commit(self):
+        self.store.WRITE_BEHIND = 60
+        for i in range(3):
+            self.put_ingoing('in-%d' % i, body={'platform_access_data': {'key': 'secret'}})
+            self.store.mark_as_handled('in-%d' % i)
+        self.store.flush()
+        self.assertEqual([self.in_is_handled('in-%d' % i) for i in range(3)], [1, 1, 1])
+        self.assertFalse('platform_access_data' in self.store.load('in-0', True).body)
+        self.assertEqual(self.store.transition_latency.count, 3)
+
+
+class MessageStoreRotateTest(StoreTestCase):
+
+    def put_outgoing(self, message_id):
+        msg = P2pMessage('HostUpdate')
+        msg.id = message_id
+        self.store.put_outgoing(msg, Queues.CONTROL, 'test')
+
+    def message_ids(self):
+        cur = bus.db.cursor()
+        try:
+            cur.execute('SELECT message_id FROM p2p_message ORDER BY id')
+            return [row[0] for row in cur.fetchall()]
+        finally:
+            cur.close()
+
+    def test_rotate_keeps_pending_messages(self):
+        self.store.TAIL_LENGTH = 5
+        self.store.ROTATE_EVERY = 1000
+        for i in range(10):
+            self.put_ingoing('in-%d' % i)
+            if i % 2:
+                self.store.mark_as_handled('in-%d' % i)
+            self.put_outgoing('out-%d' % i)
+            if i % 2:
+                self.store.mark_as_delivered('out-%d' % i)
+        self.store.rotate()
+
+        left = self.message_ids()
+        for i in range(0, 10, 2):
+            self.assertTrue('in-%d' % i in left)
+            self.assertTrue('out-%d' % i in left)
+        self.assertFalse('in-1' in left)
+        self.assertFalse('out-1' in left)
+
+    def test_rotate_caps_undelivered(self):
+        self.store.TAIL_LENGTH = 5
+        self.store.ROTATE_EVERY = 1000
+        self.store.MAX_UNDELIVERED = 3
+        self.store.ROTATE_BATCH = 2
+        for i in range(10):
+            self.put_outgoing('out-%d' % i)
+        self.put_ingoing('in-0')
+        self.store.rotate()
+
+        self.assertEqual(self.message_ids(), ['out-7', 'out-8', 'out-9', 'in-0'])
+
+    def test_insert_doesnt_rotate_inline(self):
+        self.store.ROTATE_EVERY = 2
+        rotated = threading.Event()
+        caller = []
+
+        def rotate():
+            caller.append(threading.currentThread())
+            rotated.set()
+        self.store.rotate = rotate
+
+        self.put_ingoing('in-0')
+        self.assertFalse(rotated.isSet())
+        self.put_ingoing('in-1')
+        rotated.wait(5)
+        self.assertEqual(len(caller), 1)
+        self.assertNotEqual(caller[0], threading.currentThread())
+
+    def test_periodical_task(self):
+        executor = mock.Mock()
+        with mock.patch.object(bus, 'periodical_executor', executor, create=True):
+            store = _P2pMessageStore()
+        executor.add_task.assert_called_once_with(store.rotate, store.ROTATE_INTERVAL, mock.ANY)
+
+
+class ConsumerDispatchLatencyTest(StoreTestCase):
+
+    def test_dispatch_latency(self):
+        from scalarizr.messaging.p2p.consumer import P2pMessageConsumer
+        consumer = P2pMessageConsumer('http://127.0.0.1:8013', msg_handler_enabled=False)
+        received = []
+        consumer.listeners.append(lambda message, queue: received.append(message.id))
+
+        self.put_ingoing('latency-test')
+        queue, message = self.store.get_unhandled('test')[0]
+        consumer._handle_one_message(message, queue, self.store)
+
+        self.assertEqual(received, ['latency-test'])
+        self.assertEqual(consumer.dispatch_latency.count, 1)
+        self.assertTrue(self.store.is_handled('latency-test'))
+        # restored from db, arrival time is unknown
+        self.assertEqual(self.store.received_at('latency-test'), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import time
+
+import mock
+from nose.tools import eq_
+
+from scalarizr import platform
+
+
+class _Platform(platform.Platform):
+    _conn_access_props = ('key_id', 'key')
+
+    def __init__(self):
+        platform.Platform.__init__(self)
+        self.check = mock.Mock(return_value=True)
+        self.conn_pool = self._new_conn_pool(mock.Mock, self.check)
+
+
+class TestConnectionPool(object):
+
+    def setup(self):
+        with mock.patch.object(platform.Platform, '_scalrfs'):
+            self.pl = _Platform()
+        self.pl.set_access_data({'key_id': 'id', 'key': 'secret'})
+
+    def test_same_access_data(self):
+        conn = self.pl.conn_pool.get()
+        self.pl.set_access_data({'key_id': 'id', 'key': 'secret', 'proxy': {}})
+        assert self.pl.conn_pool.get() is conn
+
+    def test_rotated_access_data(self):
+        conn = self.pl.conn_pool.get()
+        self.pl.set_access_data({'key_id': 'id', 'key': 'rotated'})
+        eq_(len(self.pl.conn_pool), 0)
+        assert self.pl.conn_pool.get() is not conn
+        assert conn.close.called
+
+    def test_idle_connection_check(self):
+        self.pl.conn_pool.max_idle = 0.01
+        conn = self.pl.conn_pool.get()
+        time.sleep(0.02)
+        assert self.pl.conn_pool.get() is conn
+        self.pl.check.assert_called_once_with(conn)
+
+    def test_idle_connection_check_failed(self):
+        self.pl.conn_pool.max_idle = 0.01
+        conn = self.pl.conn_pool.get()
+        self.pl.check.side_effect = Exception('Connection reset by peer')
+        time.sleep(0.02)
+        assert self.pl.conn_pool.get() is not conn
+        assert conn.close.called
+
+    def test_cleared_access_data(self):
+        conn = self.pl.conn_pool.get()
+        self.pl.clear_access_data()
+        assert self.pl.conn_pool.get() is not conn
@@ -0,0 +1,66 @@
+import os
+import socket
+import shutil
+import tempfile
+import unittest
+import threading
+
+from scalarizr.services import haproxy
+
+
+STAT = '# pxname,svname,status,weight,\n' \
+       'scalr:backend:80,FRONTEND,OPEN,,\n' \
+       'scalr:backend:80,10-0-0-1:80,UP,1,\n' \
+       'scalr:backend:80,BACKEND,UP,1,\n'
+
+
+class StatSocketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmp_dir, 'haproxy-stats.sock')
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.address)
+        self.listener.listen(5)
+        self.requests = []
+        self.responses = []
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.listener.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _serve(self):
+        # haproxy non-interactive mode: one request line, response, close
+        while True:
+            try:
+                conn = self.listener.accept()[0]
+            except socket.error:
+                return
+            self.requests.append(conn.makefile('r').readline().strip())
+            conn.sendall(self.responses.pop(0))
+            conn.close()
+
+    def test_show_stat(self):
+        self.responses.append(STAT)
+        stats = haproxy.StatSocket(self.address).show_stat(types=4)
+
+        self.assertEqual(['show stat -1 4 -1'], self.requests)
+        self.assertEqual(3, len(stats))
+        self.assertEqual('10-0-0-1:80', stats[1]['svname'])
+        self.assertEqual('UP', stats[1]['status'])
+
+    def test_server_commands_in_one_connection(self):
+        self.responses.extend(['\n', 'No such server.\n\n'])
+        ss = haproxy.StatSocket(self.address)
+        ss.disable_server(('scalr:backend:80', '10-0-0-1:80'), ('scalr:backend:81', '10-0-0-1:81'))
+
+        self.assertEqual(['disable server scalr:backend:80/10-0-0-1:80; '
+                          'disable server scalr:backend:81/10-0-0-1:81'], self.requests)
+        self.assertRaises(haproxy.HAProxyError, ss.enable_server, ('scalr:backend:80', 'x'))
+
+    def test_connection_error(self):
+        ss = haproxy.StatSocket(os.path.join(self.tmp_dir, 'missing.sock'))
+        self.assertRaises(haproxy.HAProxyError, ss.show_stat)
@@ -0,0 +1,186 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from scalarizr.services import postgresql
+
+
+class FakeDriver(object):
+
+    class Error(Exception):
+        pass
+
+    class OperationalError(Error):
+        pass
+
+    class InterfaceError(Error):
+        pass
+
+    def __init__(self):
+        self.connect = mock.Mock(side_effect=self._connect)
+        self.connections = []
+
+    def _connect(self, **kwds):
+        conn = mock.Mock(closed=0)
+        cursor = conn.cursor.return_value
+        cursor.description = [('?column?', )]
+        cursor.fetchall.return_value = [(1, )]
+
+        def close():
+            conn.closed = 1
+        conn.close.side_effect = close
+        self.connections.append(conn)
+        return conn
+
+
+class PSQLDriverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = FakeDriver()
+        self.patcher = mock.patch.object(postgresql, 'psycopg2', self.driver)
+        self.patcher.start()
+        self.psql = postgresql.PSQL()
+        self.psql.pool = postgresql.PgConnectionPool()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_connection_is_reused(self):
+        for _ in range(3):
+            self.assertEqual((1, ), self.psql.fetchone('SELECT 1;'))
+        self.assertEqual(1, self.driver.connect.call_count)
+        self.assertTrue(self.driver.connections[0].autocommit)
+
+    def test_broken_pooled_connection_is_replaced(self):
+        self.psql.fetchone('SELECT 1;')
+        stale = self.driver.connections[0]
+        stale.cursor.return_value.execute.side_effect = self.driver.OperationalError('server closed the connection')
+
+        self.assertEqual([(1, )], self.psql.fetchall('SELECT 1;'))
+        self.assertEqual(1, stale.closed)
+        self.assertEqual(2, self.driver.connect.call_count)
+
+    def test_query_error(self):
+        self.psql.fetchone('SELECT 1;')
+        conn = self.driver.connections[0]
+        conn.cursor.return_value.execute.side_effect = self.driver.Error('syntax error')
+
+        self.assertRaises(postgresql.PgSQLError, self.psql.fetchall, 'SELEC 1;', silent=True)
+        # connection is still usable and goes back to pool
+        self.assertEqual(0, conn.closed)
+        self.assertEqual([conn], self.psql.pool._idle[('postgres', None)])
+
+
+class PSQLSubprocessTest(unittest.TestCase):
+
+    @mock.patch.object(postgresql, 'psycopg2', None)
+    @mock.patch.object(postgresql, 'system2')
+    def test_fetchall(self, system2):
+        system2.return_value = ('postgres\x1f10\nscalr\x1f\n', '', 0)
+        rows = postgresql.PSQL().fetchall('SELECT rolname, rolconnlimit FROM pg_roles WHERE rolname != %s;',
+                                          ("o'neil", ))
+
+        self.assertEqual([('postgres', '10'), ('scalr', '')], rows)
+        self.assertEqual("SELECT rolname, rolconnlimit FROM pg_roles WHERE rolname != 'o''neil';",
+                         system2.call_args[1]['stdin'])
+
+    @mock.patch.object(postgresql, 'psycopg2', None)
+    @mock.patch.object(postgresql, 'system2')
+    def test_drop_database_outside_transaction(self, system2):
+        system2.return_value = ('', '', 0)
+        postgresql.PSQL().delete_pg_database('scalr')
+
+        self.assertEqual('DROP DATABASE IF EXISTS scalr;', system2.call_args[1]['stdin'])
+        self.assertFalse(' -1' in system2.call_args[0][0][-1])
+
+    @mock.patch.object(postgresql, 'psycopg2', None)
+    @mock.patch.object(postgresql, 'system2')
+    def test_execute_batch_single_transaction(self, system2):
+        system2.return_value = ('1\n', '', 0)
+        rows = postgresql.PSQL().execute_batch(['CREATE ROLE scalr;', 'SELECT 1'])
+
+        self.assertEqual([('1', )], rows)
+        self.assertEqual('CREATE ROLE scalr;\nSELECT 1;', system2.call_args[1]['stdin'])
+        self.assertTrue(' -1' in system2.call_args[0][0][-1])
+
+
+PG_HBA = """# TYPE  DATABASE  USER  ADDRESS  METHOD
+local\tall\tpostgres\tpassword
+
+# IPv4 local connections:
+host\tall\tall\t127.0.0.1/32\ttrust
+"""
+
+
+class PgHbaConfTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'pg_hba.conf')
+        with open(self.path, 'w') as fp:
+            fp.write(PG_HBA)
+        self.conf = postgresql.PgHbaConf(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_batch_writes_once(self):
+        with self.conf.batch():
+            for i in range(50):
+                self.assertTrue(self.conf.add_client('10.0.0.%d' % i))
+            self.assertFalse(self.conf.add_client('10.0.0.1'))
+            self.assertTrue(self.conf.delete_client('10.0.0.2'))
+
+        self.assertEqual(1, self.conf.writes)
+        text = open(self.path).read()
+        self.assertTrue(text.startswith('# TYPE  DATABASE  USER  ADDRESS  METHOD\n'))
+        self.assertTrue('# IPv4 local connections:' in text)
+        self.assertEqual(51, len(postgresql.PgHbaConf(self.path).records))
+        self.assertFalse('10.0.0.2/32' in text)
+
+    def test_replace_similar(self):
+        self.conf.allow_local_connections()
+        records = self.conf.records
+        self.assertEqual(2, len(records))
+        self.assertEqual('md5', records[1].auth_method)
+        self.assertEqual(1, self.conf.writes)
+
+    def test_failed_batch_is_discarded(self):
+        try:
+            with self.conf.batch():
+                self.conf.add_client('10.0.0.1')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(0, self.conf.writes)
+        self.assertEqual(PG_HBA, open(self.path).read())
+        self.assertEqual(2, len(self.conf.records))
+
+    def test_external_changes_are_reloaded(self):
+        self.assertEqual(2, len(self.conf.records))
+        with open(self.path, 'a') as fp:
+            fp.write('host\tall\tall\t10.1.1.1/32\tmd5\n')
+        self.assertEqual(3, len(self.conf.records))
+
+
+class PostgreSqlAccessTest(unittest.TestCase):
+
+    @mock.patch.object(postgresql.PostgreSql, 'pg_hba_conf', mock.MagicMock())
+    def test_access_batch_reloads_once(self):
+        pg = object.__new__(postgresql.PostgreSql)
+        conf = pg.pg_hba_conf
+        conf.add_client.side_effect = lambda ip: ip != '10.0.0.1'
+        pg.service = mock.Mock()
+
+        with pg.access_batch():
+            for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+                pg.register_client(ip)
+            self.assertFalse(pg.service.reload.called)
+
+        self.assertEqual(1, pg.service.reload.call_count)
+        self.assertEqual(1, conf.batch.call_count)
+        pg.register_client('10.0.0.4')
+        self.assertEqual(2, pg.service.reload.call_count)
@@ -0,0 +1,171 @@
+import time
+import socket
+import unittest
+import threading
+
+import mock
+
+from scalarizr.services import redis
+
+
+class RedisConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = redis.RedisConnection(6379)
+        self.client, self.server = socket.socketpair()
+        self.conn._sock, self.conn._fp = self.client, self.client.makefile('rb')
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.close()
+
+    def reply(self, data):
+        # Redis writes nothing to idle connection, reply once request is read
+        def serve():
+            self.sent = self.server.recv(4096)
+            self.server.sendall(data)
+        t = threading.Thread(target=serve)
+        t.start()
+        self.addCleanup(t.join)
+
+    def test_pipeline(self):
+        self.reply('+OK\r\n:5\r\n$3\r\nfoo\r\n$-1\r\n*2\r\n$1\r\na\r\n:1\r\n')
+        replies = self.conn.pipeline([
+            ('SET', 'k', u'v'), ('INCR', 'n'), ('GET', 'k'), ('GET', 'x'), ('CONFIG', 'GET', 'a')])
+
+        self.assertEqual(['OK', 5, 'foo', None, ['a', 1]], replies)
+        self.assertTrue(self.sent.startswith('*3\r\n$3\r\nSET\r\n$1\r\nk\r\n$1\r\nv\r\n*2\r\n$4\r\nINCR\r\n'))
+
+    def test_error_reply_keeps_stream_in_sync(self):
+        self.reply('-ERR unknown command\r\n+PONG\r\n')
+        replies = self.conn.pipeline([('FOO',), ('PING',)], raise_on_error=False)
+        self.assertTrue(isinstance(replies[0], redis.RedisResponseError))
+        self.assertEqual('PONG', replies[1])
+
+        self.reply('-ERR unknown command\r\n')
+        self.assertRaises(redis.RedisResponseError, self.conn.call, 'FOO')
+
+    def test_reconnect_idle_connection_closed_by_server(self):
+        self.server.close()
+        client, self.server = socket.socketpair()
+
+        def connect():
+            self.conn._sock, self.conn._fp = client, client.makefile('rb')
+        self.server.sendall('+PONG\r\n')
+        with mock.patch.object(self.conn, 'connect', side_effect=connect) as m:
+            self.assertEqual('PONG', self.conn.call('PING'))
+        self.assertEqual(1, m.call_count)
+
+    def test_no_resend_after_write(self):
+        def close_without_reply():
+            self.server.recv(4096)
+            self.server.close()
+        t = threading.Thread(target=close_without_reply)
+        t.start()
+        self.conn.connect = mock.Mock()
+        self.assertRaises(EOFError, self.conn.call, 'INCR', 'n')
+        t.join()
+        self.assertFalse(self.conn.connect.called)
+        self.assertEqual(None, self.conn._sock)
+
+
+class RedisCLITest(unittest.TestCase):
+
+    def test_info_is_cached_inside_block(self):
+        cli = redis.RedisCLI(port=6379)
+        calls = []
+
+        def execute(args, silent=False):
+            calls.append(args)
+            return 'role:slave\r\nmaster_link_status:up\r\nmaster_sync_in_progress:0\r\n'
+        cli.execute = execute
+
+        with cli.cached_info():
+            self.assertEqual('up', cli.master_link_status)
+            self.assertFalse(cli.master_sync_in_progress)
+        self.assertEqual(1, len(calls))
+
+        cli.role
+        self.assertEqual(2, len(calls))
+
+
+class RedisInstancesTest(unittest.TestCase):
+
+    class Instance(object):
+        def __init__(self, port):
+            self.port = port
+
+    def setUp(self):
+        self.ri = redis.RedisInstances.__new__(redis.RedisInstances)
+        self.ri.instances = [self.Instance(port) for port in range(6379, 6387)]
+
+    def test_map_runs_concurrently(self):
+        barrier = threading.Semaphore(0)
+        active = []
+
+        def fn(instance):
+            active.append(instance.port)
+            if len(active) == self.ri.concurrency:
+                for _ in range(self.ri.concurrency):
+                    barrier.release()
+            # blocks forever if instances are processed one by one
+            self.assertTrue(wait_acquire(barrier))
+            return instance.port
+
+        self.ri.concurrency = 4
+        self.ri.instances = self.ri.instances[:4]
+        self.assertEqual([6379, 6380, 6381, 6382], self.ri._map('test', fn))
+
+    def test_map_aggregates_errors(self):
+        done = []
+
+        def fn(instance):
+            if instance.port in (6380, 6383):
+                raise Exception('boom %s' % instance.port)
+            done.append(instance.port)
+
+        try:
+            self.ri._map('restart', fn)
+            self.fail('RedisInstancesError expected')
+        except redis.RedisInstancesError, e:
+            self.assertEqual([6380, 6383], sorted(e.errors))
+            self.assertTrue('boom 6383' in str(e))
+        self.assertEqual(6, len(done))
+
+    @mock.patch.object(redis, 'chown_r')
+    @mock.patch.object(redis.os.path, 'exists', return_value=True)
+    def test_init_as_masters_prepares_mpoint_once(self, exists, chown_r):
+        for instance in self.ri.instances:
+            instance.init_master = mock.Mock()
+            instance.password = None
+        self.ri.init_as_masters('/mnt/redisstorage')
+
+        chown_r.assert_called_once_with('/mnt/redisstorage', redis.__redis__['defaults']['user'])
+        for instance in self.ri.instances:
+            instance.init_master.assert_called_once_with('/mnt/redisstorage', mpoint_ready=True)
+
+
+def wait_acquire(sem, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if sem.acquire(False):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class PortsTest(unittest.TestCase):
+
+    @mock.patch.object(redis, '_ps_redis')
+    def test_busy_ports(self, ps):
+        server = redis.__redis__['redis-server']
+        ps.return_value = [
+            '%s %s' % (server, redis.__redis__['defaults']['redis.conf']),
+            '%s /etc/redis/redis.6380.conf' % server,
+            '%s *:6385' % server,
+            'redis-aof-rewrite 6390',
+        ]
+        self.assertEqual([6379, 6380, 6385], redis.get_busy_ports())
+        self.assertEqual(set(redis.__redis__['ports_range']) - set([6379, 6380, 6385]),
+                         set(redis.get_available_ports()))
+        self.assertEqual(2, ps.call_count)
@@ -0,0 +1,206 @@
+from __future__ import with_statement
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import urlparse
+import threading
+import cStringIO
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import mock
+
+from scalarizr.storage2 import largetransfer
+from scalarizr.storage2.cloudfs import NamedStream
+
+
+class TestSplitToBuffers(object):
+
+    def test_chunks(self):
+        data = os.urandom(2500)
+        stream = NamedStream(cStringIO.StringIO(data), 'backup')
+        buffers = largetransfer.ChunkBufferPool(1, 1000)
+
+        chunks = []
+        for buf in largetransfer.split_to_buffers(stream, buffers, extension='gz'):
+            chunk = buf.read()
+            assert buf.md5_sum == hashlib.md5(chunk).hexdigest()
+            assert buf.size == len(chunk)
+            chunks.append((buf.name, chunk))
+            # single buffer pool: next chunk can be read only after release
+            buffers.release(buf)
+
+        assert [name for name, _ in chunks] == ['backup.gz.000', 'backup.gz.001', 'backup.gz.002']
+        assert ''.join(chunk for _, chunk in chunks) == data
+
+    def test_buffer_is_seekable(self):
+        buf = largetransfer.ChunkBuffer(100)
+        buf.fill(cStringIO.StringIO('0123456789'), 'chunk.000')
+
+        assert buf.read(4) == '0123'
+        buf.seek(0, os.SEEK_END)
+        assert buf.tell() == 10
+        assert buf.read() == ''
+        buf.seek(-3, os.SEEK_END)
+        assert buf.read() == '789'
+        buf.seek(0)
+        assert buf.read() == '0123456789'
+
+    def test_buffer_write(self):
+        buf = largetransfer.ChunkBuffer(10)
+        buf.write('garbage')
+        # get() retry starts from scratch
+        buf.truncate()
+        buf.write('01234')
+        buf.write(buffer('56789'))
+
+        assert buf.size == 10
+        assert buf.md5_sum == hashlib.md5('0123456789').hexdigest()
+        try:
+            buf.write('x')
+            assert False, 'ValueError expected'
+        except ValueError:
+            pass
+
+        out = cStringIO.StringIO()
+        buf.write_to(out, block_size=3)
+        assert out.getvalue() == '0123456789'
+
+
+class _Downloader(object):
+    '''
+    Fake _Transfer('get'): completes submitted chunks from a thread, newest first
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = []
+        self.completed = []
+        self.submitted = 0
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def apply_async(self, src, dst, complete_cb=None, progress_cb=None):
+        with self.cond:
+            self.pending.append((src, dst, complete_cb))
+            self.submitted += 1
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            # Let more chunks come, so they complete out of order
+            time.sleep(0.02)
+            with self.cond:
+                src, buf, complete_cb = self.pending.pop()
+            name = os.path.basename(src.path)
+            buf.truncate()
+            buf.write(self.chunks[name])
+            self.completed.append(name)
+            try:
+                complete_cb({'src': src.path, 'dst': buf, 'size': src.size, 'md5_sum': src.md5_sum,
+                             'retry': 0, 'status': 'done', 'result': buf, 'error': None})
+            except largetransfer.MD5SumError:
+                # _Worker logs it, consumer gets it from _stream_chunks
+                pass
+
+
+class TestStreamChunks(object):
+
+    def setup(self):
+        self.chunks = dict(('backup.%03d' % i, os.urandom(100 + i)) for i in range(7))
+        self.download = largetransfer.Download('s3://bucket/backups/manifest.json',
+                                               pool_size=2, streaming=True)
+        self.download._manifest['files'] = [{
+            'name': 'backup', 'streamer': None, 'compressor': None,
+            'chunks': [(name, hashlib.md5(data).hexdigest(), len(data))
+                       for name, data in sorted(self.chunks.items())]}]
+        self.downloader = _Downloader(self.chunks)
+
+    def teardown(self):
+        shutil.rmtree(self.download._tmp_dir, ignore_errors=True)
+
+    def test_out_of_order_completion(self):
+        names = []
+        in_flight = []
+        for buf, streamer, compressor in self.download._stream_chunks(self.downloader, 's3://bucket/backups'):
+            buf.seek(0)
+            assert buf.read() == self.chunks[buf.name]
+            names.append(buf.name)
+            in_flight.append(self.downloader.submitted - len(names))
+        assert names == sorted(self.chunks)
+        assert self.downloader.completed != sorted(self.chunks), self.downloader.completed
+        # reorder buffer is bounded by pool_size + 1 chunk buffers
+        assert max(in_flight) <= 2, in_flight
+
+    def test_reorder_buffer_is_bounded(self):
+        chunks = self.download._stream_chunks(self.downloader, 's3://bucket/backups')
+        chunks.next()
+        time.sleep(0.2)
+        # consumer holds the head buffer, downloader may fill the other two only
+        assert self.downloader.submitted == 3
+
+    def test_md5_mismatch(self):
+        self.chunks['backup.003'] = 'corrupted'
+        try:
+            for _ in self.download._stream_chunks(self.downloader, 's3://bucket/backups'):
+                pass
+            assert False, 'MD5SumError expected'
+        except largetransfer.MD5SumError:
+            pass
+
+
+class TestRoundTrip(object):
+
+    def setup(self):
+        self.workdir = tempfile.mkdtemp(prefix='szr-test-')
+        self.data = os.urandom(3 * 1024 * 1024 + 1000)
+
+    def teardown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def upload(self, streaming):
+        path = os.path.join(self.workdir, 'backup')
+        with open(path, 'wb') as fp:
+            fp.write(self.data)
+        src = NamedStream(open(path, 'rb'), 'backup')
+        up = largetransfer.Upload(src, 'file://%s' % os.path.join(self.workdir, str(streaming)),
+                                  gzip=False, chunk_size=1, streaming=streaming)
+        up.apply_async()
+        up.join()
+        return up.manifest.cloudfs_path
+
+    def download(self, manifest, streaming):
+        dl = largetransfer.Download(manifest, streaming=streaming)
+        dl.apply_async()
+        out = dl.output.read()
+        dl.join()
+        return out
+
+    def test_all_modes(self):
+        for up_streaming in (False, True):
+            manifest = self.upload(up_streaming)
+            for down_streaming in (False, True):
+                assert self.download(manifest, down_streaming) == self.data, \
+                    (up_streaming, down_streaming)
+
+    def test_manifest_without_chunk_sizes(self):
+        manifest = self.upload(False)
+        path = urlparse.urlparse(manifest).path
+        data = json.load(open(path))
+        for f in data['files']:
+            f['chunks'] = [chunk[:2] for chunk in f['chunks']]
+        json.dump(data, open(path, 'w'))
+
+        stream_chunks = mock.Mock(side_effect=AssertionError('tmp dir path expected'))
+        with mock.patch.object(largetransfer.Download, '_stream_chunks', stream_chunks):
+            assert self.download(manifest, True) == self.data
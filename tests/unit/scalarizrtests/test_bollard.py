@@ -0,0 +1,180 @@
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import time
+import Queue
+import threading
+import unittest
+
+import mock
+
+from scalarizr import bollard
+from scalarizr import rpc
+from scalarizr.api.executor import ExecutorAPI
+
+
+class TestAsyncResultGet(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(bollard.Executor, '_started', 1),
+            mock.patch.object(bollard.Task, 'in_db', return_value=True),
+            mock.patch.object(bollard.Task, 'load')
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.task = bollard.Task.create('noop')
+
+    def tearDown(self):
+        bollard._Waiter._waiters.clear()
+
+    def test_notify_wakes_get(self):
+        finished = bollard.Task(task_id=self.task['task_id'], state='completed', result='42')
+        timer = threading.Timer(0.1, bollard._Waiter.notify, args=(finished, ))
+        timer.start()
+        result = bollard.AsyncResult(self.task).get(timeout=5)
+        timer.join()
+        self.assertEqual(result, 42)
+        self.assertEqual(bollard._Waiter._waiters, {})
+
+    def test_timeout_removes_waiter(self):
+        res = bollard.AsyncResult(self.task)
+        self.assertRaises(bollard.TimeoutError, res.get, timeout=0.1)
+        self.assertEqual(bollard._Waiter._waiters, {})
+
+    def test_shared_waiter(self):
+        task_id = self.task['task_id']
+        waiter = bollard._Waiter.register(task_id)
+        self.assertTrue(bollard._Waiter.register(task_id) is waiter)
+        bollard._Waiter.unregister(task_id, waiter)
+        self.assertTrue(task_id in bollard._Waiter._waiters)
+        bollard._Waiter.unregister(task_id, waiter)
+        self.assertFalse(task_id in bollard._Waiter._waiters)
+
+
+class TestTaskQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = bollard._TaskQueue({'backup': 1})
+
+    def test_task_limits(self):
+        backup1, backup2, other = [bollard.Task.create(name) for name in ('backup', 'backup', 'other')]
+        for task in (backup1, backup2, other):
+            self.queue.put(task)
+        self.assertTrue(self.queue.get_for('w1', timeout=0) is backup1)
+        self.assertEqual(self.queue.qsize(), 1)
+        self.assertEqual(self.queue.depth, 2)
+        self.assertTrue(self.queue.get_for('w2', timeout=0) is other)
+        self.assertRaises(Queue.Empty, self.queue.get_for, 'w2', timeout=0)
+        self.queue.finished(backup1['task_id'])
+        self.assertTrue(self.queue.get_for('w1', timeout=0) is backup2)
+        self.assertEqual(self.queue.running(), {'backup': 1, 'other': 1})
+
+    def test_retire(self):
+        self.queue.put(bollard.Task.create('other'))
+        self.queue.get_for('busy', timeout=0)
+        self.assertFalse(self.queue.retire('busy'))
+        self.assertTrue(self.queue.retire('idle'))
+        self.queue.put(bollard.Task.create('other'))
+        self.assertEqual(self.queue.get_for('idle', timeout=0), None)
+        self.assertEqual(self.queue.qsize(), 1)
+
+    def test_retire_wakes_waiting_worker(self):
+        timer = threading.Timer(0.1, self.queue.retire, args=('idle', ))
+        timer.start()
+        self.assertEqual(self.queue.get_for('idle', timeout=5), None)
+        timer.join()
+
+
+class _Worker(object):
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def stop(self):
+        self.alive = False
+
+
+class TestExecutorPool(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = bollard.Executor(min_workers=1, max_workers=4)
+        self.launched = []
+        self.executor._launch_worker = self._launch_worker
+
+    def tearDown(self):
+        bollard.Executor._workers.pop(self.executor, None)
+
+    def _launch_worker(self, wait=False):
+        worker = _Worker('w%d' % len(self.launched))
+        self.launched.append(worker)
+        self.executor._push_queue.worker_added(worker.worker_id)
+        self.executor.workers.append(worker)
+        return worker
+
+    def test_grow(self):
+        self.executor._check_workers()
+        self.assertEqual(len(self.executor.workers), 1)
+        for i in range(3):
+            self.executor._push_queue.put(bollard.Task.create('other'))
+        self.executor._check_workers()
+        self.assertEqual(len(self.executor.workers), 3)
+        for i in range(5):
+            self.executor._push_queue.put(bollard.Task.create('other'))
+        self.executor._check_workers()
+        self.assertEqual(len(self.executor.workers), 4)
+
+    def test_replace_dead(self):
+        self.executor._check_workers()
+        self.launched[0].alive = False
+        self.assertTrue(self.executor._check_workers())
+        self.assertEqual([w.worker_id for w in self.executor.workers], ['w1'])
+
+    def test_shrink(self):
+        queue = self.executor._push_queue
+        for i in range(3):
+            self._launch_worker()
+        queue.put(bollard.Task.create('other'))
+        queue.get_for('w0', timeout=0)
+
+        with mock.patch.object(bollard, 'WORKER_IDLE_TIMEOUT', 60):
+            self.executor._check_workers()
+            self.assertEqual(len(self.executor.workers), 3)
+            with mock.patch.object(time, 'time', return_value=time.time() + 61):
+                self.executor._check_workers()
+                self.executor._check_workers()
+                self.executor._check_workers()
+        # busy worker is kept, idle ones are stopped down to min_workers
+        self.assertEqual([w.worker_id for w in self.executor.workers], ['w0'])
+        self.assertFalse(self.launched[1].alive or self.launched[2].alive)
+
+    def test_stats(self):
+        for i in range(2):
+            self._launch_worker()
+        self.executor._push_queue.put(bollard.Task.create('backup'))
+        self.executor._push_queue.get_for('w0', timeout=0)
+        stats = self.executor.stats()
+        self.assertEqual(stats['workers'], 2)
+        self.assertEqual(stats['busy_workers'], 1)
+        self.assertEqual(stats['utilisation'], 0.5)
+        self.assertEqual(stats['running'], {'backup': 1})
+
+    def test_stats_rpc(self):
+        self._launch_worker()
+        self.executor._push_queue.put(bollard.Task.create('backup'))
+        handler = rpc.RequestHandler({'executor': ExecutorAPI(self.executor)})
+        resp = json.loads(handler.handle_request(
+                json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'stats', 'params': {}}),
+                namespace='executor'))
+        self.assertEqual(resp['result']['workers'], 1)
+        self.assertEqual(resp['result']['queue_depth'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
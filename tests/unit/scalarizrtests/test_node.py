@@ -1,4 +1,7 @@
 import os
+import shutil
+import tempfile
+import ConfigParser
  
 import mock
  
@@ -147,3 +150,61 @@ class TestIni(object):
             if os.path.exists(filename):
                 os.remove(filename)
  
+
+
+class TestStatCache(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, data):
+        filename = os.path.join(self.tmp_dir, name)
+        with open(filename, 'w') as fp:
+            fp.write(data)
+        return filename
+
+    def test_ini_parsed_once(self):
+        filename = self._write('node.ini', '[mysql]\nroot_password = abc\n')
+        store = node.Ini(filename, 'mysql')
+        with mock.patch('ConfigParser.ConfigParser', wraps=ConfigParser.ConfigParser) as parser:
+            for _ in range(10):
+                eq_(store['root_password'], 'abc')
+        eq_(parser.call_count, 1)
+
+    def test_ini_reloaded_on_change(self):
+        filename = self._write('node.ini', '[mysql]\nroot_password = abc\n')
+        store = node.Ini(filename, 'mysql')
+        eq_(store['root_password'], 'abc')
+        self._write('node.ini', '[mysql]\nroot_password = abcdef\n')
+        eq_(store['root_password'], 'abcdef')
+
+    def test_ini_write_through(self):
+        filename = self._write('node.ini', '[mysql]\nroot_password = abc\n')
+        store = node.Ini(filename, 'mysql')
+        store['root_password'] = 'xyz'
+        with mock.patch.object(store, '_reload') as reload:
+            eq_(store['root_password'], 'xyz')
+        assert not reload.called
+
+    def test_file(self):
+        filename = self._write('state', 'running\n')
+        store = node.File(filename)
+        eq_(store['state'], 'running')
+        self._write('state', 'terminating')
+        eq_(store['state'], 'terminating')
+        store['state'] = 'stopped'
+        with mock.patch('__builtin__.open') as open_:
+            eq_(store['state'], 'stopped')
+        assert not open_.called
+
+    def test_json(self):
+        filename = self._write('volume.json', '{"type": "eph"}')
+        store = node.Json(filename, mock.Mock())
+        store['volume']
+        store['volume']
+        eq_(store.fn.call_count, 1)
+        self._write('volume.json', '{"type": "lvm", "vg": "mysql"}')
+        store['volume']
+        store.fn.assert_called_with(type='lvm', vg='mysql')
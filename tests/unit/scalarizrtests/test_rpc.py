@@ -0,0 +1,163 @@
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import time
+import threading
+
+import mock
+from nose.tools import eq_, raises
+
+from scalarizr import rpc
+
+
+class MyService(object):
+
+    @rpc.service_method
+    def foo(self, value=None):
+        return value or 'bar'
+
+    @rpc.service_method
+    def unserializable(self):
+        return object()
+
+    @rpc.service_method
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return threading.current_thread().name
+
+    @rpc.service_method
+    def exit_in_thread(self):
+        if threading.current_thread().name != 'MainThread':
+            raise SystemExit()
+        time.sleep(0.1)
+        return 'main'
+
+
+class OtherService(object):
+
+    @rpc.service_method
+    def baz(self):
+        return 'qux'
+
+
+class TestRequestHandler(object):
+
+    def setup(self):
+        self.handler = rpc.RequestHandler({None: MyService()})
+
+    def _call(self, method, **params):
+        return json.loads(self.handler.handle_request(
+                        {'id': 1, 'method': method, 'params': params}))
+
+    def test_result(self):
+        eq_(self._call('foo', value='baz'), {'id': 1, 'result': 'baz'})
+
+    def test_serialized_once(self):
+        with mock.patch.object(rpc.json, 'dumps', wraps=json.dumps) as dumps:
+            self._call('foo')
+        eq_(dumps.call_count, 1)
+
+    def test_unserializable_result(self):
+        resp = self._call('unserializable')
+        eq_(resp['error']['code'], rpc.ServiceError.INTERNAL)
+        assert resp['error']['message'].startswith('TypeError')
+
+    def test_method_not_found(self):
+        resp = self._call('undefined')
+        eq_(resp['error']['code'], rpc.ServiceError.METHOD_NOT_FOUND)
+
+    def test_no_namespace_prefix_in_single_request(self):
+        self.handler.services['other'] = OtherService()
+        resp = self._call('other.baz')
+        eq_(resp['error']['code'], rpc.ServiceError.METHOD_NOT_FOUND)
+
+
+class TestBatch(object):
+
+    def setup(self):
+        self.handler = rpc.RequestHandler({None: MyService(), 'other': OtherService()})
+
+    def _call(self, batch):
+        return json.loads(self.handler.handle_request(json.dumps(batch)))
+
+    def test_batch(self):
+        resp = self._call([
+            {'jsonrpc': '2.0', 'id': 1, 'method': 'foo', 'params': {}},
+            {'jsonrpc': '2.0', 'id': 2, 'method': 'other.baz', 'params': {}},
+            {'jsonrpc': '2.0', 'id': 3, 'method': 'undefined', 'params': {}},
+            {'jsonrpc': '2.0', 'id': 4, 'method': 'unserializable', 'params': {}},
+        ])
+        eq_(resp[0], {'jsonrpc': '2.0', 'id': 1, 'result': 'bar'})
+        eq_(resp[1], {'jsonrpc': '2.0', 'id': 2, 'result': 'qux'})
+        eq_(resp[2]['error']['code'], rpc.ServiceError.METHOD_NOT_FOUND)
+        eq_(resp[3]['error']['code'], rpc.ServiceError.INTERNAL)
+
+    def test_bounded_concurrency(self):
+        self.handler.batch_workers = 2
+        batch = [{'id': i, 'method': 'sleep', 'params': {'seconds': 0.05}} for i in range(6)]
+        start = time.time()
+        resp = self._call(batch)
+        elapsed = time.time() - start
+        assert 0.15 <= elapsed < 0.3, elapsed
+        eq_(len(set(item['result'] for item in resp)), 2)
+
+    def test_worker_killed(self):
+        self.handler.batch_workers = 2
+        resp = self._call([{'jsonrpc': '2.0', 'id': i, 'method': 'exit_in_thread', 'params': {}}
+                           for i in range(2)])
+        eq_(sorted(item.get('result') for item in resp), [None, 'main'])
+        killed = [item for item in resp if 'error' in item][0]
+        eq_(killed['error']['code'], rpc.ServiceError.INTERNAL)
+        eq_(killed['jsonrpc'], '2.0')
+        assert killed['id'] in (0, 1)
+
+    def test_invalid_batch(self):
+        eq_(self._call([])['error']['code'], rpc.ServiceError.INVALID_REQUEST)
+        resp = self._call([1])
+        eq_(resp[0]['error']['code'], rpc.ServiceError.INVALID_REQUEST)
+
+
+class _LocalProxy(rpc.ServiceProxy):
+
+    def __init__(self, handler):
+        rpc.ServiceProxy.__init__(self)
+        self.handler = handler
+        self.exchanges = 0
+
+    def exchange(self, request):
+        self.exchanges += 1
+        namespace = '/'.join(self.local.method[0:-1]) or None
+        return self.handler.handle_request(request, namespace)
+
+
+class TestServiceProxyBatch(object):
+
+    def setup(self):
+        self.proxy = _LocalProxy(
+                rpc.RequestHandler({None: MyService(), 'other': OtherService()}))
+
+    def test_batch(self):
+        with self.proxy.batch() as batch:
+            foo = batch.foo(value='baz')
+            baz = batch.other.baz()
+        eq_((foo.result, baz.result), ('baz', 'qux'))
+        eq_(self.proxy.exchanges, 1)
+
+    def test_execute(self):
+        batch = self.proxy.batch()
+        batch.foo()
+        batch.other.baz()
+        eq_(batch.execute(), ['bar', 'qux'])
+        eq_(batch.execute(), [])
+
+    @raises(rpc.ServiceError)
+    def test_error(self):
+        batch = self.proxy.batch()
+        foo = batch.foo()
+        batch.undefined()
+        try:
+            batch.execute()
+        finally:
+            eq_(foo.result, 'bar')
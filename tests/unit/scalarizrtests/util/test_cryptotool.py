@@ -4,9 +4,13 @@ Created on Apr 7, 2010
 @author: marat
 '''
  
-from scalarizr.util import cryptotool, init_tests
+from scalarizr.util import cryptotool
 import unittest
 import binascii
+import hashlib
+import hmac
+import tempfile
+import os
  
 class Test(unittest.TestCase):
  
@@ -24,9 +28,54 @@ class Test(unittest.TestCase):
         self.assertEqual(so, "12345678")
  
         print so
+
+    def test_calculate_md5_sum(self):
+        data = os.urandom(10000)
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            # buffer smaller than file and not a multiple of its size
+            self.assertEqual(cryptotool.calculate_md5_sum(path, 3000),
+                             hashlib.md5(data).hexdigest())
+            self.assertEqual(cryptotool.calculate_md5_sum(path),
+                             hashlib.md5(data).hexdigest())
+        finally:
+            os.remove(path)
+
+    def test_read_key(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, binascii.b2a_base64('a' * 40))
+            os.close(fd)
+            self.assertEqual(cryptotool.read_key(path), 'a' * 40)
+
+            # served from cache while the file is unchanged
+            cached = cryptotool._keys[path]
+            cryptotool._keys[path] = (cached[0], 'cached')
+            self.assertEqual(cryptotool.read_key(path), 'cached')
+
+            cryptotool.forget_key(path)
+            self.assertEqual(cryptotool.read_key(path), 'a' * 40)
+
+            with open(path, 'w') as fp:
+                fp.write(binascii.b2a_base64('b' * 41))
+            self.assertEqual(cryptotool.read_key(path), 'b' * 41)
+        finally:
+            cryptotool.forget_key()
+            os.remove(path)
+
+    def test_sign(self):
+        key = 'k' * 40
+        data = 'x' * 5000
+        timestamp = (2014, 1, 1, 0, 0, 0, 2, 1, 0)
+        date = '%s' % cryptotool.sign_http_request(data, key, timestamp)[1]
+        expected = binascii.b2a_base64(hmac.new(key, data + date, hashlib.sha1).digest())[:-1]
+        self.assertEqual(cryptotool.sign_http_request(data, key, timestamp)[0], expected)
+        # keyed state is reused, not updated
+        self.assertEqual(cryptotool.sign_http_request(data, key, timestamp)[0], expected)
  
  
 if __name__ == "__main__":
-    init_tests()
     unittest.main()
  
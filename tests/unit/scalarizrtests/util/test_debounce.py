@@ -0,0 +1,55 @@
+import time
+import threading
+
+from scalarizr.util import Debounce
+
+
+class TestDebounce(object):
+
+    def test_coalesce(self):
+        calls = []
+        done = threading.Event()
+
+        def fn():
+            calls.append(1)
+            done.set()
+
+        debounce = Debounce(fn, 0.05)
+        for _ in range(10):
+            debounce()
+        assert debounce.pending
+        done.wait(5)
+        time.sleep(0.05)
+        assert calls == [1]
+        assert (debounce.calls, debounce.runs) == (10, 1)
+        assert not debounce.pending
+
+    def test_flush(self):
+        calls = []
+        debounce = Debounce(lambda: calls.append(1), 60)
+        debounce.flush()
+        assert calls == []
+        debounce()
+        debounce.flush()
+        assert calls == [1]
+        assert not debounce.pending
+
+    def test_cancel(self):
+        calls = []
+        debounce = Debounce(lambda: calls.append(1), 0.01)
+        debounce()
+        assert debounce.cancel()
+        time.sleep(0.05)
+        assert calls == []
+        assert not debounce.cancel()
+
+    def test_callable_delay(self):
+        calls = []
+        settings = {'delay': 60}
+        debounce = Debounce(lambda: calls.append(1), lambda: settings['delay'])
+        debounce()
+        debounce.cancel()
+        settings['delay'] = 0.01
+        debounce()
+        time.sleep(0.1)
+        assert calls == [1]
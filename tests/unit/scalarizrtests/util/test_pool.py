@@ -0,0 +1,160 @@
+import time
+import httplib
+import threading
+import BaseHTTPServer
+
+import mock
+from nose.tools import eq_
+
+from scalarizr.util import KeyedLocalPool
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class _StubServer(BaseHTTPServer.HTTPServer):
+    # counts accepted TCP connections
+    accepted = 0
+
+    def get_request(self):
+        self.accepted += 1
+        return BaseHTTPServer.HTTPServer.get_request(self)
+
+    def process_request(self, request, client_address):
+        t = threading.Thread(target=self.finish_request_and_close,
+                        args=(request, client_address))
+        t.setDaemon(True)
+        t.start()
+
+    def finish_request_and_close(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class TestKeyedLocalPool(object):
+
+    def setup(self):
+        self.server = _StubServer(('127.0.0.1', 0), _Handler)
+        t = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        t.setDaemon(True)
+        t.start()
+        self.access_key = 'key-1'
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _connect(self):
+        return httplib.HTTPConnection('127.0.0.1', self.server.server_address[1])
+
+    def _request(self, pool):
+        conn = pool.get()
+        conn.request('GET', '/')
+        resp = conn.getresponse()
+        eq_(resp.read(), 'ok')
+
+    def test_reuse_connection(self):
+        pool = KeyedLocalPool(self._connect)
+        for _ in range(10):
+            self._request(pool)
+        eq_(self.server.accepted, 1)
+        eq_(pool.stats['created'], 1)
+        eq_(pool.stats['reused'], 9)
+
+    def test_thread_local(self):
+        pool = KeyedLocalPool(self._connect)
+        def worker():
+            for _ in range(5):
+                self._request(pool)
+        threads = [threading.Thread(target=worker) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        eq_(self.server.accepted, 3)
+        eq_(len(pool), 3)
+
+    def test_refresh_on_key_change(self):
+        pool = KeyedLocalPool(self._connect, key_fn=lambda: self.access_key)
+        self._request(pool)
+        first = pool.get()
+        self.access_key = 'key-2'
+        self._request(pool)
+        assert pool.get() is not first
+        assert first.sock is None  # closed
+        eq_(pool.stats['refreshed'], 1)
+        eq_(self.server.accepted, 2)
+
+    def test_bounded(self):
+        pool = KeyedLocalPool(mock.Mock, pool_size=2)
+        first = pool.get()
+        def worker():
+            pool.get()
+        for _ in range(2):
+            t = threading.Thread(target=worker)
+            t.start()
+            t.join()
+        eq_(len(pool), 2)
+        eq_(pool.stats['evicted'], 1)
+        # owner thread closes evicted connection on its next get()
+        assert not first.close.called
+        assert pool.get() is not first
+        assert first.close.called
+
+    def test_health_check(self):
+        check = mock.Mock(return_value=True)
+        pool = KeyedLocalPool(mock.Mock, max_idle=0.01, check=check)
+        conn = pool.get()
+        time.sleep(0.02)
+        assert pool.get() is conn
+        check.assert_called_once_with(conn)
+
+        check.return_value = False
+        time.sleep(0.02)
+        assert pool.get() is not conn
+        eq_(pool.stats['expired'], 1)
+        assert conn.close.called
+
+    def test_dispose(self):
+        pool = KeyedLocalPool(mock.Mock)
+        conn = pool.get()
+        pool.dispose_local()
+        assert conn.close.called
+        assert pool.get() is not conn
+        pool.dispose_all()
+        eq_(len(pool), 0)
+        eq_(pool.stats['disposed'], 2)
+
+    def test_dispose_all_leaves_other_threads_connections(self):
+        pool = KeyedLocalPool(mock.Mock)
+        conns = []
+        got, disposed = threading.Event(), threading.Event()
+        def worker():
+            conns.append(pool.get())
+            got.set()
+            disposed.wait(5)
+            # in-flight request isn't interrupted
+            closed.append(conns[0].close.called)
+            conns.append(pool.get())
+        closed = []
+        t = threading.Thread(target=worker)
+        t.start()
+        got.wait(5)
+        pool.dispose_all()
+        disposed.set()
+        t.join()
+        eq_(closed, [False])
+        assert conns[0].close.called
+        assert conns[1] is not conns[0]
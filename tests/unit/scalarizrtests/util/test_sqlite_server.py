@@ -111,6 +111,22 @@ INSERT INTO test_clients_update VALUES (1, 'Mr. First', 36);
         assert cur.fetchall() is None
  
  
+    def test_execute_batch(self):
+        CONN.executescript('''
+DROP TABLE IF EXISTS test_batch;
+CREATE TABLE test_batch ("id" INTEGER PRIMARY KEY, "name" TEXT);
+''')
+        cur = CONN.cursor()
+        cur.execute_batch([('INSERT INTO test_batch VALUES (?, ?)', [1, 'one']),
+                           ('INSERT INTO test_batch VALUES (?, ?)', [2, 'two'])])
+        assert_raises(sqlite3.IntegrityError, cur.execute_batch,
+                      [('INSERT INTO test_batch VALUES (?, ?)', [3, 'three']),
+                       ('INSERT INTO test_batch VALUES (?, ?)', [1, 'duplicate'])])
+        # statement after failed batch runs in autocommit mode again
+        cur.execute('INSERT INTO test_batch VALUES (?, ?)', [4, 'four'])
+        cur.execute('SELECT id FROM test_batch ORDER BY id')
+        assert cur.fetchall() == [(1, ), (2, ), (4, )]
+
     def test_rowcount(self):
         pass
  
@@ -179,3 +195,78 @@ class TestSQLiteServer(object):
         cur.execute('select 1')
         assert cur.fetchone() == (1, )
  
+
+ 
+class TestLocalConnection(object):
+    DATABASE = '/tmp/sqlite_local_connection_test.db'
+ 
+    @classmethod
+    def setup_class(cls):
+        cls.conn = sqlite_server.LocalConnection(
+                lambda: sqlite3.Connection(database=cls.DATABASE))
+        cls.conn.executescript('''
+DROP TABLE IF EXISTS test_clients;
+CREATE TABLE test_clients (
+"id" INTEGER PRIMARY KEY,
+"name" TEXT,
+"age" INTEGER
+);
+INSERT INTO test_clients VALUES (1, 'Mr. First', 36);
+''')
+ 
+    @classmethod
+    def teardown_class(cls):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(cls.DATABASE + suffix):
+                os.remove(cls.DATABASE + suffix)
+ 
+    def test_wal_enabled(self):
+        cur = self.conn.cursor()
+        cur.execute('PRAGMA journal_mode')
+        assert cur.fetchone() == ('wal', )
+ 
+    def test_execute_fetch(self):
+        cur = self.conn.cursor()
+        cur.execute('UPDATE test_clients SET age = ? WHERE id = ?', [37, 1])
+        assert cur.rowcount == 1
+        cur.execute('SELECT * FROM test_clients WHERE id = ?', (1, ))
+        assert cur.fetchone() == (1, 'Mr. First', 37)
+        assert cur.fetchone() is None
+        cur.execute('SELECT id FROM test_clients WHERE id = 1')
+        assert cur.fetchall() == [(1, )]
+        assert cur.fetchall() is None
+ 
+    def test_row_factory(self):
+        self.conn.row_factory = sqlite3.Row
+        try:
+            cur = self.conn.cursor()
+            cur.execute('SELECT name FROM test_clients WHERE id = 1')
+            assert cur.fetchone()['name'] == 'Mr. First'
+        finally:
+            self.conn.row_factory = None
+ 
+    def test_connection_per_thread(self):
+        conns = []
+        def work():
+            conns.append(self.conn.get_connection())
+            cur = self.conn.cursor()
+            cur.execute('INSERT INTO test_clients VALUES (NULL, ?, ?)', ['Thread', 20])
+        threads = [threading.Thread(target=work) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(set(map(id, conns))) == 3
+        cur = self.conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM test_clients WHERE name = ?', ['Thread'])
+        assert cur.fetchone() == (3, )
+
+    def test_execute_batch(self):
+        cur = self.conn.cursor()
+        cur.execute_batch([('INSERT INTO test_clients VALUES (?, ?, ?)', [10, 'Batch', 1]),
+                           ('INSERT INTO test_clients VALUES (?, ?, ?)', [11, 'Batch', 2])])
+        assert_raises(sqlite3.IntegrityError, cur.execute_batch,
+                      [('INSERT INTO test_clients VALUES (?, ?, ?)', [12, 'Batch', 3]),
+                       ('INSERT INTO test_clients VALUES (?, ?, ?)', [10, 'Batch', 4])])
+        cur.execute('SELECT id FROM test_clients WHERE name = ? ORDER BY id', ['Batch'])
+        assert cur.fetchall() == [(10, ), (11, )]